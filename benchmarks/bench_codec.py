@@ -0,0 +1,51 @@
+"""Compare the stdlib json calls the migrator used to make with the codec
+module, for each stage's JSON work on one large synthetic job.
+
+Run from the top of the repository as:
+
+    python -m benchmarks.bench_codec [--blob-size N] [--repeat N]
+"""
+import argparse
+import io
+import json
+import timeit
+from squash_migrator import codec
+from .synthetic import make_job
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--blob-size", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    job = make_job(1, blob_size=args.blob_size)
+    raw = json.dumps(job).encode("utf-8")
+    pretty = json.dumps(job, indent=4, sort_keys=True)
+    compact = codec.dumps(job, compact=True)
+    print("decoder: %s; job: %d bytes raw, %d pretty, %d compact" %
+          (codec.DECODER, len(raw), len(pretty), len(compact)))
+    cases = [
+        ("extract: decode response",
+         lambda: json.loads(raw),
+         lambda: codec.loads(raw)),
+        ("transform: read job",
+         lambda: json.load(io.StringIO(pretty)),
+         lambda: codec.load(io.StringIO(compact))),
+        ("extract/transform: write",
+         lambda: json.dump(job, io.StringIO(), indent=4, sort_keys=True),
+         lambda: codec.dump(job, io.StringIO(), compact=True)),
+        ("load: read job",
+         lambda: json.load(io.StringIO(pretty)),
+         lambda: codec.load(io.StringIO(compact))),
+    ]
+    print("%-26s %12s %12s %8s" % ("stage", "stdlib ms", "codec ms",
+                                     "speedup"))
+    for name, old, new in cases:
+        t_old = min(timeit.repeat(old, number=1, repeat=args.repeat)) * 1000
+        t_new = min(timeit.repeat(new, number=1, repeat=args.repeat)) * 1000
+        print("%-26s %12.2f %12.2f %7.1fx" % (name, t_old, t_new,
+                                              t_old / t_new))
+
+
+if __name__ == "__main__":
+    main()
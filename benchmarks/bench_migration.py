@@ -0,0 +1,216 @@
+"""Measure extract, transform, and load throughput against local stand-in
+services.
+
+Each stage runs in a fresh process, so that its peak memory can be
+measured on its own; the stand-in services run in processes of their
+own.  For each stage this reports jobs per second, bytes per second (as
+sent by the old service for extract, read from the job cache for
+transform, received by the new service for load, and sent back by it
+for --verify), and peak resident memory, both of the stage's main
+process and of any worker processes.
+
+Run from the top of the repository as, for example:
+
+    python -m benchmarks.bench_migration --jobs 200 --blob-size 5000 \\
+        --latency 0.02 --workers 4 --output results.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import requests
+from squash_migrator.context import Context
+from squash_migrator.extractor import Extractor
+from squash_migrator.loader import Loader, UPLOAD_ENCODINGS
+from squash_migrator.main import Migrator
+from squash_migrator.store import STORE_TYPES
+from squash_migrator.transformer import Transformer
+from squash_migrator.verifier import Verifier, VERIFIED
+from .servers import start_server
+
+STAGES = ["extract", "transform", "load"]
+# ru_maxrss is in kilobytes, except on macOS.
+MAXRSS_SCALE = 1 if sys.platform == "darwin" else 1024
+
+
+def _run_stage(stage, options, conn):
+    """Run one stage (or, for "etl", the whole pipelined migration) in
+    this process and send back its wall time and peak memory.
+    """
+    context = Context(user="benchmark", password="benchmark",
+                      loglevel=options["loglevel"],
+                      directory=options["directory"],
+                      from_url=options["from_url"],
+                      to_url=options["to_url"],
+                      workers=options["workers"],
+                      max_uploads=options["max_uploads"],
+                      store=options["store"],
+                      compact=options["compact"],
+                      upload_encoding=options["upload_encoding"])
+    start = time.perf_counter()
+    verified = None
+    if stage == "extract":
+        Extractor(context=context).extract()
+    elif stage == "transform":
+        Transformer(context=context).transform()
+    elif stage == "load":
+        Loader(context=context).load()
+    elif stage == "verify":
+        verified = len(Verifier(context=context).verify()[VERIFIED])
+    else:
+        migrator = Migrator(context, Extractor(context=context),
+                            Transformer(context=context),
+                            Loader(context=context))
+        migrator.etl(pipeline=True)
+    elapsed = time.perf_counter() - start
+    conn.send({
+        "seconds": elapsed,
+        "verified": verified,
+        "peak_rss": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss *
+                     MAXRSS_SCALE),
+        "worker_peak_rss": (resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss * MAXRSS_SCALE)})
+    conn.close()
+
+
+def run_stage(stage, options):
+    ctx = multiprocessing.get_context("spawn")
+    parent, child = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_run_stage, args=(stage, options, child))
+    proc.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        raise RuntimeError("Stage '%s' failed" % stage)
+    proc.join()
+    return result
+
+
+def get_stats(url):
+    return requests.get(url + "/_stats").json()
+
+
+def count_jobs(directory, state):
+    """Return how many jobs the manifest says reached state, and their
+    total size at that point if it is recorded.
+    """
+    conn = sqlite3.connect(os.path.join(directory, "manifest.sqlite"))
+    try:
+        size = "0"
+        if state != "loaded":
+            size = "SUM(%s_size)" % state
+        row = conn.execute("SELECT COUNT(*), %s FROM jobs " % size +
+                           "WHERE %s IS NOT NULL" % state).fetchone()
+    finally:
+        conn.close()
+    return row[0], row[1] or 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--jobs", type=int, default=100)
+    parser.add_argument("--blob-size", type=int, default=1000,
+                        help="Floats per column of each job's blob")
+    parser.add_argument("--measurements", type=int, default=20)
+    parser.add_argument("--packages", type=int, default=80)
+    parser.add_argument("--repr-blobs", action="store_true",
+                        help="Serialize job blobs with repr()")
+    parser.add_argument("--gzip", action="store_true",
+                        help="Have the old service compress responses")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="Seconds to delay each request to either service")
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--upload-delay", type=float, default=0.5,
+                        help="Seconds for which each upload is pending")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-uploads", type=int, default=None)
+    parser.add_argument("--store", choices=STORE_TYPES, default="directory")
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("--upload-encoding", choices=UPLOAD_ENCODINGS,
+                        default="auto")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Time one pipelined run instead of each stage")
+    parser.add_argument("--verify", action="store_true",
+                        help="Also time verifying the loaded jobs")
+    parser.add_argument("--directory", default=None,
+                        help="Working directory [default: a temporary one]")
+    parser.add_argument("--loglevel", default="warning")
+    parser.add_argument("--output", default=None,
+                        help="Also write the results as JSON to this file")
+    args = parser.parse_args()
+    server_options = {"latency": args.latency, "jitter": args.jitter}
+    old_proc, from_url = start_server(
+        "old", jobs=args.jobs, blob_size=args.blob_size,
+        measurements=args.measurements, packages=args.packages,
+        repr_blobs=args.repr_blobs, gzip=args.gzip, **server_options)
+    new_proc, to_url = start_server("new", upload_delay=args.upload_delay,
+                                    **server_options)
+    directory = args.directory or tempfile.mkdtemp(prefix="squash-bench-")
+    options = {"loglevel": getattr(logging, args.loglevel.upper()),
+               "directory": directory,
+               "from_url": from_url,
+               "to_url": to_url,
+               "workers": args.workers,
+               "max_uploads": args.max_uploads,
+               "store": args.store,
+               "compact": args.compact,
+               "upload_encoding": args.upload_encoding}
+    stages = STAGES
+    if args.pipeline:
+        stages = ["etl"]
+    if args.verify:
+        stages = stages + ["verify"]
+    results = []
+    try:
+        for stage in stages:
+            old_before = get_stats(from_url)
+            new_before = get_stats(to_url)
+            result = run_stage(stage, options)
+            old_after = get_stats(from_url)
+            new_after = get_stats(to_url)
+            if stage in ("extract", "etl"):
+                jobs = count_jobs(directory, "extracted")[0]
+                nbytes = old_after["bytes_out"] - old_before["bytes_out"]
+            if stage == "transform":
+                jobs = count_jobs(directory, "transformed")[0]
+                nbytes = count_jobs(directory, "extracted")[1]
+            if stage == "load":
+                jobs = count_jobs(directory, "loaded")[0]
+                nbytes = new_after["bytes_in"] - new_before["bytes_in"]
+            if stage == "verify":
+                jobs = result["verified"]
+                nbytes = new_after["bytes_out"] - new_before["bytes_out"]
+            result.update({"stage": stage, "jobs": jobs, "bytes": nbytes})
+            results.append(result)
+    finally:
+        old_proc.terminate()
+        new_proc.terminate()
+        if not args.directory:
+            shutil.rmtree(directory, ignore_errors=True)
+    print("%-10s %6s %9s %9s %9s %10s %10s" %
+          ("stage", "jobs", "seconds", "jobs/s", "MB/s", "peak MB",
+           "workers MB"))
+    for result in results:
+        seconds = result["seconds"]
+        result["jobs_per_second"] = result["jobs"] / seconds
+        result["bytes_per_second"] = result["bytes"] / seconds
+        print("%-10s %6d %9.2f %9.1f %9.2f %10.1f %10.1f" %
+              (result["stage"], result["jobs"], seconds,
+               result["jobs_per_second"], result["bytes_per_second"] / 1e6,
+               result["peak_rss"] / 1e6, result["worker_peak_rss"] / 1e6))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"parameters": vars(args), "results": results}, f,
+                      indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
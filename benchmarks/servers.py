@@ -0,0 +1,330 @@
+"""Local stand-ins for the old and new SQuaSH services, for benchmarks.
+
+The old service serves synthetic jobs from /jobs (paginated, or one at a
+time) and their metric units from /metrics/; the new service accepts
+jobs at /job, hands out tokens (which may be made to expire) at /auth,
+reports each upload as pending for a while before it succeeds, and
+serves the jobs it holds back at /job/<id>.  Every request is delayed by
+a configurable latency.  Both count the requests and bytes they see, at
+/_stats, so that a benchmark can work out transfer rates.
+
+Either can be run by hand from the top of the repository:
+
+    python -m benchmarks.servers old --port 8000 --jobs 200 --latency 0.05
+"""
+import argparse
+import base64
+import gzip
+import json
+import multiprocessing
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from .synthetic import make_job, make_metrics
+
+SERVER_KINDS = ["old", "new"]
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 1000
+METRICS_ETAG = '"metrics-v1"'
+
+
+class StandInServer(ThreadingHTTPServer):
+    """HTTP server holding the options and counters shared by its
+    handlers.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, handler, options):
+        super().__init__(address, handler)
+        self.options = options
+        self.base_url = "http://%s:%d" % (address[0], self.server_port)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "bytes_in": 0, "bytes_out": 0}
+        self.jobs = {}
+        self.uploads = {}
+        self.loaded = {}
+        self.next_upload = 1
+
+    def count(self, bytes_in=0, bytes_out=0):
+        with self.lock:
+            self.stats["requests"] = self.stats["requests"] + 1
+            self.stats["bytes_in"] = self.stats["bytes_in"] + bytes_in
+            self.stats["bytes_out"] = self.stats["bytes_out"] + bytes_out
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _delay(self):
+        options = self.server.options
+        latency = options.get("latency", 0)
+        jitter = options.get("jitter", 0)
+        if latency or jitter:
+            time.sleep(max(0, latency + random.uniform(-jitter, jitter)))
+
+    def _send(self, body, status=200, headers=None, bytes_in=0):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        accept = self.headers.get("Accept-Encoding", "")
+        encoded = (self.server.options.get("gzip") and "gzip" in accept and
+                   body)
+        if encoded:
+            body = gzip.compress(body, compresslevel=1)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if encoded:
+            self.send_header("Content-Encoding", "gzip")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(bytes_in=bytes_in, bytes_out=len(body))
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        if self.headers.get("Content-Encoding") == "gzip":
+            return len(body), gzip.decompress(body)
+        return len(body), body
+
+    def _stats(self):
+        with self.server.lock:
+            stats = dict(self.server.stats)
+        body = json.dumps(stats).encode("utf-8")
+        # Not counted, so that polling the counters does not move them.
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class OldServiceHandler(_Handler):
+    """The parts of the old SQuaSH API the extractor and transformer
+    use.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path.rstrip("/")
+        if path == "/_stats":
+            return self._stats()
+        self._delay()
+        query = parse_qs(url.query)
+        if path == "/jobs":
+            return self._send(self._get_page(query))
+        if path.startswith("/jobs/"):
+            try:
+                jobnum = int(path.split("/")[2])
+            except ValueError:
+                jobnum = 0
+            if not 1 <= jobnum <= self.server.options["jobs"]:
+                return self._send({"detail": "Not found."}, status=404)
+            return self._send(self._get_job(jobnum))
+        if path == "/metrics":
+            if self.headers.get("If-None-Match") == METRICS_ETAG:
+                return self._send(b"", status=304)
+            metrics = make_metrics()
+            return self._send({"count": len(metrics), "next": None,
+                               "results": metrics},
+                              headers={"ETag": METRICS_ETAG})
+        self._send({"detail": "Not found."}, status=404)
+
+    def _get_job(self, jobnum):
+        # Jobs are generated once and kept encoded, so that the stand-in
+        #  is not what limits throughput.
+        server = self.server
+        with server.lock:
+            data = server.jobs.get(jobnum)
+        if data is None:
+            options = server.options
+            job = make_job(jobnum, base_url=server.base_url,
+                           blob_size=options.get("blob_size", 1000),
+                           measurements=options.get("measurements", 20),
+                           packages=options.get("packages", 80),
+                           repr_blobs=options.get("repr_blobs", False))
+            data = json.dumps(job).encode("utf-8")
+            with server.lock:
+                server.jobs[jobnum] = data
+        return data
+
+    def _get_page(self, query):
+        count = self.server.options["jobs"]
+        try:
+            page = int(query.get("page", ["1"])[0])
+            size = int(query.get("page_size", [DEFAULT_PAGE_SIZE])[0])
+        except ValueError:
+            page, size = 1, DEFAULT_PAGE_SIZE
+        size = max(1, min(size, MAX_PAGE_SIZE))
+        first = (page - 1) * size + 1
+        last = min(count, page * size)
+        nexturl = "null"
+        if last < count:
+            nexturl = '"%s/jobs/?page=%d' % (self.server.base_url, page + 1)
+            if "page_size" in query:
+                nexturl = nexturl + "&page_size=%d" % size
+            nexturl = nexturl + '"'
+        results = b",".join(self._get_job(j) for j in range(first, last + 1))
+        return (('{"count":%d,"next":%s,"results":[' % (count, nexturl))
+                .encode("utf-8") + results + b"]}")
+
+
+class NewServiceHandler(_Handler):
+    """The parts of the new SQuaSH API the loader uses.
+    """
+
+    def do_GET(self):
+        path = urlparse(self.path).path.rstrip("/")
+        if path == "/_stats":
+            return self._stats()
+        self._delay()
+        if path.startswith("/user/"):
+            return self._send({"username": path.split("/")[2]})
+        if path.startswith("/job/"):
+            with self.server.lock:
+                body = self.server.loaded.get(path.split("/")[2])
+            if body is None:
+                return self._send({"message": "Not found."}, status=404)
+            return self._send(body)
+        if path.startswith("/status/"):
+            with self.server.lock:
+                started = self.server.uploads.get(path.split("/")[2])
+            if started is None:
+                return self._send({"message": "Not found."}, status=404)
+            delay = self.server.options.get("upload_delay", 0)
+            status = "PENDING"
+            if time.monotonic() - started >= delay:
+                status = "SUCCESS"
+            return self._send({"status": status})
+        self._send({"message": "Not found."}, status=404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path.rstrip("/")
+        try:
+            size, body = self._read_body()
+        except OSError:
+            return self._send({"message": "Bad body."}, status=400)
+        self._delay()
+        if path == "/auth":
+            return self._send({"access_token": self._make_token()},
+                              bytes_in=size)
+        if path == "/register":
+            return self._send({"message": "User created."}, status=201,
+                              bytes_in=size)
+        if path == "/job":
+            if not self._authorized():
+                return self._send({"message": "No valid token."},
+                                  status=401, bytes_in=size)
+            try:
+                json.loads(body)
+            except ValueError:
+                return self._send({"message": "Bad JSON."}, status=400,
+                                  bytes_in=size)
+            with self.server.lock:
+                jobid = self.server.next_upload
+                self.server.next_upload = jobid + 1
+                self.server.uploads[str(jobid)] = time.monotonic()
+                if self.server.options.get("keep_jobs", True):
+                    self.server.loaded[str(jobid)] = body
+            return self._send(
+                {"message": "Job `%d` accepted." % jobid,
+                 "status": "%s/status/%d" % (self.server.base_url, jobid)},
+                status=202, bytes_in=size)
+        self._send({"message": "Not found."}, status=404, bytes_in=size)
+
+    def _make_token(self):
+        # Shaped like a JWT, so that the migrator can read its expiry.
+        now = time.time()
+        lifetime = self.server.options.get("token_lifetime") or 24 * 3600
+        claims = json.dumps({"iat": now, "exp": now + lifetime})
+        payload = base64.urlsafe_b64encode(claims.encode("utf-8"))
+        return "e30." + payload.decode("ascii").rstrip("=") + ".benchmark"
+
+    def _authorized(self):
+        header = self.headers.get("Authorization") or ""
+        try:
+            payload = header.split(".")[1]
+            payload = payload + "=" * (-len(payload) % 4)
+            claims = json.loads(base64.urlsafe_b64decode(payload))
+            return time.time() < claims["exp"]
+        except (IndexError, KeyError, TypeError, ValueError):
+            return False
+
+
+def make_server(kind, host="127.0.0.1", port=0, **options):
+    """Create (but do not start) a stand-in for the "old" or "new"
+    service.  Options are jobs, blob_size, measurements, packages,
+    repr_blobs, and gzip for the old service, upload_delay, keep_jobs
+    (whether to hold uploaded jobs for /job/<id>), and token_lifetime (in
+    seconds) for the new, and latency and jitter (in seconds) for both.
+    """
+    handlers = {"old": OldServiceHandler, "new": NewServiceHandler}
+    options.setdefault("jobs", 100)
+    return StandInServer((host, port), handlers[kind], options)
+
+
+def _serve(kind, options, conn):
+    server = make_server(kind, **options)
+    conn.send(server.base_url)
+    conn.close()
+    server.serve_forever()
+
+
+def start_server(kind, **options):
+    """Run a stand-in service in a separate process, so that it does not
+    count towards the migrator's CPU time or memory.  Returns the process
+    (terminate it when done) and the service's base URL.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    parent, child = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_serve, args=(kind, options, child),
+                       daemon=True)
+    proc.start()
+    child.close()
+    base_url = parent.recv()
+    parent.close()
+    return proc, base_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("kind", choices=SERVER_KINDS)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--jobs", type=int, default=100)
+    parser.add_argument("--blob-size", type=int, default=1000)
+    parser.add_argument("--measurements", type=int, default=20)
+    parser.add_argument("--packages", type=int, default=80)
+    parser.add_argument("--repr-blobs", action="store_true")
+    parser.add_argument("--gzip", action="store_true",
+                        help="Compress responses when the client asks")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Seconds to delay each request")
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--upload-delay", type=float, default=0,
+                        help="Seconds for which each upload is pending")
+    parser.add_argument("--token-lifetime", type=float, default=None,
+                        help="Seconds for which each token is accepted")
+    args = parser.parse_args()
+    server = make_server(args.kind, host=args.host, port=args.port,
+                         jobs=args.jobs, blob_size=args.blob_size,
+                         measurements=args.measurements,
+                         packages=args.packages, repr_blobs=args.repr_blobs,
+                         gzip=args.gzip, latency=args.latency,
+                         jitter=args.jitter, upload_delay=args.upload_delay,
+                         token_lifetime=args.token_lifetime)
+    print("Serving the %s service at %s" % (args.kind, server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Synthetic SQuaSH jobs in the old service's format, for benchmarks.
+"""
+import random
+
+FILTERS = ["r", "z", "HSC-I"]
+SPECS = ["design", "minimum", "stretch"]
+METRICS = ["AD1", "AD2", "AF1", "AF2", "PA2", "PF1"]
+
+
+def make_job(jobnum, base_url="http://localhost", blob_size=1000,
+             measurements=20, seed=None, packages=80, repr_blobs=False):
+    """Return an old-style job whose metadata strings are serialized with
+    repr(), as many real ones were, and whose blob holds blob_size
+    floats.  With repr_blobs set, the blobs are a repr() string too.
+    """
+    rnd = random.Random(jobnum if seed is None else seed)
+    meas = []
+    for i in range(measurements):
+        metric = METRICS[i % len(METRICS)]
+        metadata = {"spec_name": SPECS[i % len(SPECS)],
+                    "filter_name": FILTERS[i % len(FILTERS)],
+                    "parameters": {"brightSnr": 100, "gnum": 5},
+                    "extras": {"rms": [rnd.random() for _ in range(10)]},
+                    "blobs": {"matchedDataset": "%032x" % jobnum}}
+        meas.append({"metric": metric,
+                     "value": rnd.random(),
+                     "metadata": repr(metadata)})
+    blobs = [{"identifier": "%032x" % jobnum,
+              "name": "MatchedMultiVisitDataset",
+              "data": {"mag": [rnd.random() for _ in range(blob_size)],
+                       "snr": [rnd.random() for _ in range(blob_size)]}}]
+    packages = [{"name": "pkg%d" % i,
+                 "build_version": "13.0-%d" % i,
+                 "git_commit": "%040x" % rnd.getrandbits(160),
+                 "git_url": "https://github.com/lsst/pkg%d.git" % i,
+                 "git_branch": "master"} for i in range(packages)]
+    if repr_blobs:
+        blobs = repr(blobs)
+    return {"links": {"self": "%s/jobs/%d/" % (base_url, jobnum)},
+            "ci_id": str(jobnum),
+            "ci_name": "validate_drp",
+            "ci_dataset": "cfht",
+            "ci_label": "centos-7",
+            "ci_url": "https://ci.lsst.codes/job/%d/" % jobnum,
+            "date": "2017-10-01T00:00:00Z",
+            "status": 0,
+            "measurements": meas,
+            "blobs": blobs,
+            "packages": packages}
+
+
+def make_metrics():
+    """Return the old service's metric list, one entry per metric used by
+    make_job().
+    """
+    return [{"metric": metric, "unit": "mmag" if metric[0] == "A" else "mag"}
+            for metric in METRICS]
@@ -1,15 +1,14 @@
 """Base class for the Extractor, Transformer, and Loader classes.
    Contains utility methods common to those classes.
 """
-import glob
-import json
 import os
-import requests
 
 
 class Actuator(object):
     """Base class for SQuaSH migration components.
     """
+    # Name of the stage in statistics; set by subclasses.
+    stage = None
 
     def __init__(self, context=None):
         if not context:
@@ -17,13 +16,25 @@ class Actuator(object):
         self.context = context
         self.directory = os.path.abspath(context.directory)
         self.job_numbers = self.context.job_numbers
-        self.session = requests.Session()
+        self.metrics = context.metrics
+        # All actuators share the context's connection pool and per-host
+        #  concurrency control.
+        self.session = context.http
 
-    def scan_for_jobs(self, directory):
-        """Find jobs matching job file name format in a given directory.
+    @property
+    def manifest(self):
+        """The working directory's job manifest, shared through the
+        context.
         """
-        fileglobstr = os.path.join(directory, "job-*.json")
-        return glob.glob(fileglobstr)
+        return self.context.manifest
+
+    def count_job(self, outcome, size=None):
+        """Count a job this stage has finished with: outcome is "ok",
+        "skipped", or "failed", and size the bytes it wrote, if any.
+        """
+        self.metrics.incr("jobs_total", stage=self.stage, outcome=outcome)
+        if size:
+            self.metrics.incr("job_bytes_total", size, stage=self.stage)
 
     def get_jobnum_for_job(self, job):
         """Given a job, get the job number for it.  If new-style, it needs
@@ -36,12 +47,6 @@ class Actuator(object):
         jobnum = int(jobnumstr)
         return jobnum
 
-    def get_filename_for_jobnum(self, directory, jobnum):
-        """Given a job number and directory, produce the job file name.
-        """
-        fname = os.path.join(directory, "job-%s.json" % str(jobnum))
-        return fname
-
     def show_response_error(self, resp, exc):
         """Show an HTTP response error, eliding text if necessary.
         """
@@ -67,16 +72,18 @@ class Actuator(object):
                      input[-1000:])
         return instr
 
-    def write_job(self, job, directory):
-        """Write JSON for job to file in specified directory.
+    def write_job(self, job, store, overwrite=False):
+        """Write JSON for job to the specified job store.  Returns the
+        job number and the stored size, which is None if the job was
+        already present (and not to be overwritten).
         """
         jobnum = self.get_jobnum_for_job(job)
         job["_job_number"] = jobnum
-        fname = self.get_filename_for_jobnum(directory, jobnum)
-        if os.path.exists(fname):
-            self.logger.info(
-                "File '%s' exists; remove to allow it rewriting." % fname)
-            return
-        with open(fname, "w") as fp:
-            self.logger.debug("Writing job to file '%s'." % fname)
-            json.dump(job, fp, indent=4, sort_keys=True)
+        location = store.location(jobnum)
+        if not overwrite and store.exists(jobnum):
+            self.logger.info("'%s' exists; remove it and use " % location +
+                             "--rebuild-manifest to allow it rewriting.")
+            return jobnum, None
+        self.logger.debug("Writing job to '%s'." % location)
+        size = store.write(jobnum, job)
+        return jobnum, size
@@ -0,0 +1,176 @@
+"""Authentication with the new SQuaSH service.
+"""
+import base64
+import json
+import os
+import threading
+import time
+import requests
+
+# Seconds to wait for each request made to authenticate.
+AUTH_TIMEOUT = 15
+# A token is renewed once it is this many seconds, or a quarter of its
+#  lifetime if that is shorter, from expiring.
+REFRESH_MARGIN = 60
+# Seconds after failing to get a token before trying again unprompted.
+RETRY_DELAY = 30
+# Cache of the last token, in the working directory.
+TOKEN_CACHE = "auth_token.json"
+
+
+class TokenSource(object):
+    """Gets the token with which to write to the new service on first use,
+    rather than on every start: from the cache in directory if it holds an
+    unexpired token for the same service and user, and otherwise by
+    authenticating (registering the user first if need be).  Tokens are
+    renewed shortly before they expire and when the service rejects them.
+    A token given outright is used until it is rejected.
+
+    The cache file is readable by its owner only, and holds no password.
+    """
+
+    def __init__(self, http, url, user=None, password=None, token=None,
+                 directory=None, logger=None):
+        self.http = http
+        self.url = url
+        self.user = user
+        self._password = password
+        self.cache_file = None
+        if directory:
+            self.cache_file = os.path.join(directory, TOKEN_CACHE)
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._token = token
+        self._expires, self._margin = _get_expiry(token)
+        self._tried = False
+        self._retry_after = 0
+
+    @property
+    def can_renew(self):
+        return bool(self.user and self._password)
+
+    def get_token(self):
+        """Return the current token, or None if there is none to be had.
+        """
+        with self._lock:
+            if self._token and not self._expiring():
+                return self._token
+            if not self.can_renew:
+                if not self._token and not self._tried:
+                    self._tried = True
+                    self._warn("no credentials")
+                return self._token
+            if not self._token and self._read_cache():
+                return self._token
+            if time.monotonic() >= self._retry_after:
+                self._authenticate()
+            return self._token
+
+    def renew(self, token):
+        """Replace token, which the service has rejected, unless another
+        thread already has.  Returns whether there is a different token.
+        """
+        with self._lock:
+            if self._token != token:
+                return self._token is not None
+            if not self.can_renew:
+                return False
+            self._token = None
+            self._authenticate()
+            return self._token is not None and self._token != token
+
+    def _expiring(self):
+        return (self._expires is not None and
+                time.time() > self._expires - self._margin)
+
+    def _authenticate(self):
+        url = self.url
+        user = self.user
+        ustruct = {"username": user, "password": self._password}
+        session = self.http
+        self._tried = True
+        try:
+            self._debug("Trying to acquire token for '%s'." % url)
+            resp = session.get(url + "/user/" + user, timeout=AUTH_TIMEOUT)
+            if resp.status_code != requests.codes.ok:
+                self._debug("Trying to create user '%s'." % user)
+                # If we don't have a user, this will fail.
+                session.post(url + "/register", json=ustruct,
+                             timeout=AUTH_TIMEOUT)
+            self._debug("Getting token for user '%s'" % user)
+            resp = session.post(url + "/auth", json=ustruct,
+                                timeout=AUTH_TIMEOUT)
+            token = resp.json()["access_token"]
+        except (requests.exceptions.RequestException, KeyError,
+                TypeError, ValueError) as exc:
+            self._warn(str(exc))
+            self._retry_after = time.monotonic() + RETRY_DELAY
+            return
+        self._token = token
+        self._expires, self._margin = _get_expiry(token)
+        self._write_cache()
+
+    def _read_cache(self):
+        if not self.cache_file:
+            return False
+        try:
+            with open(self.cache_file, "r") as f:
+                cached = json.load(f)
+            if cached["url"] != self.url or cached["user"] != self.user:
+                return False
+            self._token = cached["token"]
+            self._expires, self._margin = _get_expiry(self._token)
+        except (OSError, KeyError, TypeError, ValueError):
+            return False
+        if self._expiring():
+            self._token = None
+            return False
+        self._debug("Using cached token for user '%s'." % self.user)
+        return True
+
+    def _write_cache(self):
+        if not self.cache_file:
+            return
+        tmpfile = self.cache_file + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), mode=0o755,
+                        exist_ok=True)
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump({"url": self.url, "user": self.user,
+                           "token": self._token}, f)
+            os.replace(tmpfile, self.cache_file)
+        except OSError as exc:
+            if self.logger:
+                self.logger.warning("Could not cache token in '%s': %s" %
+                                    (self.cache_file, str(exc)))
+
+    def _debug(self, message):
+        if self.logger:
+            self.logger.debug(message)
+
+    def _warn(self, reason):
+        if self.logger:
+            self.logger.warning("Could not get token for %s (%s); " %
+                                (self.url, reason) + "no write possible.")
+
+
+def _get_expiry(token):
+    """Return the expiry time in a JWT's payload (None if it has none that
+    can be read), and how long before then to renew it.
+    """
+    try:
+        payload = token.split(".")[1]
+        payload = payload + "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        expires = float(claims["exp"])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None, REFRESH_MARGIN
+    try:
+        margin = min(REFRESH_MARGIN, (expires - float(claims["iat"])) / 4)
+    except (KeyError, TypeError, ValueError):
+        margin = REFRESH_MARGIN
+    return expires, margin
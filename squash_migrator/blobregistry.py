@@ -0,0 +1,51 @@
+"""Persistent record of blob identifiers already uploaded to the target.
+"""
+import os
+import threading
+
+
+class BlobRegistry(object):
+    """Set of blob identifiers known to be held by the target service,
+    kept in the working directory as an append-only file with one
+    identifier per line.  Since transformed blob identifiers are derived
+    from blob content, an identifier in the registry means the target
+    already has that exact blob.
+    """
+
+    def __init__(self, directory, logger=None):
+        self.path = os.path.join(directory, "blobs.registry")
+        self.logger = logger
+        self.blobids = set()
+        self._fp = None
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                for line in f:
+                    blobid = line.strip()
+                    if blobid:
+                        self.blobids.add(blobid)
+
+    def __contains__(self, blobid):
+        return blobid in self.blobids
+
+    def __len__(self):
+        return len(self.blobids)
+
+    def add(self, blobids):
+        """Record that the target now holds the given blobs.
+        """
+        with self._lock:
+            new = [b for b in blobids if b not in self.blobids]
+            if not new:
+                return
+            if not self._fp:
+                self._fp = open(self.path, "a")
+            self._fp.write("".join(b + "\n" for b in new))
+            self._fp.flush()
+            self.blobids.update(new)
+
+    def close(self):
+        with self._lock:
+            if self._fp:
+                self._fp.close()
+                self._fp = None
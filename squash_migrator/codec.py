@@ -0,0 +1,69 @@
+"""JSON encoding and decoding for the migrator's hot I/O paths.
+
+Decoding uses orjson when it is installed and falls back to the standard
+library otherwise, and also whenever orjson rejects its input; the
+standard library accepts a few things orjson does not (NaN, Infinity,
+integers wider than 64 bits), so the decoded value is always the one
+json.loads would give.
+
+Encoding always uses the standard library, because orjson silently writes
+NaN as null.  It is still much faster in compact mode than the
+indent=4 json.dump the caches used to use: indented or streamed output
+forces the pure-Python encoder, while compact one-shot output uses the C
+encoder.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    DECODER = "orjson"
+else:
+    DECODER = "json"
+
+
+def loads(data):
+    """Decode a JSON document from str or bytes.  Raises
+    json.decoder.JSONDecodeError on invalid input, with the standard
+    library's error message.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def dumps(obj, compact=False, allow_nan=True):
+    """Encode obj as a str with sorted keys.  The default pretty form is
+    byte-identical to json.dump(obj, fp, indent=4, sort_keys=True); the
+    compact form has no insignificant whitespace.  Unless allow_nan is
+    set, NaN and infinities raise ValueError rather than being written
+    as the non-standard NaN and Infinity.
+    """
+    if compact:
+        return json.dumps(obj, sort_keys=True, separators=(",", ":"),
+                          allow_nan=allow_nan)
+    return json.dumps(obj, indent=4, sort_keys=True, allow_nan=allow_nan)
+
+
+def load(fp):
+    """Decode a JSON document from an open file.
+    """
+    return loads(fp.read())
+
+
+def dump(obj, fp, compact=False):
+    """Encode obj to an open text file.
+    """
+    fp.write(dumps(obj, compact=compact))
+
+
+def response_json(resp):
+    """Decode the body of a requests response.
+    """
+    return loads(resp.content)
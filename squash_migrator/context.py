@@ -1,5 +1,10 @@
 import logging
-import requests
+import threading
+from .auth import TokenSource
+from .jobmap import JobMap
+from .manifest import open_manifest
+from .metrics import Metrics
+from .transport import HTTPClient
 
 
 class Context:
@@ -8,7 +13,13 @@ class Context:
 
     def __init__(self, user=None, password=None, token=None,
                  logger=None, loglevel=None, directory=None, from_url=None,
-                 to_url=None, job_numbers=None):
+                 to_url=None, job_numbers=None, workers=None,
+                 max_uploads=None, refresh_metrics=False, store=None,
+                 compact=False, skip_known_blobs=False,
+                 rebuild_manifest=False, incremental=False,
+                 upload_encoding=None, stats_interval=None,
+                 prometheus_file=None, profile=None, metric_names=None,
+                 min_page_size=None, max_page_size=None):
         self.from_url = from_url
         self.to_url = to_url
         if not logger:
@@ -19,36 +30,125 @@ class Context:
         self.loglevel = loglevel
         logger.setLevel(loglevel)
         self.directory = directory
+        self.metrics = Metrics()
+        self._http = None
+        self._manifest = None
+        self._manifest_lock = threading.Lock()
+        self._jobmap = None
+        self._jobmap_lock = threading.Lock()
         if job_numbers is None:
             job_numbers = set()
         self.job_numbers = job_numbers
-        if to_url and not token:
-            logger.debug("Trying to acquire token for '%s'." % to_url)
-            ustruct = {"username": user,
-                       "password": password
-                       }
-            if user and password:
-                session = requests.Session()
-                resp = session.get(to_url + "/user/" + user, timeout=5)
-                if resp.status_code != requests.codes.ok:
-                    logger.debug("Trying to create user '%s'." % user)
-                    # Try creating the user
-                    resp = session.post(
-                        to_url + "/register", json=ustruct, timeout=5)
-                    # If we don't have a user, this will fail.
-                logger.debug("Getting token for user '%s'" % user)
-                resp = session.post(to_url + "/auth", json=ustruct, timeout=5)
-                try:
-                    token = resp.json()['access_token']
-                except (KeyError, ValueError):
-                    pass
+        if not workers or workers < 1:
+            workers = 1
+        self.workers = workers
+        self.max_uploads = max_uploads
+        self.refresh_metrics = refresh_metrics
+        if not store:
+            store = "directory"
+        self.store = store
+        self.compact = compact
+        self.skip_known_blobs = skip_known_blobs
+        self.rebuild_manifest = rebuild_manifest
+        self.incremental = incremental
+        if not upload_encoding:
+            upload_encoding = "auto"
+        self.upload_encoding = upload_encoding
+        self.stats_interval = stats_interval
+        self.prometheus_file = prometheus_file
+        self.profile = profile
+        self.metric_names = metric_names
+        self.min_page_size = min_page_size
+        self.max_page_size = max_page_size
+        # Nothing is sent to the new service until something needs to
+        #  write to it.
+        self._auth = None
+        if to_url:
+            self._auth = TokenSource(self.http, to_url, user=user,
+                                     password=password, token=token,
+                                     directory=directory, logger=logger)
         user = None
         password = None
-        if token:
-            self.headers = {
-                "Authorization": "JWT " + token
-            }
-        else:
-            self.headers = {}
-            logger.warning("Could not get token for context; no write to %s" %
-                           to_url)
+
+    @property
+    def headers(self):
+        """Headers with which to write to the new service, empty if no
+        token can be had.
+        """
+        token = None
+        if self._auth:
+            token = self._auth.get_token()
+        if not token:
+            return {}
+        return {"Authorization": "JWT " + token}
+
+    def authorized_request(self, method, url, headers=None, **kwargs):
+        """Send a request to the new service with the current token.  If
+        the service rejects the token, get a new one and send the request
+        once more.
+        """
+        headers = headers or {}
+        auth = self.headers
+        resp = self.http.request(method, url, headers=dict(headers, **auth),
+                                 **kwargs)
+        if resp.status_code != 401 or not auth or not self._auth:
+            return resp
+        token = auth["Authorization"][len("JWT "):]
+        if not self._auth.renew(token):
+            return resp
+        self.logger.info("Token rejected by %s; retrying with a new one." %
+                         url)
+        resp.close()
+        return self.http.request(method, url,
+                                 headers=dict(headers, **self.headers),
+                                 **kwargs)
+
+    @property
+    def http(self):
+        """The HTTP client shared by everything using this context.
+        """
+        if self._http is None:
+            self._http = HTTPClient(concurrency=self.workers,
+                                    logger=self.logger,
+                                    metrics=self.metrics)
+        return self._http
+
+    @property
+    def manifest(self):
+        """The working directory's job manifest, opened (and built, if need
+        be) on first use.  Every stage shares it, so that concurrent stages
+        never rebuild it under one another.
+        """
+        with self._manifest_lock:
+            if self._manifest is None:
+                self._manifest = open_manifest(self, logger=self.logger)
+        return self._manifest
+
+    @property
+    def jobmap(self):
+        """The working directory's map of old to new job numbers, read on
+        first use and shared, like the manifest, by every stage.
+        """
+        with self._jobmap_lock:
+            if self._jobmap is None:
+                self._jobmap = JobMap(self.directory, logger=self.logger)
+        return self._jobmap
+
+    def __getstate__(self):
+        # The client holds a connection pool and locks; worker processes
+        #  build their own.
+        state = self.__dict__.copy()
+        state["_http"] = None
+        # Nor do they write to the new service, the manifest, or the job
+        #  map.
+        state["_auth"] = None
+        state["_manifest"] = None
+        state["_jobmap"] = None
+        del state["_manifest_lock"]
+        del state["_jobmap_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._manifest_lock = threading.Lock()
+        self._jobmap_lock = threading.Lock()
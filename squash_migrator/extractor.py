@@ -1,97 +1,596 @@
 import json
 import logging
-import os
+import time
 import requests
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, \
+    FIRST_COMPLETED
+from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
+from . import codec
+from . import stream
 from .actuator import Actuator
+from .manifest import EXTRACTED
+from .store import open_store
 
 MAX_TIMEOUT = 10 * 60
 BASE_TIMEOUT = 15
+# Manifest checkpoint holding the progress of a bulk extract.
+BULK_CHECKPOINT = "bulk_extract"
+# Default limits on the number of jobs asked for in each page of the
+#  listing.
+MIN_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 1000
+# Pages grow while they take less than half of each of these, and shrink
+#  when they take more than either.
+PAGE_TARGET_SECONDS = 5
+PAGE_TARGET_BYTES = 16 * 1024 * 1024
+# Attempts at a page before its jobs are left for a later run.
+PAGE_ATTEMPTS = 3
+
+
+class PageSizer(object):
+    """Chooses how many jobs to ask for in each page of the listing.
+
+    Sizes are min_size doubled some number of times, up to max_size, so
+    that the offset at which a page of one size ends is always one at
+    which a page of any smaller size can start.  The size doubles after a
+    page of the current size comes back quickly and small, once the next
+    offset allows it, and halves after a page is slow, large, or fails.
+    """
+
+    def __init__(self, min_size=None, max_size=None, logger=None):
+        min_size = max(1, min_size or MIN_PAGE_SIZE)
+        max_size = max(min_size, max_size or MAX_PAGE_SIZE)
+        self.sizes = [min_size]
+        while self.sizes[-1] * 2 <= max_size:
+            self.sizes.append(self.sizes[-1] * 2)
+        self.level = 0
+        self.logger = logger
+
+    @property
+    def size(self):
+        return self.sizes[self.level]
+
+    def size_at(self, offset):
+        """Return the largest size, up to the current one, of a page that
+        starts at offset.
+        """
+        for size in reversed(self.sizes[:self.level + 1]):
+            if offset % size == 0:
+                return size
+        # Only after a page the service sized itself.
+        return max(d for d in range(min(self.size, offset), 0, -1)
+                   if offset % d == 0)
+
+    def record(self, size, seconds, nbytes):
+        """Adjust the size given a page of size jobs that took seconds and
+        nbytes.
+        """
+        if seconds > PAGE_TARGET_SECONDS or nbytes > PAGE_TARGET_BYTES:
+            self.shrink()
+        elif (size >= self.size and seconds < PAGE_TARGET_SECONDS / 2 and
+              nbytes < PAGE_TARGET_BYTES / 2 and
+              self.level + 1 < len(self.sizes)):
+            self.level = self.level + 1
+            self._log()
+
+    def shrink(self):
+        if self.level > 0:
+            self.level = self.level - 1
+            self._log()
+
+    def limit(self, size, asked):
+        """Stop asking for more than size jobs, the service having sent
+        that many when asked for a different number.
+        """
+        if size > asked:
+            # The page size was ignored.
+            self.sizes = [size]
+        else:
+            self.sizes = [s for s in self.sizes if s <= size] or [size]
+        self.level = min(self.level, len(self.sizes) - 1)
+        if self.logger:
+            self.logger.info("Service sent pages of %d jobs; " % size +
+                             "using at most %d." % self.sizes[-1])
+
+    def _log(self):
+        if self.logger:
+            self.logger.debug("Page size now %d jobs." % self.size)
 
 
 class Extractor(Actuator):
     """Class to extract SQuaSH jobs from the old database and write them to
     a local directory.
     """
+    stage = "extract"
 
     def __init__(self, context=None):
         super().__init__(context=context)
         self.url = context.from_url
-        self.output_directory = os.path.join(self.directory, "jobs")
+        self.store = open_store(context, "jobs")
         logger = logging.getLogger(__name__)
         logger.setLevel(context.loglevel)
         self.logger = logger
+        self.on_job = None
+        self._announced = set()
+        self._highest_listed = None
 
-    def extract(self):
+    def extract(self, on_job=None):
         """Connect to the SQuaSH DB to copy from, and extract some or all
-        jobs.  Since jobs are immutable, if there is already a file
-        representing the job, don't rewrite it.
+        jobs.  Since jobs are immutable, if the job store already holds
+        the job, don't rewrite it.
+
+        If on_job is given, it is called from the calling thread with the
+        job number of each job as soon as that job is stored.
         """
+        self.on_job = on_job
+        self._announced = set()
+        self._highest_listed = None
         job_numbers = self.context.job_numbers
-        os.makedirs(self.output_directory, mode=0o755, exist_ok=True)
-        if not job_numbers:
-            self._bulk_extract()
-        else:
-            self._individual_extract(job_numbers)
-
-    def _get_job(self, url):
-        timeout = BASE_TIMEOUT
-        saved_exception = None
-        while timeout <= MAX_TIMEOUT:
-            try:
-                resp = self.session.get(url, timeout=timeout)
-                return resp
-            except requests.exceptions.ConnectionError as exc:
-                self.logger.warning(
-                    "Connection error: %s / timeout %d s" % (str(exc), timeout)
-                )
-                saved_exception = exc
-            timeout = timeout * 2
-        raise saved_exception
+        self.metrics.stage_started(self.stage)
+        complete = False
+        try:
+            if job_numbers:
+                self._individual_extract(job_numbers)
+            elif self.context.incremental:
+                complete = self._incremental_extract()
+            else:
+                complete = self._bulk_extract()
+        finally:
+            self.manifest.flush()
+            self.metrics.stage_finished(self.stage)
+        # Only a listing read to the end shows that no job below the
+        #  highest one in it is missing.
+        if complete and self._highest_listed is not None:
+            self.manifest.set_high_water_mark(self._highest_listed)
+
+    def _get_job(self, url, stream=False):
+        # The shared client retries with backoff, doubling the timeout
+        #  whenever a (possibly very large) job is slow to arrive.
+        return self.session.get(url, timeout=BASE_TIMEOUT,
+                                max_timeout=MAX_TIMEOUT, stream=stream)
 
     def _bulk_extract(self):
-        nexturl = self.url + "/jobs"
-        so_far = 0
+        """Extract every job in the listing.  Progress is checkpointed in
+        the manifest after each page: as the ranges of the listing already
+        written, or, where pages can only be reached by following "next"
+        links, as the next link to follow.  An interrupted extract then
+        resumes where it stopped rather than at the first page.
+
+        Where the listing takes a page size, the size of each page is
+        chosen by a PageSizer, so that small jobs come many to a page and
+        large ones few.  Returns whether every page was extracted.
+        """
+        listing = self.url + "/jobs"
+        checkpoint = self.manifest.get_checkpoint(BULK_CHECKPOINT)
+        if checkpoint and checkpoint.get("url") != listing:
+            checkpoint = None
+        if checkpoint and checkpoint.get("next"):
+            self.logger.info("Resuming extract from '%s'." %
+                             checkpoint["next"])
+            self._highest_listed = checkpoint.get("highest")
+            self._announce_extracted()
+            return self._follow_pages(checkpoint["next"], checkpoint)
+        sizer = PageSizer(self.context.min_page_size,
+                          self.context.max_page_size, logger=self.logger)
+        size = sizer.size_at(0)
+        j_resp, seconds, nbytes = self._fetch_page(
+            listing + "?" + urlencode({"page_size": size}))
+        if j_resp is None:
+            return False
+        count = j_resp["count"]
+        if checkpoint and not self._checkpoint_valid(checkpoint, j_resp):
+            self.logger.info("Job listing changed since the last " +
+                             "checkpoint; extracting from the start.")
+            checkpoint = None
+        if checkpoint:
+            self.logger.info("Resuming extract: %d/%d jobs already done." %
+                             (_covered(checkpoint["done"]), count))
+            self._highest_listed = checkpoint.get("highest")
+            self._announce_extracted()
+        else:
+            checkpoint = {"url": listing, "done": []}
+        checkpoint["count"] = count
+        self._write_listed_page(j_resp, 0, checkpoint)
+        if not j_resp.get("next"):
+            self.manifest.clear_checkpoint(BULK_CHECKPOINT)
+            return True
+        if not j_resp["results"] or not self._get_page_url(j_resp, 2):
+            return self._follow_pages(j_resp["next"], checkpoint)
+        if len(j_resp["results"]) != size:
+            sizer.limit(len(j_resp["results"]), size)
+        else:
+            sizer.record(size, seconds, nbytes)
+        if self._paged_extract(j_resp, checkpoint, sizer):
+            self.manifest.clear_checkpoint(BULK_CHECKPOINT)
+            return True
+        self.logger.warning("Some pages were not extracted; run again " +
+                            "to fetch only those.")
+        return False
+
+    def _checkpoint_valid(self, checkpoint, j_resp):
+        """A checkpoint's ranges still hold if the listing has the same
+        length or, listed in ascending job order, has only grown at the
+        end.
+        """
+        if checkpoint.get("count") == j_resp["count"]:
+            return True
+        jobnums = [self.get_jobnum_for_job(job) for job in j_resp["results"]]
+        return (j_resp["count"] > checkpoint.get("count", 0) and
+                jobnums == sorted(jobnums))
+
+    def _announce_extracted(self):
+        """On resuming, pass on the jobs from pages that will not be
+        fetched again, once each.
+        """
+        if not self.on_job:
+            return
+        for jobnum in self.manifest.jobnums(EXTRACTED):
+            self._announced.add(jobnum)
+            self.on_job(jobnum)
+
+    def _follow_pages(self, nexturl, checkpoint):
+        """Follow "next" links from nexturl, checkpointing each link
+        before it is followed.  Returns whether the last page was reached.
+        """
+        so_far = _covered(checkpoint["done"])
         while nexturl:
-            url = nexturl
+            checkpoint["next"] = nexturl
+            self.manifest.save_checkpoint(BULK_CHECKPOINT, checkpoint)
+            j_resp = self._fetch_page(nexturl)[0]
+            if j_resp is None:
+                self.logger.warning("Extract stopped; run again to resume " +
+                                    "from '%s'." % nexturl)
+                return False
+            nexturl = j_resp.get("next")
+            so_far = so_far + self._write_page(j_resp)
+            checkpoint["done"] = [[0, so_far]]
+            checkpoint["highest"] = self._highest_listed
+            self.logger.info("%s: %d/%s" % (self.url, so_far,
+                                            j_resp["count"]))
+        self.manifest.clear_checkpoint(BULK_CHECKPOINT)
+        return True
+
+    def _write_listed_page(self, j_resp, offset, checkpoint):
+        """Write a page holding the jobs at offset in the listing, and
+        checkpoint that they are done.
+        """
+        written = self._write_page(j_resp)
+        _add_range(checkpoint["done"], offset, offset + written)
+        checkpoint["highest"] = self._highest_listed
+        self.manifest.save_checkpoint(BULK_CHECKPOINT, checkpoint)
+        self.logger.info("%s: %d/%s" % (self.url,
+                                        _covered(checkpoint["done"]),
+                                        checkpoint["count"]))
+
+    def _fetch_page(self, url):
+        """Fetch one page of the job collection.  Returns the decoded
+        response (or None if it could not be fetched or decoded), the
+        seconds taken, and the size of the body as sent.
+        """
+        start = time.monotonic()
+        try:
             resp = self._get_job(url)
-            nexturl = None
-            try:
-                j_resp = resp.json()
-            except json.decoder.JSONDecodeError as exc:
-                self.show_response_error(resp, exc)
+            nbytes = len(resp.content)
+        except requests.exceptions.RequestException as exc:
+            self.logger.error("Did not fetch page '%s': %s" % (url, str(exc)))
+            return None, time.monotonic() - start, 0
+        try:
+            with self.metrics.timer("json_decode_seconds", stage=self.stage):
+                j_resp = codec.response_json(resp)
+        except json.decoder.JSONDecodeError as exc:
+            self.show_response_error(resp, exc)
+            j_resp = None
+        return j_resp, time.monotonic() - start, nbytes
+
+    def _write_page(self, j_resp):
+        jobs = j_resp["results"]
+        for job in jobs:
+            with self.metrics.timer("json_encode_seconds", stage=self.stage):
+                jobnum, size = self.write_job(job, self.store)
+            self.count_job("skipped" if size is None else "ok", size)
+            self.manifest.mark(jobnum, EXTRACTED, size=size)
+            if (self._highest_listed is None or
+                    jobnum > self._highest_listed):
+                self._highest_listed = jobnum
+            # Pages of different sizes may overlap.
+            if self.on_job and jobnum not in self._announced:
+                self._announced.add(jobnum)
+                self.on_job(jobnum)
+        return len(jobs)
+
+    def _get_page_url(self, j_resp, page, page_size=None):
+        """Rewrite the "next" link of a page of the job collection to point
+        at the given page number (of the given size, if one is given), or
+        return None if it has no page number.
+        """
+        if not j_resp.get("next"):
+            return None
+        parsed = urlparse(j_resp["next"])
+        query = parse_qs(parsed.query)
+        if "page" not in query:
+            return None
+        query["page"] = [str(page)]
+        if page_size:
+            query["page_size"] = [str(page_size)]
+        return urlunparse(parsed._replace(query=urlencode(query, doseq=True)))
+
+    def _incremental_extract(self):
+        """Extract only jobs newer than the high-water mark, stopping once
+        the listing reaches jobs we already have.  Returns whether the
+        listing was read as far as it needed to be.
+        """
+        hwm = self.manifest.get_high_water_mark()
+        if hwm is None:
+            self.logger.info("No high-water mark; extracting all jobs.")
+            return self._bulk_extract()
+        url = self.url + "/jobs"
+        j_resp = self._fetch_page(url)[0]
+        if j_resp is None:
+            return False
+        jobnums = [self.get_jobnum_for_job(job) for job in j_resp["results"]]
+        if len(jobnums) > 1 and jobnums[0] > jobnums[-1]:
+            # Newest first: page forward until we reach old jobs.
+            so_far = 0
+            complete = True
+            while True:
+                new = [job for job in j_resp["results"]
+                       if self.get_jobnum_for_job(job) > hwm]
+                so_far = so_far + self._write_page({"results": new})
+                if (len(new) < len(j_resp["results"]) or
+                        not j_resp.get("next")):
+                    break
+                j_resp = self._fetch_page(j_resp["next"])[0]
+                if j_resp is None:
+                    complete = False
+                    break
+        else:
+            so_far, complete = self._extract_after(j_resp, hwm)
+        self.logger.info("%s: %d jobs newer than job %d" %
+                         (self.url, so_far, hwm))
+        return complete
+
+    def _extract_after(self, first, hwm):
+        """With the listing in ascending order, start at the page where the
+        jobs we hold should end and follow "next" links from there.
+        Returns the number of jobs written and whether the last page was
+        reached.
+        """
+        pagesize = len(first["results"])
+        have = self.manifest.count_extracted(hwm)
+        page = 1
+        if pagesize and have:
+            page = (have - 1) // pagesize + 1
+        j_resp = first
+        while page > 1:
+            url = self._get_page_url(first, page)
+            if not url:
+                page = 1
                 break
-            if "next" in j_resp:
-                nexturl = j_resp["next"]
-            jobs = j_resp["results"]
-            so_far = so_far + len(jobs)
-            for job in j_resp["results"]:
-                self.write_job(job, self.output_directory)
-            self.logger.info("%s: %d/%s" % (self.url, so_far, j_resp["count"]))
+            j_resp = self._fetch_page(url)[0]
+            if j_resp is None:
+                return 0, False
+            results = j_resp["results"]
+            # If jobs were deleted upstream, the mark may lie earlier.
+            if not results or self.get_jobnum_for_job(results[0]) > hwm:
+                page = page - 1
+                continue
+            break
+        if page == 1:
+            j_resp = first
+        so_far = 0
+        while True:
+            new = [job for job in j_resp["results"]
+                   if self.get_jobnum_for_job(job) > hwm]
+            so_far = so_far + self._write_page({"results": new})
+            if not j_resp.get("next"):
+                return so_far, True
+            j_resp = self._fetch_page(j_resp["next"])[0]
+            if j_resp is None:
+                return so_far, False
+
+    def _paged_extract(self, first, checkpoint, sizer):
+        """Fetch the parts of the listing the checkpoint does not cover,
+        concurrently if there are several workers, writing each page in
+        this thread as it arrives so that the network and the disk are
+        kept busy at the same time.  At most twice as many pages as there
+        are workers are held in memory at once.  Returns whether every
+        page was written.
+        """
+        workers = self.context.workers
+        window = 2 * workers if workers > 1 else 1
+        count = checkpoint["count"]
+        pending = {}
+        attempts = {}
+        skipped = []
+        with ThreadPoolExecutor(max_workers=workers,
+                                thread_name_prefix=self.stage) as executor:
+            while True:
+                while len(pending) < window:
+                    # Merged, since _first_gap needs sorted ranges.
+                    claimed = [list(r) for r in checkpoint["done"]]
+                    for low, high in skipped:
+                        _add_range(claimed, low, high)
+                    for offset, size, page in pending.values():
+                        _add_range(claimed, offset, offset + size)
+                    offset = _first_gap(claimed, count)
+                    if offset is None:
+                        break
+                    size = sizer.size_at(offset)
+                    page = offset // size + 1
+                    url = self._get_page_url(first, page, size)
+                    pending[executor.submit(self._fetch_page, url)] = \
+                        (offset, size, page)
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    offset, size, page = pending.pop(future)
+                    j_resp, seconds, nbytes = future.result()
+                    if j_resp is None:
+                        sizer.shrink()
+                        attempts[offset] = attempts.get(offset, 0) + 1
+                        if attempts[offset] >= PAGE_ATTEMPTS:
+                            _add_range(skipped, offset, offset + size)
+                        continue
+                    got = len(j_resp["results"])
+                    if j_resp.get("next") and got != size:
+                        # The service paged by a size of its own.
+                        sizer.limit(got, size)
+                        offset = (page - 1) * got
+                    else:
+                        sizer.record(size, seconds, nbytes)
+                    self._write_listed_page(j_resp, offset, checkpoint)
+                    if not j_resp.get("next") or not got:
+                        # Jobs were removed since the count was taken.
+                        _add_range(checkpoint["done"], offset, count)
+        return not skipped
 
     def _individual_extract(self, job_numbers):
         lenjob = len(job_numbers)
         so_far = 0
-        for jobnum in job_numbers:
-            fname = self.get_filename_for_jobnum(self.output_directory, jobnum)
-            if os.path.exists(fname):
-                self.logger.info(
-                    "File '%s' exists; remove to re-fetch." % fname)
-                so_far = so_far + 1
-                continue
-            url = self.url + "/jobs/" + str(jobnum) + "/"
-            try:
-                resp = self._get_job(url)
-            except requests.exceptions.ConnectionError as exc:
-                self.logger.error("Did not fetch '%s': %s" % (url, str(exc)))
-                continue
-            try:
-                j_resp = resp.json()
-            except json.decoder.JSONDecodeError as exc:
-                self._showerror(resp, exc)
-                continue
-            try:
-                self.write_job(j_resp, self.output_directory)
-                so_far = so_far + 1
-            except KeyError:
-                self.logger.error("Job %d malformed: cannot write." % jobnum)
-            self.logger.info("%s: %d/%d", url, so_far, lenjob)
+        workers = self.context.workers
+        extracted = self.manifest.has(EXTRACTED)
+        fetch = sorted(set(job_numbers) - extracted)
+        for jobnum in sorted(set(job_numbers) & extracted):
+            so_far = so_far + 1
+            if self.on_job:
+                self.on_job(jobnum)
+        if so_far:
+            self.logger.info("%d/%d jobs already extracted." %
+                             (so_far, lenjob))
+        with ThreadPoolExecutor(max_workers=workers,
+                                thread_name_prefix=self.stage) as executor:
+            futures = [executor.submit(self._extract_job, jobnum)
+                       for jobnum in fetch]
+            # Jobs complete in arbitrary order; count them as they finish.
+            for future in as_completed(futures):
+                jobnum, done = future.result()
+                if done:
+                    so_far = so_far + 1
+                    if self.on_job:
+                        self.on_job(jobnum)
+                self.logger.info("%s: job %d: %d/%d", self.url, jobnum,
+                                 so_far, lenjob)
+
+    def _extract_job(self, jobnum):
+        """Fetch and write a single job, recording the outcome in the
+        manifest.  Returns a tuple of the job number and whether the job is
+        now in the job store.
+        """
+        url = self.url + "/jobs/" + str(jobnum) + "/"
+        try:
+            resp = self._get_job(url, stream=True)
+        except requests.exceptions.RequestException as exc:
+            self.logger.error("Did not fetch '%s': %s" % (url, str(exc)))
+            self.manifest.mark_failed(jobnum, EXTRACTED, str(exc))
+            self.count_job("failed")
+            return jobnum, False
+        # The decoded size of a compressed body is not known in advance.
+        length = resp.headers.get("Content-Length")
+        if (not length or resp.headers.get("Content-Encoding") or
+                int(length) > stream.STREAM_THRESHOLD):
+            return self._stream_job(jobnum, resp)
+        try:
+            # Read the body first, so that only decoding is timed.
+            resp.content
+            with self.metrics.timer("json_decode_seconds", stage=self.stage):
+                j_resp = codec.response_json(resp)
+        except json.decoder.JSONDecodeError as exc:
+            self.show_response_error(resp, exc)
+            self.manifest.mark_failed(jobnum, EXTRACTED, str(exc))
+            self.count_job("failed")
+            return jobnum, False
+        try:
+            with self.metrics.timer("json_encode_seconds", stage=self.stage):
+                jobnum, size = self.write_job(j_resp, self.store)
+        except KeyError:
+            self.logger.error("Job %d malformed: cannot write." % jobnum)
+            self.manifest.mark_failed(jobnum, EXTRACTED, "malformed job")
+            self.count_job("failed")
+            return jobnum, False
+        self.count_job("skipped" if size is None else "ok", size)
+        self.manifest.mark(jobnum, EXTRACTED, size=size)
+        return jobnum, True
+
+    def _stream_job(self, jobnum, resp):
+        """Copy a job of unknown or large size from the response to the
+        job store without ever holding all of it in memory.
+        """
+        location = self.store.location(jobnum)
+        if self.store.exists(jobnum):
+            resp.close()
+            self.logger.info("'%s' exists; remove it and use " % location +
+                             "--rebuild-manifest to allow it rewriting.")
+            self.manifest.mark(jobnum, EXTRACTED)
+            self.count_job("skipped")
+            return jobnum, True
+        self.logger.debug("Streaming job to '%s'." % location)
+        fp = stream.ChunkReader(resp.iter_content(stream.CHUNK_SIZE))
+        # Decoding and re-encoding are interleaved with the download, so
+        #  all of it counts as decoding.
+        start = time.monotonic()
+        try:
+            with stream.ObjectWriter(compact=self.store.compact) as job:
+                members = {}
+                for key, value in stream.iter_object(fp, stream.JOB_ARRAYS):
+                    if isinstance(value, Iterator):
+                        array = job.array(key)
+                        for element in value:
+                            array.append(element)
+                    else:
+                        job.set(key, value)
+                        members[key] = value
+                jobnum = self.get_jobnum_for_job(members)
+                job.set("_job_number", jobnum)
+                with self.store.writer(jobnum) as out:
+                    job.write(out)
+        except (requests.exceptions.RequestException, KeyError, TypeError,
+                ValueError, OSError) as exc:
+            self.logger.error("Could not extract job %d from %s: %s: %s" %
+                              (jobnum, resp.url, type(exc).__name__,
+                               str(exc)))
+            self.manifest.mark_failed(jobnum, EXTRACTED, str(exc))
+            self.count_job("failed")
+            return jobnum, False
+        finally:
+            resp.close()
+        self.metrics.observe("json_decode_seconds",
+                             time.monotonic() - start, stage=self.stage)
+        self.count_job("ok", out.size)
+        self.manifest.mark(jobnum, EXTRACTED, size=out.size)
+        return jobnum, True
+
+
+def _add_range(ranges, first, end):
+    """Add the half-open range [first, end) to a sorted list of disjoint
+    [first, end) pairs, merging where they touch.
+    """
+    if end <= first:
+        return
+    merged = []
+    for low, high in ranges:
+        if high < first or low > end:
+            merged.append([low, high])
+        else:
+            first = min(first, low)
+            end = max(end, high)
+    merged.append([first, end])
+    ranges[:] = sorted(merged)
+
+
+def _first_gap(ranges, count):
+    """Return the first offset below count not in ranges, or None.
+    """
+    offset = 0
+    for low, high in ranges:
+        if low > offset:
+            break
+        offset = max(offset, high)
+    if offset >= count:
+        return None
+    return offset
+
+
+def _covered(ranges):
+    return sum(high - low for low, high in ranges)
@@ -0,0 +1,125 @@
+"""Persistent map from old to new job numbers.
+"""
+import json
+import os
+import threading
+
+# Number of journal entries after which the journal is folded into the
+#  map file.
+COMPACT_INTERVAL = 1000
+# Stands in a journal line for the new job number of a removed job.
+REMOVED = "-"
+
+
+class JobMap(object):
+    """Map of old job number to new job number, kept in a directory as
+    jobmap.json plus an append-only journal of pairs added (and of job
+    numbers removed) since the map file was last written.  Adding or
+    removing a pair costs one short append, and a crash can lose at most
+    the line being written.
+    """
+
+    def __init__(self, directory, logger=None):
+        self.mapfile = os.path.join(directory, "jobmap.json")
+        self.journal = os.path.join(directory, "jobmap.journal")
+        self.logger = logger
+        self.map = {}
+        self._journaled = 0
+        self._journal_fp = None
+        self._lock = threading.Lock()
+        self._read()
+
+    def __contains__(self, jobnum):
+        return jobnum in self.map
+
+    def __len__(self):
+        return len(self.map)
+
+    def get(self, jobnum, default=None):
+        return self.map.get(jobnum, default)
+
+    def items(self):
+        return self.map.items()
+
+    def add(self, jobnum, new_jobnum):
+        """Record that old job jobnum was loaded as new_jobnum.
+        """
+        with self._lock:
+            self.map[jobnum] = new_jobnum
+            self._append("%d %d\n" % (jobnum, new_jobnum))
+
+    def remove(self, jobnums):
+        """Forget that the given old jobs were loaded.
+        """
+        with self._lock:
+            for jobnum in jobnums:
+                if self.map.pop(jobnum, None) is not None:
+                    self._append("%d %s\n" % (jobnum, REMOVED))
+
+    def compact(self):
+        """Write the whole map to jobmap.json and empty the journal.
+        """
+        with self._lock:
+            self._compact()
+
+    def close(self):
+        self.compact()
+
+    def _append(self, line):
+        if not self._journal_fp:
+            self._journal_fp = open(self.journal, "a")
+        self._journal_fp.write(line)
+        self._journal_fp.flush()
+        self._journaled = self._journaled + 1
+        if self._journaled >= COMPACT_INTERVAL:
+            self._compact()
+
+    def _compact(self):
+        if self._journal_fp:
+            self._journal_fp.close()
+            self._journal_fp = None
+        tmpfile = self.mapfile + ".tmp"
+        with open(tmpfile, "w") as f:
+            # This makes the object key a string
+            json.dump(self.map, f)
+        os.replace(tmpfile, self.mapfile)
+        if os.path.exists(self.journal):
+            os.remove(self.journal)
+        self._journaled = 0
+
+    def _read(self):
+        if os.path.exists(self.mapfile):
+            with open(self.mapfile, "r") as f:
+                # because JSON, keys come back as strings
+                for key, value in json.load(f).items():
+                    self.map[int(key)] = value
+        if not os.path.exists(self.journal):
+            return
+        torn = False
+        with open(self.journal, "r") as f:
+            for line in f:
+                # Every entry is written with its newline, so a line
+                #  without one was torn by an interrupted write.
+                bad = not line.endswith("\n")
+                torn = torn or bad
+                fields = line.split()
+                try:
+                    jobnum = int(fields[0])
+                    if fields[1] != REMOVED:
+                        new_jobnum = int(fields[1])
+                except (IndexError, ValueError):
+                    bad = True
+                if bad:
+                    if self.logger:
+                        self.logger.warning(
+                            "Ignoring bad jobmap journal line '%s'" %
+                            line.rstrip())
+                    continue
+                if fields[1] == REMOVED:
+                    self.map.pop(jobnum, None)
+                else:
+                    self.map[jobnum] = new_jobnum
+                self._journaled = self._journaled + 1
+        if torn:
+            # Otherwise the next entry would be appended to the torn line.
+            self._compact()
@@ -0,0 +1,43 @@
+"""Decoder for strings that hold either JSON or the repr() of a Python
+literal, as the metadata and blobs of some old SQuaSH jobs do.
+"""
+import ast
+from . import codec
+
+
+def decode(input):
+    """Decode input, which may be JSON or a Python literal repr, without
+    evaluating any code.  The likely format is picked from the first
+    quote character, so each string is normally parsed once.  Raises
+    ValueError if input is neither.
+    """
+    if _looks_like_repr(input):
+        parsers = (_literal_eval, codec.loads)
+    else:
+        parsers = (codec.loads, _literal_eval)
+    try:
+        return parsers[0](input)
+    except ValueError as exc:
+        first_exc = exc
+    try:
+        return parsers[1](input)
+    except ValueError:
+        raise first_exc
+
+
+def _looks_like_repr(input):
+    # JSON strings and keys are always double-quoted; repr() prefers
+    #  single quotes (with a u prefix under Python 2).
+    for char in input[:200]:
+        if char == '"':
+            return False
+        if char == "'":
+            return True
+    return False
+
+
+def _literal_eval(input):
+    try:
+        return ast.literal_eval(input.strip())
+    except (SyntaxError, TypeError, MemoryError, RecursionError) as exc:
+        raise ValueError("Not a Python literal: %s" % str(exc))
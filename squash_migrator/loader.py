@@ -1,128 +1,529 @@
+import functools
+import gzip
 import json
 import logging
-import os
+import tempfile
+import threading
 import time
+import requests
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from . import codec
+from . import stream
 from .actuator import Actuator
+from .blobregistry import BlobRegistry
+from .manifest import LOADED, TRANSFORMED
+from .store import open_store
+
+# Default cap on uploads that are POSTed but not yet finished.
+MAX_OUTSTANDING = 32
+# Status polling starts at MIN_POLL_DELAY seconds per upload and doubles
+#  up to MAX_POLL_DELAY; an upload pending longer than MAX_POLL_TIME fails.
+MIN_POLL_DELAY = 1
+MAX_POLL_DELAY = 30
+MAX_POLL_TIME = 300
+# How job bodies are sent; "auto" means gzip unless the service refuses it.
+UPLOAD_ENCODINGS = ["auto", "gzip", "identity"]
+GZIP_LEVEL = 6
+# Bodies smaller than this are not worth compressing.
+MIN_GZIP_SIZE = 1024
+# Responses with which a service may turn down a compressed body.
+GZIP_REJECTED_STATUSES = frozenset([400, 415])
 
 
 class Loader(Actuator):
     """Class to load new SQuaSH representation into database."""
+    stage = "load"
 
     def __init__(self, context=None):
         super().__init__(context=context)
-        self.input_dir = os.path.join(self.directory, "transformed")
+        self.input_store = open_store(context, "transformed")
         self.to_url = self.context.to_url
         logger = logging.getLogger(__name__)
         logger.setLevel(context.loglevel)
         self.logger = logger
+        self.max_outstanding = context.max_uploads or MAX_OUTSTANDING
+        # Whether the target takes gzip bodies: None until an upload
+        #  settles it.
+        self.accepts_gzip = None
+        if context.upload_encoding == "gzip":
+            self.accepts_gzip = True
+        elif context.upload_encoding == "identity":
+            self.accepts_gzip = False
+        self.so_far = 0
+        self.numfiles = None
+        self.jobmap = None
+        self.blob_registry = None
+        self._new_jobnums = {}
+        self._sent_blobids = {}
+        self._lock = threading.Lock()
+        self._outstanding = None
+        self._executor = None
+        self._poller = None
 
     def load(self):
         """Push transformed jobs into target database"""
+        job_numbers = self.job_numbers
+        manifest = self.manifest
+        inputjobs = manifest.jobnums(TRANSFORMED)
+        if job_numbers:
+            inputjobs = [j for j in inputjobs if j in job_numbers]
+            if len(inputjobs) < len(job_numbers):
+                self.logger.warning(
+                    "%d requested jobs were never transformed." %
+                    (len(job_numbers) - len(inputjobs)))
+        if not inputjobs:
+            self.logger.error("No input jobs found in %s to load" %
+                              self.input_store.location("*"))
+            return
+        if not self.start(numfiles=len(inputjobs)):
+            return
+        done = manifest.has(LOADED)
+        self.so_far = len([j for j in inputjobs if j in done])
+        if self.so_far:
+            self.logger.info("%d/%d jobs already loaded." %
+                             (self.so_far, len(inputjobs)))
+        try:
+            for jobnum in inputjobs:
+                if jobnum not in done:
+                    self.submit(jobnum)
+        finally:
+            self.finish()
+
+    def start(self, numfiles=None):
+        """Prepare the session, the POST workers, and the status poller
+        for loading.  Returns False if there are no credentials with which
+        to load jobs.
+        """
         headers = self.context.headers
         if not headers:
             self.logger.warning("No authentication to load jobs.")
+            return False
+        self.metrics.stage_started(self.stage)
+        self.so_far = 0
+        self.numfiles = numfiles
+        self.jobmap = self.context.jobmap
+        self._new_jobnums = {}
+        self._sent_blobids = {}
+        if self.context.skip_known_blobs:
+            self.blob_registry = BlobRegistry(self.directory,
+                                              logger=self.logger)
+        self._outstanding = threading.BoundedSemaphore(self.max_outstanding)
+        self._executor = ThreadPoolExecutor(max_workers=self.context.workers,
+                                            thread_name_prefix=self.stage)
+        self._poller = StatusPoller(self.context, self.logger,
+                                    self._upload_finished,
+                                    metrics=self.metrics)
+        self._poller.start()
+        return True
+
+    def submit(self, jobnum):
+        """Queue a transformed job for sending.  Blocks while the maximum
+        number of uploads is already outstanding.  Jobs already in the job
+        map were loaded by an earlier run and are skipped.
+        """
+        if jobnum in self.jobmap:
+            self.logger.info("Job %d already loaded as %d; skipping." %
+                             (jobnum, self.jobmap.get(jobnum)))
+            self.count_job("skipped")
             return
-        inputfiles = []
-        job_numbers = self.job_numbers
-        if not job_numbers:
-            inputfiles = self.scan_for_jobs(self.input_dir)
-        else:
-            for jobnum in job_numbers:
-                inputfiles.append(self.get_filename_for_jobnum(
-                    self.input_dir, jobnum))
-        if not inputfiles:
-            self.logger.error("No input files found in %s to load" %
-                              self.input_dir)
+        self._outstanding.acquire()
+        self._executor.submit(self._send_job, jobnum)
+
+    def finish(self):
+        """Wait for every submitted job to be sent and for its upload to
+        complete or fail.
+        """
+        self._executor.shutdown(wait=True)
+        self._poller.stop()
+        self.jobmap.close()
+        self.manifest.flush()
+        if self.blob_registry is not None:
+            self.blob_registry.close()
+        self.metrics.stage_finished(self.stage)
+
+    def _send_job(self, jobnum):
+        try:
+            statuslink = self._post_job(jobnum)
+        except Exception as exc:
+            self.logger.error("Could not send job %d: %s" % (jobnum, str(exc)))
+            statuslink = None
+        if statuslink is None:
+            self._upload_finished(jobnum, False)
             return
-        session = self.session
-        session.headers.update(self.context.headers)
-        so_far = 0
-        numfiles = len(inputfiles)
-        jobmap = {}
-        for fname in inputfiles:
-            try:
-                with open(fname, "r") as f:
-                    self.logger.debug("Loading '%s' for transmission" % fname)
-                    job = json.load(f)
-                    # _job_number is used in new jobs for correlation but
-                    #   should not be sent
-                    jobnumstr = os.path.basename(fname)[4:-5]
-                    jobnum = int(jobnumstr)
-                    save_num = None
-                    if "_job_number" in job:
-                        save_num = job["_job_number"]
-                        del job["_job_number"]
-                        if save_num is not None and save_num != jobnum:
-                            errstr = ("_job_number %d != filename %d" %
-                                      (save_num, jobnum))
-                            self.logger.error(errstr)
-                    url = self.to_url + "/job"
-                    self.logger.info(
-                        "Sending transformed job %d to %s" % (jobnum, url))
-                    resp = session.post(url, json=job)
-                    if (resp.status_code < 200 or
-                            resp.status_code > 299):
-                        # Should always be 202 if it worked.
-                        self.logger.error("POST error '%s': HTTP %d / '%s'" %
-                                          (fname, resp.status_code, resp.text))
-                    continue
-                    try:
-                        r_json = resp.json()
-                        message = r_json["message"]
-                        statuslink = r_json["status"]
-                    except (json.decoder.JSONDecodeError, KeyError) as exc:
-                        self.logger.error("Malformed response from " +
-                                          "%s (%s): %s" % (url, str(exc),
-                                                           resp.text))
-                        continue
-                    # This is cheesy, but we rely on the message format
-                    #  to extract the new job ID
-                    # To wit, 'Job `XYZ` accepted' or similar, where
-                    #  XYZ is within backticks.
-                    try:
-                        new_jobnum = int(message.split('`')[1])
-                        jobmap[jobnum] = new_jobnum
-                    except ValueError:
-                        errstr = "Could not get job numbers for '%s' % fname"
-                        self.logger.error(errstr)
-                    try:
-                        self._check_status(statuslink)
-                    except (RuntimeError, KeyError,
-                            json.decoder.JSONDecodeError) as exc:
-                        self.logger.error("Data load failed: %s" % str(exc))
-                        continue
-                    so_far = so_far + 1
-                    self.logger.info("%s: %d/%d" % (fname, so_far, numfiles))
-                if jobmap:
-                    with open(os.path.join(self.directory, "jobmap.json"),
-                              "w") as f:
-                        # This makes the object key a string
-                        json.dump(jobmap, f)
-                    # because JSON
-            except OSError:
-                self.logger.error("Could not read file '%s'" % fname)
-
-    def _check_status(self, statuslink):
-        self.logger.info("Checking S3 upload status.")
-        maxtries = 60
-        delay = 5
-        attempt = 0
-        while attempt < maxtries:
-            attempt = attempt + 1
-            resp = self.session.get(statuslink)
-            r_json = resp.json()
-            status = r_json["status"]
-            if status == "SUCCESS":
-                return
-            elif status == "FAILURE":
-                break
-            elif status == "PENDING" or status == "STARTED":
-                self.logger.debug("Upload %s [%d/%d]; waiting %ds" % (status,
-                                                                      attempt,
-                                                                      maxtries,
-                                                                      delay))
+        self._poller.add(jobnum, statuslink)
+
+    def _upload_finished(self, jobnum, success):
+        """Record how an upload ended.  The upload's slot is freed however
+        that goes, so that a failure here cannot stall submit().
+        """
+        try:
+            with self._lock:
+                mapping = self._new_jobnums.pop(jobnum, None)
+                blobids = self._sent_blobids.pop(jobnum, None)
+            error = "upload failed"
+            if success:
+                try:
+                    self._record_loaded(jobnum, mapping, blobids)
+                    return
+                except Exception as exc:
+                    error = "could not record load: %s" % str(exc)
+                    self.logger.error("Job %d: %s" % (jobnum, error))
+            self.manifest.mark_failed(jobnum, LOADED, error)
+            self.count_job("failed")
+        finally:
+            self._outstanding.release()
+
+    def _record_loaded(self, jobnum, mapping, blobids):
+        # Only completed uploads are recorded, so that a restarted load
+        #  retries the rest.
+        new_jobnum = None
+        if mapping:
+            self.jobmap.add(*mapping)
+            new_jobnum = mapping[1]
+        self.manifest.mark(jobnum, LOADED, new_jobnum=new_jobnum)
+        if blobids and self.blob_registry is not None:
+            self.blob_registry.add(blobids)
+        self.count_job("ok")
+        with self._lock:
+            self.so_far = self.so_far + 1
+            location = self.input_store.location(jobnum)
+            if self.numfiles:
+                self.logger.info("%s: %d/%d" % (location, self.so_far,
+                                                self.numfiles))
             else:
-                self.logger.error("Unknown status %s" % status)
-                break
-            time.sleep(delay)
-        raise RuntimeError("Upload to s3 failed")
+                self.logger.info("%s: %d loaded" % (location, self.so_far))
+
+    def _post_job(self, jobnum):
+        """Send a single transformed job to the target database.  Returns
+        the link at which to check upload status, or None if the job was
+        not accepted.
+        """
+        fname = self.input_store.location(jobnum)
+        self.logger.debug("Loading '%s' for transmission" % fname)
+        body = self._encode_job(jobnum, self.accepts_gzip is not False)
+        if body is None:
+            return None
+        url = self.to_url + "/job"
+        self.logger.info(
+            "Sending transformed job %d to %s" % (jobnum, url))
+        try:
+            resp = self._post_body(url, jobnum, body)
+        finally:
+            body.close()
+        if (resp.status_code < 200 or
+                resp.status_code > 299):
+            # Should always be 202 if it worked.
+            self.logger.error("POST error '%s': HTTP %d / '%s'" %
+                              (fname, resp.status_code, resp.text))
+            return None
+        self.metrics.incr("job_bytes_total", body.size, stage=self.stage)
+        try:
+            r_json = resp.json()
+            message = r_json["message"]
+            statuslink = r_json["status"]
+        except (json.decoder.JSONDecodeError, KeyError) as exc:
+            self.logger.error("Malformed response from " +
+                              "%s (%s): %s" % (url, str(exc),
+                                               resp.text))
+            return None
+        # This is cheesy, but we rely on the message format
+        #  to extract the new job ID
+        # To wit, 'Job `XYZ` accepted' or similar, where
+        #  XYZ is within backticks.
+        try:
+            new_jobnum = int(message.split('`')[1])
+        except (ValueError, IndexError):
+            errstr = "Could not get job numbers for '%s'" % fname
+            self.logger.error(errstr)
+        else:
+            with self._lock:
+                self._new_jobnums[jobnum] = (jobnum, new_jobnum)
+        return statuslink
+
+    def _encode_job(self, jobnum, compress):
+        """Encode a transformed job as an upload body, gzipped if compress
+        is set and it is large enough to be worth it.  The body leaves out
+        the job's _job_number and, if skip_known_blobs is set, the blobs
+        the target already holds.  Returns None if the job cannot be read
+        or encoded.
+        """
+        fname = self.input_store.location(jobnum)
+        try:
+            if self.input_store.size(jobnum) > stream.STREAM_THRESHOLD:
+                return self._stream_job(jobnum, compress)
+            with self.metrics.timer("json_decode_seconds", stage=self.stage):
+                job = self.input_store.read(jobnum)
+            # _job_number is used in new jobs for correlation but
+            #   should not be sent
+            self._check_job_number(jobnum, job.pop("_job_number", None))
+            if self.blob_registry is not None and job.get("blobs"):
+                job["blobs"] = list(self._filter_known_blobs(jobnum,
+                                                             job["blobs"]))
+            with self.metrics.timer("json_encode_seconds", stage=self.stage):
+                data = codec.dumps(job, compact=True,
+                                   allow_nan=False).encode("utf-8")
+        except (KeyError, OSError, ValueError) as exc:
+            self.logger.error("Could not encode '%s': %s" % (fname, str(exc)))
+            return None
+        # Only the encoded body is held from here on.
+        del job
+        size = len(data)
+        if compress and size >= MIN_GZIP_SIZE:
+            data = gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+            return _JobBody(data, size, gzipped=True)
+        return _JobBody(data, size)
+
+    def _stream_job(self, jobnum, compress):
+        """Encode a large job from the store a member, or an array element,
+        at a time, through gzip if compress is set, into a temporary file,
+        so that memory use is bounded by its largest element.
+        """
+        tmp = tempfile.TemporaryFile()
+        out = tmp
+        if compress:
+            out = gzip.GzipFile(fileobj=tmp, mode="wb",
+                                compresslevel=GZIP_LEVEL, mtime=0)
+        writer = _EncodingWriter(out)
+        # Decoding and re-encoding are interleaved, so all of it counts as
+        #  decoding.
+        start = time.monotonic()
+        try:
+            with self.input_store.reader(jobnum) as fp, \
+                    stream.ObjectWriter(compact=True,
+                                        allow_nan=False) as job:
+                for key, value in stream.iter_object(fp, stream.JOB_ARRAYS):
+                    if key == "_job_number":
+                        self._check_job_number(jobnum, value)
+                    elif not isinstance(value, Iterator):
+                        job.set(key, value)
+                    else:
+                        if key == "blobs" and self.blob_registry is not None:
+                            value = self._filter_known_blobs(jobnum, value)
+                        array = job.array(key)
+                        for element in value:
+                            array.append(element)
+                job.write(writer)
+            if out is not tmp:
+                out.close()
+            tmp.seek(0)
+        except BaseException:
+            tmp.close()
+            raise
+        self.metrics.observe("json_decode_seconds", time.monotonic() - start,
+                             stage=self.stage)
+        return _JobBody(tmp, writer.size, gzipped=compress)
+
+    def _check_job_number(self, jobnum, save_num):
+        if save_num is not None and save_num != jobnum:
+            errstr = ("_job_number %d != filename %d" %
+                      (save_num, jobnum))
+            self.logger.error(errstr)
+
+    def _post_body(self, url, jobnum, body):
+        """POST a job body.  In "auto" mode, a compressed body the target
+        turns down is encoded again and re-sent uncompressed, and if that
+        is accepted, later bodies are sent uncompressed too.
+        """
+        # Each request carries the token current when it is sent.
+        post = functools.partial(self.context.authorized_request, "POST")
+        headers = {"Content-Type": "application/json"}
+        if not body.gzipped:
+            return post(url, data=body.data, headers=headers)
+        gzheaders = {"Content-Encoding": "gzip"}
+        gzheaders.update(headers)
+        resp = post(url, data=body.data, headers=gzheaders)
+        probing = (self.accepts_gzip is None and
+                   self.context.upload_encoding == "auto")
+        if not probing:
+            return resp
+        if resp.status_code not in GZIP_REJECTED_STATUSES:
+            if 200 <= resp.status_code <= 299:
+                self.accepts_gzip = True
+            return resp
+        self.logger.debug("Compressed upload refused (HTTP %d); " %
+                          resp.status_code + "retrying uncompressed.")
+        plain = self._encode_job(jobnum, False)
+        if plain is None:
+            return resp
+        try:
+            resp = post(url, data=plain.data, headers=headers)
+        finally:
+            plain.close()
+        if 200 <= resp.status_code <= 299 and self.accepts_gzip is None:
+            self.logger.warning("%s does not accept compressed " % url +
+                                "uploads; sending them uncompressed.")
+            self.accepts_gzip = False
+        return resp
+
+    def _filter_known_blobs(self, jobnum, blobs):
+        """Yield those of blobs that the target does not already hold,
+        leaving the measurements' references to them in place, and
+        remember the rest so they can be registered once the upload
+        succeeds.
+        """
+        registry = self.blob_registry
+        unsent = []
+        skipped = 0
+        for blob in blobs:
+            identifier = blob.get("identifier")
+            if identifier in registry:
+                skipped = skipped + 1
+                continue
+            if identifier:
+                unsent.append(identifier)
+            yield blob
+        if skipped:
+            self.logger.debug("Job %d: not re-sending %d known blobs" %
+                              (jobnum, skipped))
+        with self._lock:
+            self._sent_blobids[jobnum] = unsent
+
+
+class _JobBody(object):
+    """An encoded job: data is bytes, or for a large job a temporary file,
+    and size the length of its JSON before any compression.
+    """
+
+    def __init__(self, data, size, gzipped=False):
+        self.data = data
+        self.size = size
+        self.gzipped = gzipped
+
+    def close(self):
+        if not isinstance(self.data, bytes):
+            self.data.close()
+
+
+class _EncodingWriter(object):
+    """Text file that writes UTF-8 to a binary file, counting the bytes.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.size = 0
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self.fp.write(data)
+        self.size = self.size + len(data)
+
+
+class StatusPoller(object):
+    """Single thread that checks the S3 upload status of every outstanding
+    job.  Each upload is polled with its own exponentially growing delay;
+    callback(jobnum, success) is called once per upload when it resolves.
+    Requests are sent with the context's current token.
+    """
+
+    def __init__(self, context, logger, callback, metrics=None):
+        self.context = context
+        self.logger = logger
+        self.callback = callback
+        self.metrics = metrics
+        self.pending = {}
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run,
+                                        name="load-status-poller",
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Wait for all pending uploads to resolve, then stop polling.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join()
+
+    def add(self, jobnum, statuslink):
+        now = time.monotonic()
+        with self._cond:
+            self.pending[statuslink] = {"jobnum": jobnum,
+                                        "started": now,
+                                        "delay": MIN_POLL_DELAY,
+                                        "next": now + MIN_POLL_DELAY}
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self.pending:
+                        if self._stopping:
+                            return
+                        self._cond.wait()
+                        continue
+                    now = time.monotonic()
+                    wake = min(p["next"] for p in self.pending.values())
+                    if wake <= now:
+                        break
+                    self._cond.wait(wake - now)
+                due = [(link, p) for link, p in self.pending.items()
+                       if p["next"] <= now]
+            for statuslink, upload in due:
+                # This thread serves every upload, so no one upload's
+                #  failure may end it.
+                jobnum = upload["jobnum"]
+                try:
+                    result = self._check_status(statuslink, upload)
+                except Exception as exc:
+                    self.logger.error("Status check for job %d failed: %s" %
+                                      (jobnum, str(exc)))
+                    result = False
+                if result is None:
+                    continue
+                with self._cond:
+                    del self.pending[statuslink]
+                if self.metrics:
+                    self.metrics.observe(
+                        "upload_wait_seconds",
+                        time.monotonic() - upload["started"],
+                        outcome="ok" if result else "failed")
+                try:
+                    self.callback(jobnum, result)
+                except Exception as exc:
+                    self.logger.error("Could not finish upload of job " +
+                                      "%d: %s" % (jobnum, str(exc)))
+
+    def _check_status(self, statuslink, upload):
+        """Check one upload.  Returns True or False once it has succeeded
+        or failed, or None if it should be checked again later.
+        """
+        jobnum = upload["jobnum"]
+        try:
+            resp = self.context.authorized_request("GET", statuslink)
+            status = resp.json()["status"]
+        except requests.exceptions.RequestException as exc:
+            self.logger.warning("Status check for job %d failed: %s" %
+                                (jobnum, str(exc)))
+            status = None
+        except (KeyError, TypeError, ValueError) as exc:
+            if self.metrics:
+                self.metrics.incr("status_polls_total", status="invalid")
+            self.logger.error("Data load failed for job %d: %s" %
+                              (jobnum, str(exc)))
+            return False
+        if self.metrics:
+            self.metrics.incr("status_polls_total", status=str(status))
+        if status == "SUCCESS":
+            return True
+        elif status == "FAILURE":
+            self.logger.error("Upload to s3 failed for job %d" % jobnum)
+            return False
+        elif status in ("PENDING", "STARTED", None):
+            now = time.monotonic()
+            if now - upload["started"] > MAX_POLL_TIME:
+                self.logger.error("Upload to s3 timed out for job %d" % jobnum)
+                return False
+            delay = min(upload["delay"] * 2, MAX_POLL_DELAY)
+            self.logger.debug("Upload %s for job %d; waiting %ds" %
+                              (status, jobnum, delay))
+            upload["delay"] = delay
+            upload["next"] = now + delay
+            return None
+        self.logger.error("Unknown status %s for job %d" % (status, jobnum))
+        return False
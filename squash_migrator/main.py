@@ -3,14 +3,37 @@
 """
 
 import argparse
+import collections
+import contextlib
 import logging
+import multiprocessing
 import os
+import queue
+import threading
 from .context import Context
 from .defaults import SQUASH_MIGRATOR_NAMESPACE, SQUASH_API_URL,\
     SQUASH_RESTFUL_API_URL
-from .extractor import Extractor
+from .extractor import Extractor, MIN_PAGE_SIZE, MAX_PAGE_SIZE
 from .transformer import Transformer
 from .loader import Loader
+from .store import STORE_TYPES
+from .loader import UPLOAD_ENCODINGS
+from .manifest import EXTRACTED, TRANSFORMED
+from .metrics import StatsReporter, STATS_INTERVAL
+from .profiling import Profiler, PROFILE_MODES
+from .transformer import FAILED
+from .verifier import Verifier, DIVERGENT, MISSING
+
+# Maximum number of jobs waiting between pipeline stages.
+PIPELINE_QUEUE_SIZE = 64
+# Sentinel marking the end of a pipeline stage's output.
+_DONE = None
+
+
+class PipelineAborted(Exception):
+    """Raised in a pipeline stage when another stage has failed.
+    """
+    pass
 
 
 class Migrator:
@@ -18,22 +41,236 @@ class Migrator:
     """
 
     def __init__(self, context=None, extractor=None, transformer=None,
-                 loader=None):
+                 loader=None, verifier=None):
         self.context = context
         self.extractor = extractor
         self.transformer = transformer
         self.loader = loader
+        self.verifier = verifier
         self.logger = logging.getLogger(__name__)
         self.loglevel = context.loglevel
         self.logger.setLevel(self.loglevel)
+        self._profiler = None
 
-    def etl(self, jobs=None):
+    def etl(self, jobs=None, pipeline=False):
         """Perform the extract/transform/load operation by delegating to
-        actuators.
+        actuators.  If pipeline is set, jobs flow through bounded queues
+        from one actuator to the next, so that early jobs are loaded while
+        later ones are still being extracted.
+
+        Statistics are written to stats.json in the working directory
+        (and to the context's Prometheus textfile, if any) as the run
+        goes, and a per-stage summary is logged at the end.  If the
+        context asks for profiling, each stage is profiled separately.
         """
-        self.extractor.extract()
-        self.transformer.transform()
-        self.loader.load()
+        with self._instrumented():
+            if pipeline:
+                self._pipelined_etl()
+            else:
+                with self._profiling("extract"):
+                    self.extractor.extract()
+                with self._profiling("transform"):
+                    self.transformer.transform()
+                with self._profiling("load"):
+                    self.loader.load()
+
+    def verify(self, requeue=False):
+        """Check the loaded jobs against the new service with the
+        verifier.  If requeue is set, jobs found missing or different are
+        loaded again.  Returns the verifier's results.
+        """
+        with self._instrumented():
+            with self._profiling("verify"):
+                results = self.verifier.verify()
+            bad = sorted(results[MISSING] + results[DIVERGENT])
+            if requeue and bad:
+                self.verifier.requeue(bad)
+                with self._profiling("load"):
+                    self._reload(bad)
+        return results
+
+    def _reload(self, jobnums):
+        loader = self.loader
+        if not loader.start(numfiles=len(jobnums)):
+            return
+        try:
+            for jobnum in jobnums:
+                loader.submit(jobnum)
+        finally:
+            loader.finish()
+
+    @contextlib.contextmanager
+    def _instrumented(self):
+        """Write statistics and, if asked for, profile for the duration of
+        a with statement, logging a per-stage summary at the end.
+        """
+        context = self.context
+        directory = os.path.abspath(context.directory)
+        reporter = StatsReporter(context.metrics, directory,
+                                 prometheus_file=context.prometheus_file,
+                                 interval=context.stats_interval,
+                                 logger=self.logger)
+        self._profiler = None
+        if context.profile:
+            self._profiler = Profiler(context.profile, directory,
+                                      logger=self.logger)
+            self._profiler.start()
+        reporter.start()
+        try:
+            yield
+        finally:
+            reporter.stop()
+            if self._profiler:
+                self._profiler.stop()
+            self._log_stages()
+
+    def _profiling(self, stage):
+        if self._profiler:
+            return self._profiler.stage(stage)
+        return contextlib.nullcontext()
+
+    def _log_stages(self):
+        stages = self.context.metrics.snapshot()["stages"]
+        for stage in ("extract", "transform", "load", "verify"):
+            summary = stages.get(stage)
+            if not summary:
+                continue
+            rate = summary["jobs_per_second"] or 0
+            self.logger.info("%s: %d jobs, %.1f MB in %.1f s " %
+                             (stage, summary["jobs"], summary["bytes"] / 1e6,
+                              summary["seconds"]) +
+                             "(%.2f jobs/s)" % rate)
+
+    def _pipelined_etl(self):
+        """Run each actuator in its own thread.  The jobs and transformed
+        job stores remain the hand-off points, so only job numbers travel
+        through the queues; a full queue blocks the stage feeding it.
+        """
+        self._abort = threading.Event()
+        self._errors = []
+        to_transform = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        to_load = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        stages = [
+            threading.Thread(target=self._run_stage, name="extract",
+                             args=(self._extract_stage, None, to_transform)),
+            threading.Thread(target=self._run_stage, name="transform",
+                             args=(self._transform_stage, to_transform,
+                                   to_load)),
+            threading.Thread(target=self._run_stage, name="load",
+                             args=(self._load_stage, to_load, None))
+        ]
+        for stage in stages:
+            stage.start()
+        for stage in stages:
+            stage.join()
+        if self._errors:
+            raise self._errors[0]
+
+    def _run_stage(self, stage, inq, outq):
+        try:
+            with self._profiling(threading.current_thread().name):
+                stage(inq, outq)
+        except PipelineAborted:
+            pass
+        except Exception as exc:
+            self.logger.error("Pipeline stage '%s' failed: %s" %
+                              (threading.current_thread().name, str(exc)))
+            self._errors.append(exc)
+            self._abort.set()
+        finally:
+            if outq is not None:
+                try:
+                    self._put(outq, _DONE)
+                except PipelineAborted:
+                    pass
+
+    def _put(self, outq, item):
+        while True:
+            if self._abort.is_set():
+                raise PipelineAborted()
+            try:
+                outq.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, inq):
+        while True:
+            if self._abort.is_set():
+                raise PipelineAborted()
+            try:
+                return inq.get(timeout=1)
+            except queue.Empty:
+                continue
+
+    def _extract_stage(self, inq, outq):
+        self.extractor.extract(on_job=lambda jobnum: self._put(outq, jobnum))
+
+    def _transform_stage(self, inq, outq):
+        transformer = self.transformer
+        transformer.start()
+        manifest = transformer.manifest
+        todo = transformer.plan(manifest.jobnums(EXTRACTED))
+        done = manifest.has(TRANSFORMED)
+        workers = self.context.workers
+        executor = None
+        if workers > 1:
+            # The other stages' threads are running, so worker processes
+            #  are spawned rather than forked from this one.
+            executor = transformer.executor(
+                mp_context=multiprocessing.get_context("spawn"))
+        # Jobs handed to the workers, oldest first; their results are
+        #  passed on in order, with a few per worker kept in hand.
+        pending = collections.deque()
+        try:
+            while True:
+                jobnum = self._get(inq)
+                if jobnum is _DONE:
+                    break
+                if jobnum in done and jobnum not in todo:
+                    self._put(outq, jobnum)
+                    continue
+                recorded = todo.get(jobnum, (None, None))
+                if executor is None:
+                    self._pass_on(outq, transformer.transform_jobnum(
+                        jobnum, *recorded))
+                    continue
+                pending.append(transformer.submit(executor, jobnum,
+                                                  *recorded))
+                while len(pending) >= 2 * workers:
+                    self._pass_on(outq,
+                                  transformer.worker_result(pending.popleft()))
+            while pending:
+                self._pass_on(outq,
+                              transformer.worker_result(pending.popleft()))
+        finally:
+            if executor is not None:
+                for future in pending:
+                    future.cancel()
+                executor.shutdown()
+        transformer.finish()
+
+    def _pass_on(self, outq, result):
+        self.transformer.record_result(result)
+        if result[1] == FAILED:
+            return
+        # Already-transformed jobs are passed on too; the loader
+        #  decides whether they still need sending.
+        self._put(outq, result[0])
+
+    def _load_stage(self, inq, outq):
+        loader = self.loader
+        loading = loader.start()
+        try:
+            while True:
+                jobnum = self._get(inq)
+                if jobnum is _DONE:
+                    return
+                if loading:
+                    loader.submit(jobnum)
+        finally:
+            if loading:
+                loader.finish()
 
 
 def _empty(obj, param):
@@ -42,6 +279,14 @@ def _empty(obj, param):
     return False
 
 
+def _env_flag(name):
+    """Return whether the option name is turned on in the environment,
+    by a value of 1, true, or yes (in any case).
+    """
+    value = os.environ.get(SQUASH_MIGRATOR_NAMESPACE + name) or ""
+    return value.strip().lower() in ("1", "true", "yes")
+
+
 def get_options():
     params = {}
     descstr = ("Command-line tool for SQuaSH ETL from old to new format. " +
@@ -49,7 +294,8 @@ def get_options():
                SQUASH_MIGRATOR_NAMESPACE + " prepended to the parameter " +
                "name (e.g. " + SQUASH_MIGRATOR_NAMESPACE + "USER). " +
                "The directory is used as a persistent cache, which must " +
-               "be cleared if re-extraction/re-transformation is desired.")
+               "be cleared if re-extraction/re-transformation is desired " +
+               "(or use --rebuild-manifest after removing single jobs).")
     parser = argparse.ArgumentParser(description=descstr)
     parser.add_argument("-u", "--user", "--username",
                         help="username for (write) SQuaSH API communication",
@@ -89,6 +335,132 @@ def get_options():
                         help="Job numbers to fetch [default: all]",
                         default=os.environ.get(SQUASH_MIGRATOR_NAMESPACE +
                                                "JOBS"))
+    parser.add_argument("-w", "--workers",
+                        help=("Number of concurrent workers per stage " +
+                              "[default: 1]"),
+                        type=int,
+                        default=int(os.environ.get(SQUASH_MIGRATOR_NAMESPACE +
+                                                   "WORKERS") or 1))
+    parser.add_argument("-m", "--max-uploads",
+                        help=("Maximum number of uploads to the new " +
+                              "service outstanding at once [default: 32]"),
+                        type=int,
+                        default=int(os.environ.get(SQUASH_MIGRATOR_NAMESPACE +
+                                                   "MAX_UPLOADS") or 32))
+    parser.add_argument("-r", "--refresh-metrics",
+                        help=("Refetch the metric unit map from the old " +
+                              "service even if the cached copy is fresh"),
+                        action="store_true",
+                        default=_env_flag("REFRESH_METRICS"))
+    parser.add_argument("-s", "--store",
+                        help=("Job cache format: one JSON file per job " +
+                              "('directory') or a single compressed, " +
+                              "indexed file ('sqlite') [default: directory]"),
+                        choices=STORE_TYPES,
+                        default=(os.environ.get(SQUASH_MIGRATOR_NAMESPACE +
+                                                "STORE") or "directory"))
+    parser.add_argument("-c", "--compact",
+                        help=("Write job files without indentation " +
+                              "(directory store only)"),
+                        action="store_true",
+                        default=_env_flag("COMPACT"))
+    parser.add_argument("-b", "--skip-known-blobs",
+                        help=("Do not re-send blobs that an earlier load " +
+                              "already sent to the new service; requires " +
+                              "a service that resolves references to " +
+                              "existing blobs"),
+                        action="store_true",
+                        default=_env_flag("SKIP_KNOWN_BLOBS"))
+    parser.add_argument("-R", "--rebuild-manifest",
+                        help=("Rebuild the job manifest from the job " +
+                              "caches and job map, e.g. after removing " +
+                              "cached jobs by hand"),
+                        action="store_true",
+                        default=_env_flag("REBUILD_MANIFEST"))
+    parser.add_argument("-i", "--incremental",
+                        help=("Only extract jobs newer than the newest " +
+                              "job extracted by an earlier run"),
+                        action="store_true",
+                        default=_env_flag("INCREMENTAL"))
+    parser.add_argument("-P", "--pipeline",
+                        help=("Stream jobs through extract, transform, and " +
+                              "load concurrently instead of running each " +
+                              "phase to completion"),
+                        action="store_true",
+                        default=_env_flag("PIPELINE"))
+    parser.add_argument("-n", "--min-page-size",
+                        help=("Fewest jobs to ask for in each page of " +
+                              "the old service's job listing; page sizes " +
+                              "are adjusted between this and the maximum " +
+                              "to keep pages quick [default: %d]" %
+                              MIN_PAGE_SIZE),
+                        type=int,
+                        default=int(os.environ.get(
+                            SQUASH_MIGRATOR_NAMESPACE + "MIN_PAGE_SIZE") or
+                            MIN_PAGE_SIZE))
+    parser.add_argument("-N", "--max-page-size",
+                        help=("Most jobs to ask for in each page of the " +
+                              "old service's job listing [default: %d]" %
+                              MAX_PAGE_SIZE),
+                        type=int,
+                        default=int(os.environ.get(
+                            SQUASH_MIGRATOR_NAMESPACE + "MAX_PAGE_SIZE") or
+                            MAX_PAGE_SIZE))
+
+    parser.add_argument("-e", "--upload-encoding",
+                        help=("Compression of job uploads: 'gzip', " +
+                              "'identity' (none), or 'auto' (gzip unless " +
+                              "the new service turns it down) " +
+                              "[default: auto]"),
+                        choices=UPLOAD_ENCODINGS,
+                        default=(os.environ.get(SQUASH_MIGRATOR_NAMESPACE +
+                                                "UPLOAD_ENCODING") or "auto"))
+
+    parser.add_argument("-S", "--stats-interval",
+                        help=("Seconds between writes of run statistics " +
+                              "to stats.json in the working directory " +
+                              "[default: %d]" % STATS_INTERVAL),
+                        type=int,
+                        default=int(os.environ.get(
+                            SQUASH_MIGRATOR_NAMESPACE + "STATS_INTERVAL") or
+                            STATS_INTERVAL))
+    parser.add_argument("-x", "--prometheus-file",
+                        help=("Also write run statistics to this file in " +
+                              "Prometheus text format, e.g. for the " +
+                              "node_exporter textfile collector"),
+                        default=os.environ.get(SQUASH_MIGRATOR_NAMESPACE +
+                                               "PROMETHEUS_FILE"))
+
+    parser.add_argument("--verify",
+                        help=("Instead of migrating, fetch the jobs in the " +
+                              "job map back from the new service and " +
+                              "compare them with the transformed jobs, " +
+                              "writing verify.json in the working directory"),
+                        action="store_true",
+                        default=_env_flag("VERIFY"))
+    parser.add_argument("-Q", "--requeue",
+                        help=("With --verify, load jobs that are missing " +
+                              "from or differ in the new service again"),
+                        action="store_true",
+                        default=_env_flag("REQUEUE"))
+
+    parser.add_argument("-M", "--metric-names",
+                        help=("JSON file of extra (metric, spec, filter) " +
+                              "to new metric name mappings, which take " +
+                              "precedence over the built-in ones (a '*' " +
+                              "spec or filter replaces every built-in " +
+                              "mapping it matches); see " +
+                              "metricnames.MetricNameIndex.from_file"),
+                        default=os.environ.get(SQUASH_MIGRATOR_NAMESPACE +
+                                               "METRIC_NAMES"))
+    parser.add_argument("-F", "--profile",
+                        help=("Profile each stage, writing results to the " +
+                              "working directory: trace every call " +
+                              "('cprofile', the default) or sample stacks " +
+                              "('sampling', cheap enough for long runs)"),
+                        nargs="?", const="cprofile",
+                        default=os.environ.get(SQUASH_MIGRATOR_NAMESPACE +
+                                               "PROFILE"))
 
     params = parser.parse_args()
     loglevel = params.loglevel
@@ -101,6 +473,14 @@ def get_options():
               'i': logging.INFO,
               'd': logging.DEBUG}
     params.loglevel = logmap.get(loglevel)
+    if params.profile and params.profile.lower() not in PROFILE_MODES:
+        # E.g. SQUASH_MIGRATOR_PROFILE=1
+        if params.profile.lower() in ("0", "false", "no", "off"):
+            params.profile = None
+        else:
+            params.profile = "cprofile"
+    elif params.profile:
+        params.profile = params.profile.lower()
     logging.basicConfig(level=params.loglevel)
     logger = logging.getLogger(__name__)
     logger.setLevel(params.loglevel)
@@ -128,12 +508,31 @@ def standalone():
                       directory=params.directory,
                       from_url=params.from_url,
                       to_url=params.to_url,
-                      job_numbers=params.jobs)
+                      job_numbers=params.jobs,
+                      workers=params.workers,
+                      max_uploads=params.max_uploads,
+                      refresh_metrics=params.refresh_metrics,
+                      store=params.store,
+                      compact=params.compact,
+                      skip_known_blobs=params.skip_known_blobs,
+                      rebuild_manifest=params.rebuild_manifest,
+                      incremental=params.incremental,
+                      upload_encoding=params.upload_encoding,
+                      stats_interval=params.stats_interval,
+                      prometheus_file=params.prometheus_file,
+                      profile=params.profile,
+                      metric_names=params.metric_names,
+                      min_page_size=params.min_page_size,
+                      max_page_size=params.max_page_size)
     extractor = Extractor(context=context)
     transformer = Transformer(context=context)
     loader = Loader(context=context)
-    migrator = Migrator(context, extractor, transformer, loader)
-    migrator.etl()
+    verifier = Verifier(context=context)
+    migrator = Migrator(context, extractor, transformer, loader, verifier)
+    if params.verify:
+        migrator.verify(requeue=params.requeue)
+    else:
+        migrator.etl(pipeline=params.pipeline)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,309 @@
+"""Index of per-job migration state for a working directory.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from .store import open_store
+
+EXTRACTED = "extracted"
+TRANSFORMED = "transformed"
+LOADED = "loaded"
+# Buffered updates are written after this many marks or this many seconds.
+FLUSH_COUNT = 500
+FLUSH_INTERVAL = 5
+
+
+def open_manifest(context, logger=None):
+    """Open the manifest in the context's working directory, building it
+    from the job stores and job map if it is new or a rebuild was asked
+    for.
+    """
+    directory = os.path.abspath(context.directory)
+    manifest = Manifest(directory, logger=logger)
+    if not manifest.built or context.rebuild_manifest:
+        manifest.rebuild(open_store(context, "jobs"),
+                         open_store(context, "transformed"),
+                         context.jobmap)
+    return manifest
+
+
+class Manifest(object):
+    """Per-job record of when (and at what size) each job was extracted,
+    transformed, and loaded, and of the last failure, held in
+    manifest.sqlite.  Planning a run is then a few indexed queries rather
+    than a directory scan plus a stat per job.  Updates are buffered and
+    written in batches; call flush() at the end of a stage.
+    """
+
+    def __init__(self, directory, logger=None):
+        self.path = os.path.join(directory, "manifest.sqlite")
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_flush = time.monotonic()
+        os.makedirs(directory, mode=0o755, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=60,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS jobs (" +
+                     "jobnum INTEGER PRIMARY KEY, " +
+                     "extracted REAL, extracted_size INTEGER, " +
+                     "transformed REAL, transformed_size INTEGER, " +
+                     "loaded REAL, new_jobnum INTEGER, " +
+                     "failed TEXT, error TEXT, updated REAL, " +
+                     "input_digest TEXT, fingerprint TEXT, " +
+                     "metric_keys TEXT)")
+        columns = [row[1] for row in
+                   conn.execute("PRAGMA table_info(jobs)").fetchall()]
+        # Manifests written before jobs were fingerprinted.
+        for column in ("input_digest", "fingerprint", "metric_keys"):
+            if column not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN %s TEXT" % column)
+        conn.execute("CREATE TABLE IF NOT EXISTS meta " +
+                     "(key TEXT PRIMARY KEY, value TEXT)")
+        conn.commit()
+        self._conn = conn
+        row = conn.execute(
+            "SELECT value FROM meta WHERE key = 'built'").fetchone()
+        self.built = row is not None
+
+    def jobnums(self, state):
+        """Return the sorted numbers of the jobs that have reached state.
+        """
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT jobnum FROM jobs WHERE %s IS NOT NULL " % state +
+                "ORDER BY jobnum").fetchall()
+        return [row[0] for row in rows]
+
+    def has(self, state):
+        """Return the set of job numbers that have reached state.
+        """
+        return set(self.jobnums(state))
+
+    def failures(self):
+        """Return a dict of job number to (stage, error) for failed jobs.
+        """
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT jobnum, failed, error FROM jobs " +
+                "WHERE failed IS NOT NULL ORDER BY jobnum").fetchall()
+        return dict((row[0], (row[1], row[2])) for row in rows)
+
+    def mark(self, jobnum, state, size=None, new_jobnum=None):
+        """Record that a job reached state, clearing any failure.  A size
+        of None means the job was already present, so an earlier time and
+        size are kept.  A newly extracted job's input digest is cleared.
+        """
+        now = time.time()
+        if state == LOADED:
+            sql = ("INSERT INTO jobs (jobnum, loaded, new_jobnum, updated) " +
+                   "VALUES (?, ?, ?, ?) ON CONFLICT(jobnum) DO UPDATE SET " +
+                   "loaded = excluded.loaded, " +
+                   "new_jobnum = excluded.new_jobnum, " +
+                   "failed = NULL, error = NULL, updated = excluded.updated")
+            params = (jobnum, now, new_jobnum, now)
+        elif size is None:
+            # The job was found already present: keep what we knew.
+            sql = (("INSERT INTO jobs (jobnum, {0}, updated) " +
+                    "VALUES (?, ?, ?) ON CONFLICT(jobnum) DO UPDATE SET " +
+                    "{0} = COALESCE({0}, excluded.{0}), " +
+                    "failed = NULL, error = NULL, " +
+                    "updated = excluded.updated").format(state))
+            params = (jobnum, now, now)
+        else:
+            sql = (("INSERT INTO jobs (jobnum, {0}, {0}_size, updated) " +
+                    "VALUES (?, ?, ?, ?) ON CONFLICT(jobnum) DO UPDATE SET " +
+                    "{0} = excluded.{0}, {0}_size = excluded.{0}_size, " +
+                    "failed = NULL, error = NULL, " +
+                    "updated = excluded.updated").format(state))
+            if state == EXTRACTED:
+                sql = sql + ", input_digest = NULL"
+            params = (jobnum, now, size, now)
+        self._add(sql, params)
+
+    def forget(self, jobnum, state):
+        """Record that a job has not reached state after all.
+        """
+        if state == LOADED:
+            sql = ("UPDATE jobs SET loaded = NULL, new_jobnum = NULL, " +
+                   "updated = ? WHERE jobnum = ?")
+        else:
+            sql = ("UPDATE jobs SET {0} = NULL, {0}_size = NULL, " +
+                   "updated = ? WHERE jobnum = ?").format(state)
+        self._add(sql, (time.time(), jobnum))
+
+    def mark_failed(self, jobnum, stage, error):
+        """Record that a job failed in the given stage.
+        """
+        now = time.time()
+        sql = ("INSERT INTO jobs (jobnum, failed, error, updated) " +
+               "VALUES (?, ?, ?, ?) ON CONFLICT(jobnum) DO UPDATE SET " +
+               "failed = excluded.failed, error = excluded.error, " +
+               "updated = excluded.updated")
+        self._add(sql, (jobnum, stage, error, now))
+
+    def set_fingerprint(self, jobnum, input_digest, fingerprint,
+                        metric_keys):
+        """Record the digest of a job's extracted input, the fingerprint
+        of the transformed job made from it, and the metric keys that
+        fingerprint covers.
+        """
+        if metric_keys is not None:
+            metric_keys = json.dumps(metric_keys)
+        self._add("UPDATE jobs SET input_digest = ?, fingerprint = ?, " +
+                  "metric_keys = ? WHERE jobnum = ?",
+                  (input_digest, fingerprint, metric_keys, jobnum))
+
+    def fingerprints(self):
+        """Return a dict of job number to (input digest, fingerprint,
+        metric keys) for transformed jobs; any may be None if not yet
+        recorded.
+        """
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT jobnum, input_digest, fingerprint, metric_keys " +
+                "FROM jobs WHERE transformed IS NOT NULL").fetchall()
+        return dict((row[0], (row[1], row[2],
+                              json.loads(row[3]) if row[3] else None))
+                    for row in rows)
+
+    def count_extracted(self, upto):
+        """Return how many jobs numbered at most upto have been extracted.
+        """
+        self.flush()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE extracted IS NOT NULL " +
+                "AND jobnum <= ?", (upto,)).fetchone()
+        return row[0]
+
+    def get_high_water_mark(self):
+        """Return the high-water mark set by set_high_water_mark(), or
+        None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM meta WHERE key = 'high_water_mark'"
+            ).fetchone()
+        if row is None:
+            return None
+        return int(row[0])
+
+    def set_high_water_mark(self, jobnum):
+        """Raise the high-water mark to jobnum, the highest job number in
+        a listing that was extracted to the end, so that every job below
+        it is known to have been extracted.  The mark never goes down.
+        """
+        self.flush()
+        with self._lock:
+            conn = self._conn
+            conn.execute(
+                "INSERT INTO meta (key, value) " +
+                "VALUES ('high_water_mark', ?) ON CONFLICT(key) DO UPDATE " +
+                "SET value = MAX(CAST(value AS INTEGER), " +
+                "CAST(excluded.value AS INTEGER))", (str(jobnum),))
+            conn.commit()
+
+    def get_checkpoint(self, name):
+        """Return the progress saved under name by save_checkpoint(), or
+        None.
+        """
+        self.flush()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM meta WHERE key = ?",
+                ("checkpoint:" + name,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save_checkpoint(self, name, value):
+        """Save a JSON-serializable record of progress under name.  It is
+        buffered along with marks, so it is never written ahead of the
+        marks made before it.
+        """
+        self._add("INSERT INTO meta (key, value) VALUES (?, ?) " +
+                  "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                  ("checkpoint:" + name, json.dumps(value)))
+
+    def clear_checkpoint(self, name):
+        self._add("DELETE FROM meta WHERE key = ?", ("checkpoint:" + name,))
+
+    def flush(self):
+        """Write buffered updates.
+        """
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._conn.close()
+
+    def rebuild(self, jobs_store, transformed_store, jobmap):
+        """Replace the manifest's contents with what the job stores and
+        job map hold.
+        """
+        if self.logger:
+            self.logger.info("Building manifest '%s'." % self.path)
+        now = time.time()
+        with self._lock:
+            self._flush()
+            conn = self._conn
+            # Extracted jobs do not change, so their digests are kept
+            #  rather than recomputed from every job; re-extracting a job
+            #  clears its digest.
+            digests = conn.execute(
+                "SELECT input_digest, fingerprint, metric_keys, jobnum " +
+                "FROM jobs WHERE input_digest IS NOT NULL " +
+                "OR fingerprint IS NOT NULL"
+            ).fetchall()
+            conn.execute("DELETE FROM jobs")
+            conn.executemany(
+                "INSERT INTO jobs (jobnum, extracted, updated) " +
+                "VALUES (?, ?, ?)",
+                [(j, now, now) for j in jobs_store.jobnums()])
+            conn.executemany(
+                "INSERT INTO jobs (jobnum, transformed, updated) " +
+                "VALUES (?, ?, ?) ON CONFLICT(jobnum) DO UPDATE SET " +
+                "transformed = excluded.transformed",
+                [(j, now, now) for j in transformed_store.jobnums()])
+            conn.executemany(
+                "INSERT INTO jobs (jobnum, loaded, new_jobnum, updated) " +
+                "VALUES (?, ?, ?, ?) ON CONFLICT(jobnum) DO UPDATE SET " +
+                "loaded = excluded.loaded, new_jobnum = excluded.new_jobnum",
+                [(j, now, n, now) for j, n in jobmap.items()])
+            conn.executemany("UPDATE jobs SET input_digest = ?, " +
+                             "fingerprint = ?, metric_keys = ? " +
+                             "WHERE jobnum = ?", digests)
+            # Checkpoints may describe jobs the stores no longer hold.
+            conn.execute("DELETE FROM meta WHERE key LIKE 'checkpoint:%'")
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) " +
+                         "VALUES ('built', ?)", (str(now),))
+            conn.commit()
+        self.built = True
+
+    def _add(self, sql, params):
+        with self._lock:
+            self._pending.append((sql, params))
+            if (len(self._pending) >= FLUSH_COUNT or
+                    time.monotonic() - self._last_flush > FLUSH_INTERVAL):
+                self._flush()
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = []
+        conn = self._conn
+        for sql, params in pending:
+            conn.execute(sql, params)
+        conn.commit()
@@ -0,0 +1,115 @@
+"""Resolution of old (metric, spec, filter) triples to new metric names.
+"""
+import json
+
+# In a metric names file, matches any spec or filter.
+WILDCARD = "*"
+
+
+class MetricNameIndex(object):
+    """Maps an old metric, specification, and filter to a new metric
+    name, falling back from the exact triple to the metric and spec with
+    any filter, then to the metric with any spec and filter, and finally
+    to the old metric name itself, so no combination is ever unmapped.
+
+    Fallback entries are given explicitly with WILDCARD, or derived: if
+    every known filter of a metric and spec maps to the same name, so do
+    unknown filters, and likewise for specs of a metric.  Resolutions are
+    memoized, so each lookup after the first is a single dict access.
+    """
+
+    def __init__(self, names, logger=None):
+        self.logger = logger
+        self._exact = {}
+        self._by_spec = {}
+        self._by_metric = {}
+        self._resolved = {}
+        self._build(names)
+
+    def _build(self, names):
+        explicit_spec = {}
+        explicit_metric = {}
+        spec_names = {}
+        metric_names = {}
+        for (metric, spec, flt), name in names.items():
+            if spec == WILDCARD:
+                explicit_metric[metric] = name
+            elif flt == WILDCARD:
+                explicit_spec[(metric, spec)] = name
+            else:
+                self._exact[(metric, spec, flt)] = name
+                spec_names.setdefault((metric, spec), set()).add(name)
+                metric_names.setdefault(metric, set()).add(name)
+        for key, found in spec_names.items():
+            if len(found) == 1:
+                self._by_spec[key] = found.pop()
+        for key, found in metric_names.items():
+            if len(found) == 1:
+                self._by_metric[key] = found.pop()
+        self._by_spec.update(explicit_spec)
+        self._by_metric.update(explicit_metric)
+
+    def __len__(self):
+        return len(self._exact)
+
+    def resolve(self, metric, spec=None, flt=None):
+        """Return the new name for an old metric, spec, and filter.
+        """
+        key = (metric, spec, flt)
+        name = self._resolved.get(key)
+        if name is None:
+            name = self._lookup(metric, spec, flt)
+            self._resolved[key] = name
+        return name
+
+    def _lookup(self, metric, spec, flt):
+        name = self._exact.get((metric, spec, flt))
+        if name:
+            return name
+        name = self._by_spec.get((metric, spec))
+        if name is None:
+            name = self._by_metric.get(metric)
+        if name is None:
+            name = metric
+        if self.logger:
+            self.logger.warning("No metric name for (%s, %s, %s); using %s" %
+                                (metric, spec, flt, name))
+        return name
+
+    @classmethod
+    def from_file(cls, fname, names=None, logger=None):
+        """Build an index from a JSON file, on top of names if given.  The
+        file holds a list of objects with "metric", "spec", "filter", and
+        "name" members; a missing or null spec or filter means none, and
+        "*" means any.  Raises OSError or ValueError if the file cannot be
+        read.
+
+        Entries in the file take precedence over names: a "*" entry
+        replaces every one of names that it matches, so that, say, a
+        metric can be renamed for all specs and filters at once.  Within
+        the file, an exact entry still wins over a "*" one.
+        """
+        given = {}
+        with open(fname, "r") as f:
+            entries = json.load(f)
+        if not isinstance(entries, list):
+            raise ValueError("'%s' does not hold a list of metric names" %
+                             fname)
+        for entry in entries:
+            try:
+                key = (entry["metric"], entry.get("spec"), entry.get("filter"))
+                given[key] = entry["name"]
+            except (KeyError, TypeError, AttributeError):
+                raise ValueError("Bad metric name entry in '%s': %r" %
+                                 (fname, entry))
+        any_spec = set(metric for metric, spec, flt in given
+                       if spec == WILDCARD)
+        any_filter = set((metric, spec) for metric, spec, flt in given
+                         if spec != WILDCARD and flt == WILDCARD)
+        merged = {}
+        for (metric, spec, flt), name in (names or {}).items():
+            if metric in any_spec or (metric, spec) in any_filter:
+                continue
+            merged[(metric, spec, flt)] = name
+        merged.update(given)
+        return cls(merged, logger=logger)
@@ -0,0 +1,290 @@
+"""Counters and latency histograms for a migration run.
+
+Every actuator records into the context's Metrics, and StatsReporter
+writes them out periodically and at the end of a run: as JSON in
+stats.json in the working directory, and optionally as a Prometheus
+textfile for node_exporter's textfile collector.  The JSON form also
+summarizes each stage's throughput, to show which stage is holding a
+long migration back.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+PROMETHEUS_PREFIX = "squash_migrator_"
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120, 300, float("inf"))
+# Seconds between periodic writes of the statistics.
+STATS_INTERVAL = 30
+
+# Descriptions of the metrics recorded, for the Prometheus textfile.
+DESCRIPTIONS = {
+    "http_requests_total": "HTTP requests sent, by response status.",
+    "http_request_seconds": "Time taken by each HTTP request.",
+    "http_retries_total": "HTTP requests retried, by reason.",
+    "http_circuit_opens_total": "Times a host's circuit breaker opened.",
+    "http_bytes_sent_total": "Request body bytes sent.",
+    "http_bytes_received_total": "Response body bytes received, as sent.",
+    "jobs_total": "Jobs handled by each stage, by outcome.",
+    "job_bytes_total": "Bytes of job data written by each stage.",
+    "json_decode_seconds": "Time taken to read and decode one job.",
+    "json_encode_seconds": "Time taken to encode and store one job.",
+    "transform_seconds": "Time taken to transform one decoded job.",
+    "upload_wait_seconds": "Time from upload to completion of one job.",
+    "status_polls_total": "Upload status checks, by status.",
+    "stage_seconds": "Time each stage has been running.",
+}
+
+
+class Metrics(object):
+    """Thread-safe registry of counters and histograms, each identified by
+    a name and a set of labels.  A pickled copy (as handed to a worker
+    process) starts out empty; the worker's figures are returned to the
+    parent with drain() and merge().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._stages = {}
+        self.started = time.time()
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._observe(key, seconds)
+
+    def _observe(self, key, seconds):
+        hist = self._histograms.get(key)
+        if hist is None:
+            hist = {"counts": [0] * len(BUCKETS), "sum": 0.0}
+            self._histograms[key] = hist
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist["counts"][index] = hist["counts"][index] + 1
+                break
+        hist["sum"] = hist["sum"] + seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the time taken by the body of a with statement.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def stage_started(self, stage):
+        with self._lock:
+            self._stages[stage] = [time.monotonic(), None]
+
+    def stage_finished(self, stage):
+        with self._lock:
+            if stage in self._stages:
+                self._stages[stage][1] = time.monotonic()
+
+    def drain(self):
+        """Return the counters and histograms in a picklable form, and
+        reset them.
+        """
+        with self._lock:
+            data = {"counters": list(self._counters.items()),
+                    "histograms": list(self._histograms.items())}
+            self._counters = {}
+            self._histograms = {}
+        return data
+
+    def merge(self, data):
+        """Add in figures returned by another registry's drain().
+        """
+        with self._lock:
+            for key, value in data["counters"]:
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, other in data["histograms"]:
+                hist = self._histograms.get(key)
+                if hist is None:
+                    hist = {"counts": [0] * len(BUCKETS), "sum": 0.0}
+                    self._histograms[key] = hist
+                hist["counts"] = [a + b for a, b in zip(hist["counts"],
+                                                        other["counts"])]
+                hist["sum"] = hist["sum"] + other["sum"]
+
+    def snapshot(self):
+        """Return the current figures as a JSON-serializable dict.
+        """
+        now = time.monotonic()
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict((k, {"counts": list(v["counts"]),
+                                   "sum": v["sum"]})
+                              for k, v in self._histograms.items())
+            stages = dict((k, list(v)) for k, v in self._stages.items())
+        result = {"started": self.started,
+                  "updated": time.time(),
+                  "stages": {},
+                  "counters": [],
+                  "histograms": []}
+        for (name, labels), value in sorted(counters.items()):
+            result["counters"].append({"name": name, "labels": dict(labels),
+                                       "value": value})
+        for (name, labels), hist in sorted(histograms.items()):
+            count = sum(hist["counts"])
+            result["histograms"].append({
+                "name": name, "labels": dict(labels), "count": count,
+                "sum": hist["sum"],
+                "mean": hist["sum"] / count if count else None,
+                "buckets": dict((_format_bound(b), c) for b, c in
+                                zip(BUCKETS, hist["counts"]) if c)})
+        for stage, (start, end) in stages.items():
+            seconds = (end or now) - start
+            jobs = 0
+            nbytes = 0
+            for (name, labels), value in counters.items():
+                labels = dict(labels)
+                if labels.get("stage") != stage:
+                    continue
+                if name == "jobs_total" and labels.get("outcome") == "ok":
+                    jobs = jobs + value
+                elif name == "job_bytes_total":
+                    nbytes = nbytes + value
+            result["stages"][stage] = {
+                "running": end is None,
+                "seconds": seconds,
+                "jobs": jobs,
+                "bytes": nbytes,
+                "jobs_per_second": jobs / seconds if seconds else None,
+                "bytes_per_second": nbytes / seconds if seconds else None}
+        return result
+
+    def write_json(self, path):
+        _write_atomically(path, json.dumps(self.snapshot(), indent=4,
+                                           sort_keys=True))
+
+    def write_prometheus(self, path):
+        """Write the figures in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name in described:
+                return
+            described.add(name)
+            if name in DESCRIPTIONS:
+                lines.append("# HELP %s%s %s" % (PROMETHEUS_PREFIX, name,
+                                                 DESCRIPTIONS[name]))
+            lines.append("# TYPE %s%s %s" % (PROMETHEUS_PREFIX, name, kind))
+
+        for counter in snapshot["counters"]:
+            describe(counter["name"], "counter")
+            lines.append("%s%s%s %s" % (PROMETHEUS_PREFIX, counter["name"],
+                                        _format_labels(counter["labels"]),
+                                        counter["value"]))
+        with self._lock:
+            histograms = sorted((k, list(v["counts"]), v["sum"])
+                                for k, v in self._histograms.items())
+        for (name, labels), counts, total in histograms:
+            describe(name, "histogram")
+            labels = dict(labels)
+            cumulative = 0
+            for bound, count in zip(BUCKETS, counts):
+                cumulative = cumulative + count
+                bucket = dict(labels, le=_format_bound(bound))
+                lines.append("%s%s_bucket%s %d" %
+                             (PROMETHEUS_PREFIX, name,
+                              _format_labels(bucket), cumulative))
+            lines.append("%s%s_sum%s %s" % (PROMETHEUS_PREFIX, name,
+                                            _format_labels(labels),
+                                            repr(total)))
+            lines.append("%s%s_count%s %d" % (PROMETHEUS_PREFIX, name,
+                                              _format_labels(labels),
+                                              cumulative))
+        for stage, summary in sorted(snapshot["stages"].items()):
+            describe("stage_seconds", "gauge")
+            lines.append("%sstage_seconds%s %s" %
+                         (PROMETHEUS_PREFIX, _format_labels({"stage": stage}),
+                          repr(summary["seconds"])))
+        _write_atomically(path, "\n".join(lines) + "\n")
+
+
+class StatsReporter(object):
+    """Thread that writes a Metrics registry to stats.json in a directory
+    (and to a Prometheus textfile, if one is given) every interval
+    seconds, and once more when stopped.
+    """
+
+    def __init__(self, metrics, directory, prometheus_file=None,
+                 interval=None, logger=None):
+        self.metrics = metrics
+        self.json_file = os.path.join(directory, "stats.json")
+        self.prometheus_file = prometheus_file
+        self.interval = interval or STATS_INTERVAL
+        self.logger = logger
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stats",
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+        self.write()
+
+    def write(self):
+        try:
+            os.makedirs(os.path.dirname(self.json_file), mode=0o755,
+                        exist_ok=True)
+            self.metrics.write_json(self.json_file)
+            if self.prometheus_file:
+                self.metrics.write_prometheus(self.prometheus_file)
+        except OSError as exc:
+            if self.logger:
+                self.logger.warning("Could not write statistics: %s" %
+                                    str(exc))
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self.write()
+
+
+def _format_bound(bound):
+    if bound == float("inf"):
+        return "+Inf"
+    return repr(float(bound))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for name, value in sorted(labels.items()):
+        value = (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+                 .replace('"', '\\"'))
+        parts.append('%s="%s"' % (name, value))
+    return "{" + ",".join(parts) + "}"
+
+
+def _write_atomically(path, text):
+    tmpfile = path + ".tmp"
+    with open(tmpfile, "w") as f:
+        f.write(text)
+    os.replace(tmpfile, path)
@@ -0,0 +1,291 @@
+"""Per-stage profiling of a migration run.
+
+In "cprofile" mode every function call is traced with cProfile: in the
+thread running a stage, in the threads it starts, and in transformer
+worker processes.  In "sampling" mode the stacks of all threads are
+instead sampled every SAMPLE_INTERVAL seconds, which costs little enough
+to leave on for a long run.  Either way, each stage's results go to the
+working directory as profile-<stage>.txt, a summary of the hottest
+functions, plus profile-<stage>.prof (for pstats or snakeviz) or
+profile-<stage>.folded (collapsed stacks, for flame graph tools).
+
+Threads are assigned to a stage by name (the actuators name their
+thread pools after their stage) or else to the stage the main thread is
+running.
+"""
+import cProfile
+import glob
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from multiprocessing.util import Finalize
+
+PROFILE_MODES = ["cprofile", "sampling"]
+STAGES = ["extract", "transform", "load", "verify"]
+# Functions listed in each stage's summary.
+PROFILE_TOP = 30
+# Seconds between stack samples in sampling mode.
+SAMPLE_INTERVAL = 0.01
+# Deepest stack recorded in sampling mode.
+MAX_STACK_DEPTH = 100
+
+
+class Profiler(object):
+    """Profiles each stage of a run in the given mode, writing results to
+    directory when stopped.
+    """
+
+    def __init__(self, mode, directory, logger=None):
+        if mode not in PROFILE_MODES:
+            raise RuntimeError("Unknown profiling mode '%s'" % mode)
+        self.mode = mode
+        self.directory = directory
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._current = None
+        self._thread_stages = {}
+        self._profiles = {}
+        self._sampler = None
+
+    def start(self):
+        os.makedirs(self.directory, mode=0o755, exist_ok=True)
+        # Results from worker processes of an earlier run must not be
+        #  merged into this one's.
+        for fname in glob.glob(os.path.join(self.directory,
+                                            "profile-*-worker-*")):
+            os.remove(fname)
+        if self.mode == "cprofile":
+            threading.setprofile(self._profile_thread)
+        else:
+            self._sampler = Sampler(self.stage_of_thread)
+            self._sampler.start()
+
+    def stop(self):
+        """Stop profiling and write each stage's results.
+        """
+        if self.mode == "cprofile":
+            threading.setprofile(None)
+        else:
+            self._sampler.stop()
+        for stage in STAGES:
+            try:
+                if self.mode == "cprofile":
+                    written = self._write_cprofile(stage)
+                else:
+                    written = self._write_samples(stage)
+            except (OSError, ValueError) as exc:
+                if self.logger:
+                    self.logger.warning("Could not write %s profile: %s" %
+                                        (stage, str(exc)))
+                continue
+            if written and self.logger:
+                self.logger.info("Wrote %s profile to '%s'." %
+                                 (stage, written))
+
+    @contextmanager
+    def stage(self, stage):
+        """Profile the body of a with statement, in the calling thread and
+        the threads it starts, as the given stage.
+        """
+        ident = threading.get_ident()
+        with self._lock:
+            self._thread_stages[ident] = stage
+            if threading.current_thread() is threading.main_thread():
+                self._current = stage
+        profile = None
+        if self.mode == "cprofile":
+            profile = self._new_profile(stage)
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            with self._lock:
+                self._thread_stages.pop(ident, None)
+                if threading.current_thread() is threading.main_thread():
+                    self._current = None
+
+    def stage_of_thread(self, ident, name):
+        """Return the stage a thread's work belongs to, or None.
+        """
+        with self._lock:
+            stage = self._thread_stages.get(ident)
+            if stage:
+                return stage
+            for stage in STAGES:
+                if (name == stage or name.startswith(stage + "_") or
+                        name.startswith(stage + "-")):
+                    return stage
+            return self._current
+
+    def _new_profile(self, stage):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Newer Pythons allow only one active profiler at a time.
+            return None
+        with self._lock:
+            self._profiles.setdefault(stage, []).append(profile)
+        return profile
+
+    def _profile_thread(self, frame, event, arg):
+        # Installed by threading.setprofile(), so called first thing in
+        #  every new thread: swap in a cProfile profiler of its own.
+        sys.setprofile(None)
+        thread = threading.current_thread()
+        stage = self.stage_of_thread(thread.ident, thread.name)
+        if stage:
+            self._new_profile(stage)
+
+    def _write_cprofile(self, stage):
+        with self._lock:
+            profiles = self._profiles.pop(stage, [])
+        stats = None
+        for profile in profiles:
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        workers = sorted(glob.glob(os.path.join(
+            self.directory, "profile-%s-worker-*.prof" % stage)))
+        for fname in workers:
+            if stats is None:
+                stats = pstats.Stats(fname)
+            else:
+                stats.add(fname)
+        if stats is None:
+            return None
+        for fname in workers:
+            os.remove(fname)
+        base = os.path.join(self.directory, "profile-%s" % stage)
+        stats.dump_stats(base + ".prof")
+        out = io.StringIO()
+        stats.stream = out
+        out.write("Stage '%s': %d processes or threads profiled.\n\n" %
+                  (stage, len(profiles) + len(workers)))
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+        stats.sort_stats("tottime").print_stats(PROFILE_TOP)
+        with open(base + ".txt", "w") as f:
+            f.write(out.getvalue())
+        return base + ".txt"
+
+    def _write_samples(self, stage):
+        counts = Counter()
+        for (sampled_stage, stack), count in self._sampler.counts.items():
+            if sampled_stage == stage:
+                counts[stack] = counts[stack] + count
+        workers = sorted(glob.glob(os.path.join(
+            self.directory, "profile-%s-worker-*.samples" % stage)))
+        for fname in workers:
+            with open(fname, "r") as f:
+                for stack, count in json.load(f):
+                    counts[tuple(stack)] = counts[tuple(stack)] + count
+        if not counts:
+            return None
+        for fname in workers:
+            os.remove(fname)
+        base = os.path.join(self.directory, "profile-%s" % stage)
+        with open(base + ".folded", "w") as f:
+            for stack, count in sorted(counts.items()):
+                f.write("%s %d\n" % (";".join(stack), count))
+        total = sum(counts.values())
+        own = Counter()
+        inclusive = Counter()
+        for stack, count in counts.items():
+            own[stack[-1]] = own[stack[-1]] + count
+            for func in set(stack):
+                inclusive[func] = inclusive[func] + count
+        with open(base + ".txt", "w") as f:
+            f.write("Stage '%s': %d samples at %g s intervals.\n\n" %
+                    (stage, total, SAMPLE_INTERVAL))
+            for title, counter in (("Inclusive", inclusive),
+                                   ("Own (exclusive)", own)):
+                f.write("%s samples:\n%8s %7s  %s\n" %
+                        (title, "samples", "%", "function"))
+                for func, count in counter.most_common(PROFILE_TOP):
+                    f.write("%8d %6.1f%%  %s\n" %
+                            (count, 100.0 * count / total, func))
+                f.write("\n")
+        return base + ".txt"
+
+
+class Sampler(object):
+    """Thread that periodically records the stack of every other thread,
+    counting samples by stage and stack.  stage_of(ident, name) picks the
+    stage of a thread; threads with none are not recorded.
+    """
+
+    def __init__(self, stage_of, interval=None):
+        self.stage_of = stage_of
+        self.interval = interval or SAMPLE_INTERVAL
+        self.counts = Counter()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampler",
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stopping.wait(self.interval):
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stage = self.stage_of(ident, names.get(ident, ""))
+                if stage:
+                    self.counts[(stage, _get_stack(frame))] += 1
+
+
+def profile_worker(mode, directory, stage):
+    """Profile the rest of this worker process's life, leaving its results
+    in directory for the parent's Profiler to merge when it stops.
+    """
+    base = os.path.join(directory, "profile-%s-worker-%d" %
+                        (stage, os.getpid()))
+    if mode == "cprofile":
+        profile = cProfile.Profile()
+        profile.enable()
+        Finalize(None, _dump_worker_profile, args=(profile, base + ".prof"),
+                 exitpriority=10)
+    elif mode == "sampling":
+        sampler = Sampler(lambda ident, name: stage)
+        sampler.start()
+        Finalize(None, _dump_worker_samples, args=(sampler,
+                                                   base + ".samples"),
+                 exitpriority=10)
+
+
+def _dump_worker_profile(profile, fname):
+    profile.disable()
+    profile.dump_stats(fname)
+
+
+def _dump_worker_samples(sampler, fname):
+    sampler.stop()
+    with open(fname, "w") as f:
+        json.dump([[list(stack), count]
+                   for (stage, stack), count in sampler.counts.items()], f)
+
+
+def _get_stack(frame):
+    stack = []
+    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        stack.append("%s (%s:%d)" % (code.co_name,
+                                     os.path.basename(code.co_filename),
+                                     code.co_firstlineno))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
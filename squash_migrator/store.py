@@ -0,0 +1,361 @@
+"""Storage backends for the jobs/ and transformed/ caches.
+
+Both backends map a job number to a job dict.  DirectoryStore keeps one
+pretty-printed JSON file per job, which is easy to inspect by hand;
+SQLiteStore keeps compressed records in a single indexed file, which is
+far kinder to the filesystem once there are tens of thousands of jobs.
+
+Besides reading and writing whole jobs, both can hand out a job's JSON as
+a binary stream and accept it as text written piecemeal, for jobs too big
+to decode in one go; see the stream module.
+"""
+import glob
+import os
+import sqlite3
+import threading
+import zlib
+from . import codec
+
+STORE_TYPES = ["directory", "sqlite"]
+
+
+def open_store(context, name):
+    """Open the store called name (e.g. "jobs" or "transformed") in the
+    context's working directory, using the backend the context selects.
+    """
+    directory = os.path.abspath(context.directory)
+    store_type = context.store or "directory"
+    if store_type == "directory":
+        return DirectoryStore(os.path.join(directory, name),
+                              compact=context.compact)
+    if store_type == "sqlite":
+        return SQLiteStore(os.path.join(directory, name + ".sqlite"))
+    raise RuntimeError("Unknown job store type '%s'" % store_type)
+
+
+class DirectoryStore(object):
+    """Job store with one job-N.json file per job in a directory.  Files
+    are indented for reading by hand unless compact is set.
+    """
+
+    def __init__(self, directory, compact=False):
+        self.directory = directory
+        self.compact = compact
+
+    def location(self, jobnum):
+        """Return a human-readable location for the job, for logging.
+        """
+        return os.path.join(self.directory, "job-%s.json" % str(jobnum))
+
+    def exists(self, jobnum):
+        return os.path.exists(self.location(jobnum))
+
+    def jobnums(self):
+        """Return the sorted job numbers present in the store.
+        """
+        jobnums = []
+        fileglobstr = os.path.join(self.directory, "job-*.json")
+        for fname in glob.glob(fileglobstr):
+            try:
+                jobnums.append(int(os.path.basename(fname)[4:-5]))
+            except ValueError:
+                continue
+        jobnums.sort()
+        return jobnums
+
+    def read(self, jobnum):
+        """Return the job with the given number.  Raises KeyError if it is
+        not present and OSError or ValueError if it cannot be read.
+        """
+        fname = self.location(jobnum)
+        try:
+            with open(fname, "r") as f:
+                return codec.load(f)
+        except FileNotFoundError:
+            raise KeyError(jobnum)
+
+    def write(self, jobnum, job):
+        """Store job under the given number; return its size in bytes.
+        """
+        os.makedirs(self.directory, mode=0o755, exist_ok=True)
+        data = codec.dumps(job, compact=self.compact).encode("utf-8")
+        with open(self.location(jobnum), "wb") as fp:
+            fp.write(data)
+        return len(data)
+
+    def size(self, jobnum):
+        """Return the size of the job's JSON in bytes.  Raises KeyError if
+        it is not present.
+        """
+        try:
+            return os.path.getsize(self.location(jobnum))
+        except FileNotFoundError:
+            raise KeyError(jobnum)
+
+    def reader(self, jobnum):
+        """Return a binary file from which the job's JSON can be read.
+        Raises KeyError if it is not present.
+        """
+        try:
+            return open(self.location(jobnum), "rb")
+        except FileNotFoundError:
+            raise KeyError(jobnum)
+
+    def writer(self, jobnum):
+        """Return a context manager with a write() method taking text, which
+        stores the job when it exits without an exception.  Its size
+        attribute is then the stored size.
+        """
+        os.makedirs(self.directory, mode=0o755, exist_ok=True)
+        return _FileWriter(self.location(jobnum))
+
+    def items(self):
+        """Iterate over (job number, job) in job number order.
+        """
+        for jobnum in self.jobnums():
+            yield jobnum, self.read(jobnum)
+
+    def close(self):
+        pass
+
+
+class SQLiteStore(object):
+    """Job store holding zlib-compressed compact JSON records in a single
+    SQLite file, indexed by job number.  Safe to share between threads;
+    each process opens its own connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Records are always compact JSON.
+        self.compact = True
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connect(self):
+        # Connections cannot cross a fork, so worker processes reconnect.
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), mode=0o755,
+                        exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=60,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs " +
+                         "(jobnum INTEGER PRIMARY KEY, data BLOB NOT NULL, " +
+                         "size INTEGER)")
+            columns = [row[1] for row in
+                       conn.execute("PRAGMA table_info(jobs)").fetchall()]
+            # Stores written before uncompressed sizes were recorded.
+            if "size" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN size INTEGER")
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def location(self, jobnum):
+        return "%s#%s" % (self.path, str(jobnum))
+
+    def exists(self, jobnum):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT 1 FROM jobs WHERE jobnum = ?", (jobnum,)).fetchone()
+        return row is not None
+
+    def jobnums(self):
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT jobnum FROM jobs ORDER BY jobnum").fetchall()
+        return [row[0] for row in rows]
+
+    def read(self, jobnum):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT data FROM jobs WHERE jobnum = ?",
+                (jobnum,)).fetchone()
+        if row is None:
+            raise KeyError(jobnum)
+        return self._decode(row[0])
+
+    def write(self, jobnum, job):
+        text = codec.dumps(job, compact=True).encode("utf-8")
+        data = zlib.compress(text)
+        self._put(jobnum, data, len(text))
+        return len(data)
+
+    def size(self, jobnum):
+        # The size of the JSON, not of the compressed record: it is what
+        #  decides whether a job is too big to decode whole.
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT size FROM jobs WHERE jobnum = ?",
+                (jobnum,)).fetchone()
+        if row is None:
+            raise KeyError(jobnum)
+        if row[0] is not None:
+            return row[0]
+        # Written before sizes were recorded: inflate it to find out.
+        size = 0
+        with self.reader(jobnum) as fp:
+            for chunk in iter(lambda: fp.read(65536), b""):
+                size = size + len(chunk)
+        return size
+
+    def reader(self, jobnum):
+        # The compressed record is held in memory, but it is inflated a
+        #  chunk at a time.
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT data FROM jobs WHERE jobnum = ?",
+                (jobnum,)).fetchone()
+        if row is None:
+            raise KeyError(jobnum)
+        return _InflatingReader(row[0])
+
+    def writer(self, jobnum):
+        return _SQLiteWriter(self, jobnum)
+
+    def _put(self, jobnum, data, size):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO jobs (jobnum, data, size) " +
+                         "VALUES (?, ?, ?)", (jobnum, data, size))
+            conn.commit()
+
+    def items(self):
+        # Read in batches so that iteration does not hold the lock (or the
+        #  whole table) for its duration.
+        last = None
+        while True:
+            with self._lock:
+                conn = self._connect()
+                if last is None:
+                    rows = conn.execute(
+                        "SELECT jobnum, data FROM jobs ORDER BY jobnum " +
+                        "LIMIT 100").fetchall()
+                else:
+                    rows = conn.execute(
+                        "SELECT jobnum, data FROM jobs WHERE jobnum > ? " +
+                        "ORDER BY jobnum LIMIT 100", (last,)).fetchall()
+            if not rows:
+                return
+            for jobnum, data in rows:
+                yield jobnum, self._decode(data)
+            last = rows[-1][0]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_pid"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _decode(self, data):
+        return codec.loads(zlib.decompress(data))
+
+
+class _FileWriter(object):
+    """Writes a job file under a temporary name, renaming it into place
+    only once it is complete.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self._tmpfile = path + ".tmp"
+        self._fp = None
+
+    def __enter__(self):
+        self._fp = open(self._tmpfile, "wb")
+        return self
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self._fp.write(data)
+        self.size = self.size + len(data)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._fp.close()
+        if exc_type is None:
+            os.replace(self._tmpfile, self.path)
+        else:
+            os.remove(self._tmpfile)
+        return False
+
+
+class _SQLiteWriter(object):
+    """Compresses a job as it is written, storing the record once it is
+    complete.
+    """
+
+    def __init__(self, store, jobnum):
+        self.store = store
+        self.jobnum = jobnum
+        self.size = 0
+        self._compressor = zlib.compressobj()
+        self._parts = []
+        self._length = 0
+
+    def __enter__(self):
+        return self
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self._length = self._length + len(data)
+        self._parts.append(self._compressor.compress(data))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._parts.append(self._compressor.flush())
+            data = b"".join(self._parts)
+            self.store._put(self.jobnum, data, self._length)
+            self.size = len(data)
+        self._parts = []
+        return False
+
+
+class _InflatingReader(object):
+    """Binary file over a zlib-compressed record.
+    """
+
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._pos = 0
+        self._decompressor = zlib.decompressobj()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(65536), b""))
+        decompressor = self._decompressor
+        while True:
+            src = decompressor.unconsumed_tail
+            if not src:
+                src = self._data[self._pos:self._pos + size]
+                self._pos = self._pos + len(src)
+            if not src:
+                return decompressor.flush()
+            data = decompressor.decompress(src, size)
+            if data:
+                return data
+
+    def close(self):
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
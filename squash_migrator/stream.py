@@ -0,0 +1,268 @@
+"""Incremental JSON reading and writing for jobs too large to hold in
+memory comfortably.
+
+iter_object() walks the top level of a JSON object read a chunk at a
+time, handing back the elements of chosen arrays one by one, and
+ObjectWriter assembles an object whose large arrays are spooled to a
+temporary file as they are built.  Memory use is then bounded by the
+largest single element rather than by the whole job.  ObjectWriter's
+output is byte-identical to codec.dumps() of the same object, so
+streamed and in-memory jobs are interchangeable.
+"""
+import codecs
+import json
+import re
+import shutil
+import tempfile
+
+# Bytes to read from the input at a time.
+CHUNK_SIZE = 64 * 1024
+# Characters of an array's encoded elements held in memory before the
+#  array is spooled to a temporary file.
+SPOOL_SIZE = 1024 * 1024
+
+# Jobs stored or sent as more than this many bytes are streamed rather
+#  than decoded whole.
+STREAM_THRESHOLD = 1024 * 1024
+# Members of an old- or new-style job that can grow without bound.
+JOB_ARRAYS = ("measurements", "blobs")
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_DECODER = json.JSONDecoder()
+
+
+def iter_object(fp, stream_keys=()):
+    """Yield the (key, value) members of the JSON object read from fp,
+    which may be a binary (UTF-8) or text file.  For keys in stream_keys
+    whose value is an array, the value yielded is instead an iterator over
+    its elements, which must be consumed before the next member is asked
+    for.  Raises ValueError on invalid input.
+    """
+    reader = _Reader(fp)
+    reader.expect("{")
+    if reader.peek() == "}":
+        reader.expect("}")
+        return
+    while True:
+        key = reader.value()
+        if type(key) is not str:
+            raise ValueError("Expected an object key, got %r" % key)
+        reader.expect(":")
+        if key in stream_keys and reader.peek() == "[":
+            reader.expect("[")
+            elements = reader.elements()
+            yield key, elements
+            for _ in elements:
+                pass
+        else:
+            yield key, reader.value()
+        if reader.separator("}"):
+            return
+
+
+class ChunkReader(object):
+    """File-like view of an iterator over chunks of bytes, such as a
+    response's iter_content(), for iter_object().
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def read(self, size=-1):
+        return next(self._chunks, b"")
+
+
+class _Reader(object):
+    """Buffered tokenizer over a file.  Values are decoded whole by the
+    standard library's scanner, so they come out exactly as json.loads
+    would give them.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+
+    def _fill(self, size):
+        # Drop what has been consumed, then read at least size characters
+        #  more.  Asking for as much again as is buffered keeps re-parsing
+        #  a value that spans many chunks linear overall.
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        parts = [self.buf]
+        got = 0
+        while got < size and not self.eof:
+            data = self.fp.read(CHUNK_SIZE)
+            if not data:
+                self.eof = True
+            if isinstance(data, bytes):
+                data = self._decoder.decode(data, final=self.eof)
+            parts.append(data)
+            got = got + len(data)
+        self.buf = "".join(parts)
+
+    def peek(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                raise ValueError("Unexpected end of JSON input")
+            self._fill(CHUNK_SIZE)
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError("Expected '%s', found '%s'" % (char, found))
+        self.pos = self.pos + 1
+
+    def separator(self, closing):
+        """Consume a comma or the closing bracket; return True for the
+        latter.
+        """
+        found = self.peek()
+        self.pos = self.pos + 1
+        if found == closing:
+            return True
+        if found != ",":
+            raise ValueError("Expected ',' or '%s', found '%s'" %
+                             (closing, found))
+        return False
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = _DECODER.raw_decode(self.buf, self.pos)
+            except json.decoder.JSONDecodeError:
+                if self.eof:
+                    raise
+                self._fill(max(CHUNK_SIZE, len(self.buf) - self.pos))
+                continue
+            # A number or literal that runs to the end of the buffer may
+            #  continue in the next chunk.
+            if end < len(self.buf) or self.eof:
+                self.pos = end
+                return obj
+            self._fill(CHUNK_SIZE)
+
+    def elements(self):
+        if self.peek() == "]":
+            self.pos = self.pos + 1
+            return
+        while True:
+            yield self.value()
+            if self.separator("]"):
+                return
+
+
+class ObjectWriter(object):
+    """A JSON object written in codec.dumps() format.  Members set with
+    set() are held in memory; arrays from array() are encoded and spooled
+    as each element is appended.  Calling array() again for the same key
+    adds a further segment, written after the earlier ones.  Unless
+    allow_nan is set, NaN and infinities raise ValueError, as they do for
+    codec.dumps().
+    """
+
+    def __init__(self, compact=False, allow_nan=True):
+        self.compact = compact
+        self.allow_nan = allow_nan
+        self._values = {}
+        self._arrays = {}
+
+    def set(self, key, value):
+        self._values[key] = value
+
+    def array(self, key):
+        spool = _ArraySpool(self.compact, self.allow_nan)
+        self._arrays.setdefault(key, []).append(spool)
+        return spool
+
+    def write(self, fp):
+        """Write the object to the text file fp.
+        """
+        keys = sorted(set(self._values) | set(self._arrays))
+        if not keys:
+            fp.write("{}")
+            return
+        fp.write("{" if self.compact else "{\n")
+        for index, key in enumerate(keys):
+            if index:
+                fp.write("," if self.compact else ",\n")
+            if self.compact:
+                fp.write(json.dumps(key) + ":")
+            else:
+                fp.write("    " + json.dumps(key) + ": ")
+            if key in self._values:
+                fp.write(_encode(self._values[key], self.compact, 1,
+                                 self.allow_nan))
+            else:
+                self._write_array(fp, self._arrays[key])
+        fp.write("}" if self.compact else "\n}")
+
+    def _write_array(self, fp, spools):
+        spools = [s for s in spools if s.count]
+        if not spools:
+            fp.write("[]")
+            return
+        fp.write("[" if self.compact else "[\n")
+        for index, spool in enumerate(spools):
+            if index:
+                fp.write("," if self.compact else ",\n")
+            spool.copy_to(fp)
+        fp.write("]" if self.compact else "\n    ]")
+
+    def close(self):
+        for spools in self._arrays.values():
+            for spool in spools:
+                spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class _ArraySpool(object):
+    """Encoded elements of one array (segment), one level below the top
+    of an object.
+    """
+
+    def __init__(self, compact, allow_nan=True):
+        self.compact = compact
+        self.allow_nan = allow_nan
+        self.count = 0
+        self._file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE,
+                                                   mode="w+",
+                                                   encoding="utf-8")
+
+    def append(self, value):
+        if self.count:
+            self._file.write("," if self.compact else ",\n")
+        if not self.compact:
+            self._file.write(" " * 8)
+        self._file.write(_encode(value, self.compact, 2, self.allow_nan))
+        self.count = self.count + 1
+
+    def copy_to(self, fp):
+        self._file.seek(0)
+        shutil.copyfileobj(self._file, fp, CHUNK_SIZE)
+
+    def close(self):
+        self._file.close()
+
+
+def _encode(value, compact, depth, allow_nan=True):
+    # Encode a value nested depth levels down, as json.dumps would within
+    #  an enclosing document.  Newlines only occur between tokens, since
+    #  those inside strings are escaped.
+    if compact:
+        return json.dumps(value, sort_keys=True, separators=(",", ":"),
+                          allow_nan=allow_nan)
+    text = json.dumps(value, indent=4, sort_keys=True, allow_nan=allow_nan)
+    return text.replace("\n", "\n" + " " * (4 * depth))
@@ -1,11 +1,49 @@
+import hashlib
 import json
 import logging
 import os
-import uuid
+import time
 import requests
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from . import codec
+from . import literal
+from . import stream
 from .actuator import Actuator
+from .extractor import MAX_PAGE_SIZE
+from .manifest import EXTRACTED, LOADED, TRANSFORMED
+from .metricnames import MetricNameIndex
+from .metrics import Metrics
+from .profiling import profile_worker
+from .store import open_store
 
-# Metric map generated by Simon Krughoff
+# Outcomes of transforming one job, besides manifest.TRANSFORMED.
+SKIPPED = "skipped"
+FAILED = "failed"
+# Version of the transformation, part of every transformed job's
+#  fingerprint.  Increase it whenever transform_job's output changes, so
+#  that the jobs transformed before are transformed again.  Changes to the
+#  metric names or units are caught by the fingerprint of each job that
+#  uses them.
+TRANSFORMER_VERSION = 1
+# Stands for the fingerprint of a job transformed before fingerprints were
+#  recorded.
+UNRECORDED = "unrecorded"
+# Seconds for which a cached metric unit map is used without checking the
+#  old service.
+METRIC_MAP_TTL = 24 * 60 * 60
+# Seconds to wait for each page of the metric unit map when a cached copy
+#  could be used instead; such a refresh is not retried.
+METRIC_MAP_REFRESH_TIMEOUT = 10
+# Number of decoded metadata strings to keep, by content hash.
+DECODED_STRING_CACHE_SIZE = 10000
+
+# Per-process transformer used by worker processes; see _init_worker.
+_worker_transformer = None
+
+# Metric map generated by Simon Krughoff.  Combinations not listed here
+#  fall back as described in metricnames.MetricNameIndex, and more can be
+#  given in a file with --metric-names.
 METRICS = {(u'AD2', u'design', u'HSC-I'): 'validate_drp.AD2_design',
            (u'AF1', u'design', u'r'): 'validate_drp.AF1_design',
            (u'PA2', u'minimum', u'r'): 'validate_drp.PA2_minimum_gri',
@@ -81,69 +119,391 @@ METRICS = {(u'AD2', u'design', u'HSC-I'): 'validate_drp.AD2_design',
 class Transformer(Actuator):
     """Class to transform old SQuaSH representation into new one.
     """
+    stage = "transform"
 
     def __init__(self, context=None):
         super().__init__(context=context)
-        self.input_dir = os.path.join(self.directory, "jobs")
-        self.output_dir = os.path.join(self.directory, "transformed")
+        self.input_store = open_store(context, "jobs")
+        self.output_store = open_store(context, "transformed")
         logger = logging.getLogger(__name__)
         logger.setLevel(context.loglevel)
         self.logger = logger
         self.metric_map = {}
+        if context.metric_names:
+            self.metric_names = MetricNameIndex.from_file(
+                context.metric_names, names=METRICS, logger=logger)
+        else:
+            self.metric_names = MetricNameIndex(METRICS, logger=logger)
+        self._decoded_strings = OrderedDict()
+        self._requeued = 0
 
     def transform(self):
         """Transform old-style representations into new ones.
         """
-        inputfiles = []
         job_numbers = self.job_numbers
-        if not job_numbers:
-            inputfiles = self.scan_for_jobs(self.input_dir)
-        else:
-            for jobnum in job_numbers:
-                inputfiles.append(os.path.join(
-                    self.input_dir, "job-%s.json" % jobnum))
-        if not inputfiles:
-            self.logger.error("No input files found in %s to transform" %
-                              self.input_dir)
+        manifest = self.manifest
+        inputjobs = manifest.jobnums(EXTRACTED)
+        if job_numbers:
+            inputjobs = [j for j in inputjobs if j in job_numbers]
+            if len(inputjobs) < len(job_numbers):
+                self.logger.warning("%d requested jobs were never extracted." %
+                                    (len(job_numbers) - len(inputjobs)))
+        if not inputjobs:
+            self.logger.error("No input jobs found in %s to transform" %
+                              self.input_store.location("*"))
+            return
+        self.start()
+        numfiles = len(inputjobs)
+        todo = self.plan(inputjobs)
+        so_far = numfiles - len(todo)
+        if so_far:
+            self.logger.info("%d/%d jobs already transformed." %
+                             (so_far, numfiles))
+        if not todo:
+            self.finish()
             return
-        os.makedirs(self.output_dir, mode=0o755, exist_ok=True)
+        workers = self.context.workers
+        if workers > 1:
+            # The metric map is built once, here, and handed to each worker
+            #  process when it starts.
+            chunksize = max(1, min(64, numfiles // (4 * workers)))
+            with self.executor() as executor:
+                results = executor.map(_transform_job_in_worker,
+                                       todo.items(), chunksize=chunksize)
+                self._report_results(self._merge_worker_metrics(results),
+                                     numfiles, so_far)
+        else:
+            results = (self.transform_jobnum(jobnum, *recorded)
+                       for jobnum, recorded in todo.items())
+            self._report_results(results, numfiles, so_far)
+        self.finish()
+
+    def start(self):
+        """Prepare the metric unit map.
+        """
+        self.metrics.stage_started(self.stage)
+        self._requeued = 0
         self._make_metric_map()
-        numfiles = len(inputfiles)
-        so_far = 0
-        for inp_file in inputfiles:
-            basefile = os.path.basename(inp_file)
-            out_file = os.path.join(self.output_dir, basefile)
-            if os.path.exists(out_file):
-                self.logger.info(
-                    "File '%s' exists; remove to re-transform." % out_file)
+
+    def plan(self, jobnums):
+        """Decide which of the given extracted jobs need transform_jobnum.
+        Returns an OrderedDict mapping each to the fingerprint recorded
+        for its transformed job (None if it has none, UNRECORDED if it was
+        transformed before fingerprints were recorded) and the metric keys
+        recorded with it.  Transformed jobs whose fingerprint is still
+        current are left out; those whose input has not been digested yet
+        are checked by transform_jobnum.
+        """
+        fingerprints = self.manifest.fingerprints()
+        todo = OrderedDict()
+        changed = 0
+        for jobnum in jobnums:
+            if jobnum not in fingerprints:
+                todo[jobnum] = (None, None)
                 continue
-            job = None
-            try:
-                with open(inp_file, "r") as f:
-                    job = json.load(f)
-            except OSError as exc:
-                self.logger.error(
-                    "Could not load '%s': %s" % (inp_file, str(exc)))
+            input_digest, previous, metric_keys = fingerprints[jobnum]
+            if not previous:
+                todo[jobnum] = (UNRECORDED, None)
+            elif not input_digest:
+                todo[jobnum] = (previous, metric_keys)
+            elif (metric_keys is None or
+                  self.fingerprint(input_digest, metric_keys) != previous):
+                # Without its metric keys, a fingerprint cannot be
+                #  checked, so the job is transformed again.
+                todo[jobnum] = (previous, metric_keys)
+                changed = changed + 1
+        if changed:
+            self.logger.info("%d transformed jobs are out of date; " %
+                             changed + "transforming them again.")
+        return todo
+
+    def fingerprint(self, input_digest, metric_keys):
+        """Return the fingerprint of the transformed job made by this
+        transformer from an input with the given digest, whose
+        measurements have the given (metric, spec, filter) keys.  Only the
+        new names and units of those keys go into it, so a change to the
+        metric names or units alters the fingerprints of just the jobs it
+        affects.
+        """
+        resolved = [[metric, spec, flt,
+                     self.metric_names.resolve(metric, spec, flt),
+                     self.metric_map.get(metric)]
+                    for metric, spec, flt in metric_keys]
+        content = json.dumps([TRANSFORMER_VERSION, input_digest, resolved])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def finish(self):
+        """Record the results of every transformed job.
+        """
+        if self._requeued:
+            self.logger.info("%d jobs loaded before were transformed " %
+                             self._requeued + "again and will be loaded " +
+                             "again.")
+        self.manifest.flush()
+        self.metrics.stage_finished(self.stage)
+
+    def executor(self, mp_context=None):
+        """Return a pool of as many worker processes as the context has
+        workers, each transforming jobs with its own transformer and this
+        one's metric map.  mp_context is as for ProcessPoolExecutor.
+        """
+        return ProcessPoolExecutor(max_workers=self.context.workers,
+                                   initializer=_init_worker,
+                                   initargs=(self.context, self.metric_map),
+                                   mp_context=mp_context)
+
+    def submit(self, executor, jobnum, previous=None, metric_keys=None):
+        """Start transform_jobnum for one job in a process of executor,
+        returning a future to hand to worker_result.
+        """
+        return executor.submit(_transform_job_in_worker,
+                               (jobnum, (previous, metric_keys)))
+
+    def worker_result(self, future):
+        """Wait for a job started by submit, and return its result once
+        the worker's statistics are merged into this transformer's.
+        """
+        result, metrics = future.result()
+        self.metrics.merge(metrics)
+        return result
+
+    def _merge_worker_metrics(self, results):
+        for result, metrics in results:
+            self.metrics.merge(metrics)
+            yield result
+
+    def record_result(self, result):
+        """Log the result of transform_jobnum and record it in the
+        manifest.
+        """
+        jobnum, status, message, size, digests = result
+        if status == FAILED:
+            self.logger.error(message)
+            self.manifest.mark_failed(jobnum, TRANSFORMED, message)
+            self.count_job("failed")
+            return
+        if message:
+            self.logger.info(message)
+        self.count_job("skipped" if status == SKIPPED else "ok", size)
+        self.manifest.mark(jobnum, TRANSFORMED, size=size)
+        self.manifest.set_fingerprint(jobnum, *digests)
+        if status == TRANSFORMED and jobnum in self.context.jobmap:
+            # The new service still holds the job as transformed before,
+            #  so it is sent again, as after a failed verification.
+            self.context.jobmap.remove([jobnum])
+            self.manifest.forget(jobnum, LOADED)
+            self._requeued = self._requeued + 1
+
+    def _report_results(self, results, numfiles, so_far):
+        failed = 0
+        for result in results:
+            self.record_result(result)
+            jobnum, status = result[:2]
+            if status == FAILED:
+                failed = failed + 1
+                continue
+            if status == SKIPPED:
                 continue
-            self.logger.debug("Loaded '%s'" % inp_file)
-            transformed_job = self.transform_job(job)
-            self.write_job(transformed_job, self.output_dir)
             so_far = so_far + 1
-            self.logger.info("%s: %d/%d" % (inp_file, so_far, numfiles))
+            self.logger.info("%s: %d/%d" %
+                             (self.input_store.location(jobnum), so_far,
+                              numfiles))
+        if failed:
+            self.logger.error("%d/%d jobs failed to transform." %
+                              (failed, numfiles))
+
+    def transform_jobnum(self, jobnum, previous=None, metric_keys=None):
+        """Transform a single job from the input store into the output
+        store, unless a transformed job is already there with a fingerprint
+        that matches (or, if previous is None or UNRECORDED, with none
+        recorded) the fingerprint previous, recorded with metric_keys.
+        Returns a tuple of the job number, one of TRANSFORMED, SKIPPED, or
+        FAILED, a message for the caller to log, the size of the stored
+        output, and the input digest, fingerprint, and metric keys to
+        record.  Runs in worker processes, so it leaves the manifest to the
+        caller; see record_result.
+        """
+        inp_loc = self.input_store.location(jobnum)
+        data = None
+        start = time.monotonic()
+        try:
+            if self.input_store.size(jobnum) > stream.STREAM_THRESHOLD:
+                input_digest = self._digest_input(jobnum)
+            else:
+                with self.input_store.reader(jobnum) as fp:
+                    data = fp.read()
+                input_digest = hashlib.sha256(data).hexdigest()
+        except (KeyError, OSError) as exc:
+            return (jobnum, FAILED,
+                    "Could not load '%s': %s" % (inp_loc, str(exc)), None,
+                    None)
+        if self.output_store.exists(jobnum):
+            message = None
+            if previous in (None, UNRECORDED):
+                # Adopted as it is, but its metric keys are needed for its
+                #  fingerprint.
+                try:
+                    metric_keys = self._find_metric_keys(jobnum, data)
+                except (KeyError, OSError, TypeError, ValueError) as exc:
+                    return (jobnum, FAILED,
+                            "Could not load '%s': %s: %s" %
+                            (inp_loc, type(exc).__name__, str(exc)), None,
+                            None)
+                if previous is None:
+                    message = ("'%s' exists; remove it and use " %
+                               self.output_store.location(jobnum) +
+                               "--rebuild-manifest to re-transform it.")
+            if metric_keys is not None:
+                fingerprint = self.fingerprint(input_digest, metric_keys)
+                if previous in (None, UNRECORDED, fingerprint):
+                    return (jobnum, SKIPPED, message, None,
+                            (input_digest, fingerprint, metric_keys))
+        if data is None:
+            return self._transform_jobnum_streaming(jobnum, input_digest)
+        try:
+            job = codec.loads(data)
+        except ValueError as exc:
+            return (jobnum, FAILED,
+                    "Could not load '%s': %s" % (inp_loc, str(exc)), None,
+                    None)
+        self.metrics.observe("json_decode_seconds", time.monotonic() - start,
+                             stage=self.stage)
+        self.logger.debug("Loaded '%s'" % inp_loc)
+        used = set()
+        try:
+            with self.metrics.timer("transform_seconds", stage=self.stage):
+                transformed_job = self.transform_job(job, used)
+        except (KeyError, TypeError, ValueError) as exc:
+            return (jobnum, FAILED,
+                    "Could not transform '%s': %s: %s" %
+                    (inp_loc, type(exc).__name__, str(exc)), None, None)
+        with self.metrics.timer("json_encode_seconds", stage=self.stage):
+            jobnum, size = self.write_job(transformed_job, self.output_store,
+                                          overwrite=True)
+        return (jobnum, TRANSFORMED, None, size,
+                self._get_digests(input_digest, used))
+
+    def _digest_input(self, jobnum):
+        digest = hashlib.sha256()
+        with self.input_store.reader(jobnum) as fp:
+            for chunk in iter(lambda: fp.read(stream.CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _find_metric_keys(self, jobnum, data=None):
+        """Return the sorted metric keys of the measurements in a job from
+        the input store, without transforming it.  data is the job's JSON,
+        if it has been read already.
+        """
+        keys = set()
+        if data is not None:
+            for meas in codec.loads(data)["measurements"]:
+                keys.add(self._get_metric_key(meas))
+        else:
+            with self.input_store.reader(jobnum) as fp:
+                for key, value in stream.iter_object(fp, stream.JOB_ARRAYS):
+                    if key == "measurements":
+                        for meas in value:
+                            keys.add(self._get_metric_key(meas))
+        return self._sort_metric_keys(keys)
+
+    def _sort_metric_keys(self, keys):
+        # Some specs and filters are None, which do not sort with strings.
+        return [list(key) for key in sorted(keys, key=repr)]
+
+    def _get_digests(self, input_digest, metric_keys):
+        metric_keys = self._sort_metric_keys(metric_keys)
+        return (input_digest, self.fingerprint(input_digest, metric_keys),
+                metric_keys)
+
+    def _transform_jobnum_streaming(self, jobnum, input_digest):
+        inp_loc = self.input_store.location(jobnum)
+        self.logger.debug("Streaming large job '%s'" % inp_loc)
+        used = set()
+        try:
+            # Reading, transforming, and writing are interleaved, so all
+            #  of it counts as transforming.
+            with self.metrics.timer("transform_seconds", stage=self.stage):
+                with self.input_store.reader(jobnum) as fp:
+                    with self.output_store.writer(jobnum) as out:
+                        self.transform_job_stream(fp, out, used)
+        except (KeyError, OSError, TypeError, ValueError) as exc:
+            return (jobnum, FAILED,
+                    "Could not transform '%s': %s: %s" %
+                    (inp_loc, type(exc).__name__, str(exc)), None, None)
+        return (jobnum, TRANSFORMED, None, out.size,
+                self._get_digests(input_digest, used))
 
     def _make_metric_map(self):
-        nexturl = self.context.from_url + "/metrics/"
-        if not self.session:
-            self.session = requests.Session()
+        """Set the metric unit map, from the cache in the working
+        directory if it is fresh enough, and otherwise from the old
+        service.  If the service cannot be reached, a stale cache is used.
+        """
+        cache = self._read_metric_map_cache()
+        refresh = self.context.refresh_metrics
+        if cache and not refresh:
+            age = time.time() - cache["fetched"]
+            if age < METRIC_MAP_TTL:
+                self.logger.debug("Using cached metric unit map (%d s old)." %
+                                  age)
+                self.metric_map = cache["map"]
+                return
+        etag = None
+        if cache and not refresh:
+            etag = cache.get("etag")
+        try:
+            m_map, etag, complete = self._fetch_metric_map(
+                etag, quick=bool(cache))
+        except requests.exceptions.RequestException as exc:
+            if not cache:
+                raise
+            self.logger.warning("Could not refresh metric unit map (%s); " %
+                                str(exc) + "using cached copy.")
+            self.metric_map = cache["map"]
+            return
+        if m_map is None:
+            self.logger.debug("Metric unit map unchanged on server.")
+            m_map = cache["map"]
+        if complete:
+            self._write_metric_map_cache(m_map, etag)
+        self.logger.debug("Created metric unit map.")
+        self.metric_map = m_map
+
+    def _fetch_metric_map(self, etag=None, quick=False):
+        """Walk the paginated metrics endpoint.  Returns the map (or None
+        if the server says the etag still matches), the etag of the first
+        page, and whether every page was read.  If quick is set, as when
+        there is a cached map to fall back on, a slow or failed request is
+        given up on at once rather than retried.
+        """
+        options = {}
+        if quick:
+            options = {"timeout": METRIC_MAP_REFRESH_TIMEOUT, "retries": 0}
+        # Metric records are small: ask for as many as allowed at once.
+        nexturl = (self.context.from_url + "/metrics/?page_size=%d" %
+                   (self.context.max_page_size or MAX_PAGE_SIZE))
         m_map = {}
+        first_etag = None
+        complete = True
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
         while nexturl:
             url = nexturl
-            resp = self.session.get(url)
+            resp = self.session.get(url, headers=headers, **options)
+            headers = {}
             nexturl = None
+            if resp.status_code == 304:
+                return None, etag, True
+            if quick:
+                resp.raise_for_status()
+            if first_etag is None:
+                first_etag = resp.headers.get("ETag")
             try:
-                j_resp = resp.json()
+                j_resp = codec.response_json(resp)
             except json.decoder.JSONDecodeError as exc:
-                self._showerror(resp, exc)
+                self.show_response_error(resp, exc)
+                complete = False
                 break
             if "next" in j_resp:
                 nexturl = j_resp["next"]
@@ -151,12 +511,43 @@ class Transformer(Actuator):
                 metric = result["metric"]
                 unit = result["unit"]
                 m_map[metric] = unit
-        self.logger.debug("Created metric unit map.")
-        self.metric_map = m_map
+        return m_map, first_etag, complete
+
+    def _get_metric_map_cache_file(self):
+        return os.path.join(self.directory, "metric_map.json")
+
+    def _read_metric_map_cache(self):
+        fname = self._get_metric_map_cache_file()
+        try:
+            with open(fname, "r") as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as exc:
+            self.logger.warning("Ignoring unreadable metric map cache " +
+                                "'%s': %s" % (fname, str(exc)))
+            return None
+        if (cache.get("url") != self.context.from_url or
+                "map" not in cache or "fetched" not in cache):
+            return None
+        return cache
+
+    def _write_metric_map_cache(self, m_map, etag):
+        fname = self._get_metric_map_cache_file()
+        cache = {"url": self.context.from_url,
+                 "fetched": time.time(),
+                 "etag": etag,
+                 "map": m_map}
+        tmpfile = fname + ".tmp"
+        os.makedirs(self.directory, mode=0o755, exist_ok=True)
+        with open(tmpfile, "w") as f:
+            json.dump(cache, f, indent=4, sort_keys=True)
+        os.replace(tmpfile, fname)
 
-    def transform_job(self, job):
+    def transform_job(self, job, metric_keys=None):
         """Does the heavy lifting to turn an old-style SQuaSH job into a
-        new one.
+        new one.  If metric_keys is a set, the (metric, spec, filter) key
+        of each measurement is added to it.
         """
         tjob = {"measurements": [],
                 "meta": {},
@@ -165,35 +556,13 @@ class Transformer(Actuator):
         tm = tjob["measurements"]
         jm = job["measurements"]
         newblobs = []
+        newblobids = set()
         # Iterate over measurements
         for meas in jm:
-            nm = {}
-            nm["identifier"] = None
-            nm["value"] = meas["value"]
-            metadata = meas.get("metadata")
-            if type(metadata) is str:
-                metadata = self._fix_input_string(metadata)
-            # Map old metric/spec/filter to new metric
-            new_metric = self._get_metric_name(meas["metric"], metadata)
-            nm["metric"] = new_metric
-            nm["unit"] = self.metric_map.get(meas["metric"])
-            nm["blob_refs"] = self._get_blob_refs(metadata)
-            if metadata:
-                # Glue extras/parameters into blobs/bob_refs.
-                newblobdata = {}
-                if "extras" in metadata:
-                    newblobdata.update(metadata["extras"])
-                if "parameters" in metadata:
-                    newblobdata.update(metadata["parameters"])
-                if newblobdata:
-                    blobid = uuid.uuid4().hex
-                    newblob = {"name": new_metric,
-                               "data": newblobdata,
-                               "identifier": blobid}
-                    newblobs.append(newblob)
-                    if nm["blob_refs"] is None:
-                        nm["blob_refs"] = []
-                    nm["blob_refs"].append(blobid)
+            nm, newblob = self._transform_measurement(meas, newblobids,
+                                                      metric_keys)
+            if newblob:
+                newblobs.append(newblob)
             tm.append(nm)
         blobs = job["blobs"]
         if type(blobs) is str:
@@ -201,32 +570,126 @@ class Transformer(Actuator):
         if newblobs:
             blobs.extend(newblobs)
         tjob["blobs"] = blobs
+        tjob["meta"] = self._transform_meta(job)
+        tjob["_job_number"] = self.get_jobnum_for_job(job)
+        return tjob
+
+    def transform_job_stream(self, fp, out, metric_keys=None):
+        """Like transform_job, but reads the old job as JSON from the
+        binary file fp, and writes the new one a piece at a time to out,
+        which has a write() method taking text.  Only one measurement or
+        blob is held in memory at once (unless the blobs were serialized
+        as a single string, which has to be decoded whole).
+        """
+        with stream.ObjectWriter(compact=self.output_store.compact) as tjob:
+            # Blobs made from measurement metadata follow the job's own,
+            #  as in transform_job.
+            blobs = tjob.array("blobs")
+            newblobs = tjob.array("blobs")
+            tm = tjob.array("measurements")
+            newblobids = set()
+            job = {}
+            for key, value in stream.iter_object(fp, stream.JOB_ARRAYS):
+                if key == "measurements":
+                    for meas in value:
+                        nm, newblob = self._transform_measurement(
+                            meas, newblobids, metric_keys)
+                        if newblob:
+                            newblobs.append(newblob)
+                        tm.append(nm)
+                elif key == "blobs":
+                    if type(value) is str:
+                        value = self._fix_input_string(value)
+                    for blob in value or []:
+                        blobs.append(blob)
+                job[key] = None if key in stream.JOB_ARRAYS else value
+            for key in stream.JOB_ARRAYS:
+                if key not in job:
+                    raise KeyError(key)
+            tjob.set("meta", self._transform_meta(job))
+            tjob.set("_job_number", self.get_jobnum_for_job(job))
+            tjob.write(out)
+
+    def _transform_measurement(self, meas, newblobids, metric_keys=None):
+        """Transform one measurement.  Returns the new measurement and the
+        blob made from its metadata, or None if there is no such blob or
+        one with the same identifier is in newblobids already.
+        """
+        nm = {}
+        nm["identifier"] = None
+        nm["value"] = meas["value"]
+        metadata = self._get_metadata(meas)
+        # Map old metric/spec/filter to new metric
+        key = self._get_metric_key(meas, metadata)
+        if metric_keys is not None:
+            metric_keys.add(key)
+        new_metric = self.metric_names.resolve(*key)
+        nm["metric"] = new_metric
+        nm["unit"] = self.metric_map.get(meas["metric"])
+        nm["blob_refs"] = self._get_blob_refs(metadata)
+        newblob = None
+        if metadata:
+            # Glue extras/parameters into blobs/bob_refs.
+            newblobdata = {}
+            if "extras" in metadata:
+                newblobdata.update(metadata["extras"])
+            if "parameters" in metadata:
+                newblobdata.update(metadata["parameters"])
+            if newblobdata:
+                newblob = {"name": new_metric,
+                           "data": newblobdata}
+                # Identical blobs get identical identifiers, so each
+                #  is stored only once per job (and can be recognized
+                #  across jobs).
+                blobid = self._get_blob_id(newblob)
+                newblob["identifier"] = blobid
+                if blobid in newblobids:
+                    newblob = None
+                else:
+                    newblobids.add(blobid)
+                if nm["blob_refs"] is None:
+                    nm["blob_refs"] = []
+                nm["blob_refs"].append(blobid)
+        return nm, newblob
+
+    def _transform_meta(self, job):
         # Move old top-level fields into .meta.env
-        tjob["meta"]["env"] = {}
-        te = tjob["meta"]["env"]
+        meta = {}
+        meta["env"] = {}
+        te = meta["env"]
         for fld in ["ci_id", "ci_name", "ci_dataset", "ci_label",
                     "date", "ci_url", "status"]:
             te[fld] = job.get(fld)
         te["env_name"] = "jenkins"
         package_obj = self._transform_packages(job)
-        tjob["meta"]["packages"] = package_obj
-        tjob["_job_number"] = self.get_jobnum_for_job(job)
-        return tjob
+        meta["packages"] = package_obj
+        return meta
+
+    def _get_blob_id(self, blob):
+        """Return an identifier derived from the blob's name and data, in
+        the same form as a uuid4 hex string.
+        """
+        content = codec.dumps(blob, compact=True).encode("utf-8")
+        return hashlib.sha256(content).hexdigest()[:32]
 
-    def _get_metric_name(self, metric, metadata):
-        newname = metric
+    def _get_metadata(self, meas):
+        metadata = meas.get("metadata")
+        if type(metadata) is str:
+            metadata = self._fix_input_string(metadata, memoize=True)
+        return metadata
+
+    def _get_metric_key(self, meas, metadata=None):
+        """Return the (metric, spec, filter) key naming a measurement's new
+        metric.
+        """
+        if metadata is None:
+            metadata = self._get_metadata(meas)
         spec_name = None
         flt = None
         if metadata:
-            spec_name = metadata.get("spec_name")
-            if spec_name:
-                newname += "_" + spec_name
-            flt = metadata.get("filter_name")
-            if flt:
-                newname += "_" + flt
-        metric_tuple = (metric, spec_name, flt)
-        retval = METRICS[metric_tuple] or metric
-        return retval
+            spec_name = metadata.get("spec_name") or None
+            flt = metadata.get("filter_name") or None
+        return (meas["metric"], spec_name, flt)
 
     def _transform_packages(self, job):
         retval = {}
@@ -251,19 +714,50 @@ class Transformer(Actuator):
         blobrefs = list(blobs.values())
         return blobrefs
 
-    def _fix_input_string(self, input):
+    def _fix_input_string(self, input, memoize=False):
         # Effectively, some of these were serialized with __repr__ rather
-        #  than via the json module.
+        #  than via the json module.  Identical metadata strings recur
+        #  across measurements and jobs, so with memoize set, results are
+        #  cached by content hash; callers must then not modify them.
+        if memoize:
+            key = hashlib.sha1(input.encode("utf-8")).digest()
+            cache = self._decoded_strings
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
         obj = None
         try:
-            obj = json.loads(input)
-        except json.decoder.JSONDecodeError as exc:
-            sexc = str(exc)
-            if sexc.find("property name enclosed in double quotes") != -1:
-                # This seems like a terrible idea.
-                obj = eval(input)
-            else:
-                einput = self.maybe_elide_long_string(input)
-                self.logger.warning("Input string transformation failed: %s" %
-                                    einput)
+            obj = literal.decode(input)
+        except ValueError:
+            einput = self.maybe_elide_long_string(input)
+            self.logger.warning("Input string transformation failed: %s" %
+                                einput)
+        if memoize:
+            cache[key] = obj
+            if len(cache) > DECODED_STRING_CACHE_SIZE:
+                cache.popitem(last=False)
         return obj
+
+
+def _init_worker(context, metric_map):
+    """Build the transformer a worker process will use, with the metric
+    map computed by the parent rather than re-fetched.
+    """
+    global _worker_transformer
+    # When workers are forked, the context is copied rather than pickled,
+    #  and would bring the parent's statistics with it.
+    context.metrics = Metrics()
+    if context.profile:
+        profile_worker(context.profile, os.path.abspath(context.directory),
+                       Transformer.stage)
+    transformer = Transformer(context=context)
+    transformer.metric_map = metric_map
+    _worker_transformer = transformer
+
+
+def _transform_job_in_worker(task):
+    # The worker's statistics travel back with each result.
+    jobnum, (previous, metric_keys) = task
+    result = _worker_transformer.transform_jobnum(jobnum, previous,
+                                                  metric_keys)
+    return result, _worker_transformer.metrics.drain()
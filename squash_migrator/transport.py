@@ -0,0 +1,262 @@
+"""Shared HTTP client for all traffic to the old and new SQuaSH services.
+
+One connection pool serves every actuator.  Requests to each host pass
+through an AIMD concurrency limit and a circuit breaker, and failed
+requests are retried with jittered exponential backoff, so that we can
+drive a healthy service hard and back off quickly when it degrades.
+"""
+import random
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+
+# Retries after the first attempt for retryable failures.
+MAX_RETRIES = 6
+# Backoff before retry n is uniform in [0, min(MAX_BACKOFF,
+#  BASE_BACKOFF * 2**n)] seconds ("full jitter").
+BASE_BACKOFF = 1
+MAX_BACKOFF = 60
+# Consecutive failures that open a host's circuit, and how long it stays
+#  open before a single probe request is let through.
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+# A request slower than LATENCY_FACTOR times the host's typical latency
+#  counts as a congestion signal.
+LATENCY_FACTOR = 4
+# Minimum seconds between multiplicative decreases of a host's limit.
+DECREASE_INTERVAL = 2
+# HTTP statuses that mean "try again later".
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# Of those, the ones that mean a non-idempotent request was not processed.
+UNPROCESSED_STATUSES = frozenset([429, 503])
+
+
+class AdaptiveLimiter(object):
+    """Additive-increase/multiplicative-decrease limit on the number of
+    requests in flight to one host.
+    """
+
+    def __init__(self, initial, maximum):
+        self.maximum = max(1, maximum)
+        self.limit = float(min(max(1, initial), self.maximum))
+        self.in_flight = 0
+        self.baseline = None
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight = self.in_flight + 1
+
+    def release(self, latency, ok):
+        with self._cond:
+            self.in_flight = self.in_flight - 1
+            slow = False
+            if ok and latency is not None:
+                if self.baseline is None:
+                    self.baseline = latency
+                else:
+                    slow = latency > LATENCY_FACTOR * self.baseline
+                    self.baseline = 0.9 * self.baseline + 0.1 * latency
+            if ok and not slow:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            else:
+                now = time.monotonic()
+                if now - self._last_decrease > DECREASE_INTERVAL:
+                    self.limit = max(1.0, self.limit / 2)
+                    self._last_decrease = now
+            self._cond.notify_all()
+
+
+class CircuitBreaker(object):
+    """Stops requests to a host after repeated failures, then lets a
+    single probe through after a cooldown to see whether it recovered.
+    """
+
+    def __init__(self, logger=None, host=None, metrics=None):
+        self.logger = logger
+        self.host = host
+        self.metrics = metrics
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until a request may be sent.
+        """
+        while True:
+            with self._lock:
+                if self.opened is None:
+                    return
+                remaining = self.opened + BREAKER_COOLDOWN - time.monotonic()
+                if remaining <= 0 and not self.probing:
+                    self.probing = True
+                    return
+            time.sleep(min(max(remaining, 0.1), 1))
+
+    def record(self, ok):
+        with self._lock:
+            self.probing = False
+            if ok:
+                if self.opened is not None and self.logger:
+                    self.logger.info("Circuit to %s closed." % self.host)
+                self.failures = 0
+                self.opened = None
+                return
+            self.failures = self.failures + 1
+            if self.opened is not None or self.failures >= BREAKER_THRESHOLD:
+                if self.opened is None and self.logger:
+                    self.logger.warning(
+                        "Circuit to %s opened after %d failures." %
+                        (self.host, self.failures))
+                if self.opened is None and self.metrics:
+                    self.metrics.incr("http_circuit_opens_total",
+                                      host=self.host)
+                self.opened = time.monotonic()
+
+
+class HTTPClient(object):
+    """Thread-safe HTTP client with a shared connection pool, per-host
+    adaptive concurrency and circuit breaking, and jittered retries.
+    get() and post() take the same arguments as their requests.Session
+    counterparts, plus max_timeout: if given, a timed-out request is
+    retried with double the timeout, up to max_timeout; and retries, the
+    most times a failed request is retried.  A file given as data is sent
+    from its start on every attempt.
+    """
+
+    def __init__(self, concurrency=1, logger=None, metrics=None):
+        self.logger = logger
+        self.metrics = metrics
+        self.concurrency = max(1, concurrency)
+        poolsize = max(10, 2 * self.concurrency)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4,
+                                                pool_maxsize=poolsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method, url, max_timeout=None, retries=MAX_RETRIES,
+                **kwargs):
+        """Send a request, retrying failures that are safe to retry.
+        Returns the last response, or raises the last exception if no
+        response was received.
+        """
+        idempotent = method in ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+        limiter, breaker = self._get_host(url)
+        data = kwargs.get("data")
+        attempt = 0
+        while True:
+            if hasattr(data, "seek"):
+                data.seek(0)
+            breaker.wait()
+            limiter.acquire()
+            start = time.monotonic()
+            resp = None
+            exc = None
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                exc = e
+            latency = time.monotonic() - start
+            ok = exc is None and resp.status_code not in RETRY_STATUSES
+            limiter.release(latency if ok else None, ok)
+            breaker.record(ok)
+            if self.metrics:
+                self._record(method, url, kwargs, resp, exc, latency)
+            if ok:
+                return resp
+            if not self._retryable(idempotent, resp, exc):
+                break
+            if attempt >= retries:
+                break
+            if (isinstance(exc, requests.exceptions.Timeout) and
+                    max_timeout and kwargs.get("timeout")):
+                kwargs["timeout"] = min(kwargs["timeout"] * 2, max_timeout)
+            delay = self._backoff(attempt, resp)
+            if self.metrics:
+                self.metrics.incr("http_retries_total",
+                                  host=urlparse(url).netloc,
+                                  reason=(type(exc).__name__ if exc else
+                                          str(resp.status_code)))
+            if resp is not None:
+                # Give the connection back if the body was not read.
+                resp.close()
+            if self.logger:
+                if exc is not None:
+                    reason = str(exc)
+                else:
+                    reason = "HTTP %d" % resp.status_code
+                self.logger.warning("%s %s failed (%s); retry %d in %.1f s" %
+                                    (method, url, reason, attempt + 1, delay))
+            time.sleep(delay)
+            attempt = attempt + 1
+        if exc is not None:
+            raise exc
+        return resp
+
+    def _record(self, method, url, kwargs, resp, exc, latency):
+        metrics = self.metrics
+        host = urlparse(url).netloc
+        if exc is not None:
+            status = type(exc).__name__
+        else:
+            status = str(resp.status_code)
+            # The body may not have been read yet, so this is the size as
+            #  sent, which for a compressed response is the smaller one.
+            length = resp.headers.get("Content-Length")
+            if length and length.isdigit():
+                metrics.incr("http_bytes_received_total", int(length),
+                             host=host)
+        metrics.incr("http_requests_total", host=host, method=method,
+                     status=status)
+        metrics.observe("http_request_seconds", latency, host=host,
+                        method=method)
+        data = kwargs.get("data")
+        if isinstance(data, bytes):
+            metrics.incr("http_bytes_sent_total", len(data), host=host)
+        elif hasattr(data, "seek"):
+            # A file, rewound before it is sent again.
+            metrics.incr("http_bytes_sent_total", data.seek(0, 2), host=host)
+
+    def _retryable(self, idempotent, resp, exc):
+        if exc is not None:
+            # Only a connection that timed out is known never to have
+            #  reached the server.
+            return (idempotent or
+                    isinstance(exc, requests.exceptions.ConnectTimeout))
+        if idempotent:
+            return True
+        return resp.status_code in UNPROCESSED_STATUSES
+
+    def _backoff(self, attempt, resp):
+        if resp is not None:
+            retry_after = resp.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    return min(float(retry_after), MAX_BACKOFF)
+                except ValueError:
+                    pass
+        return random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt))
+
+    def _get_host(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = (
+                    AdaptiveLimiter(self.concurrency, 2 * self.concurrency),
+                    CircuitBreaker(logger=self.logger, host=host,
+                                   metrics=self.metrics))
+            return self._hosts[host]
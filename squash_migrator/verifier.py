@@ -0,0 +1,180 @@
+"""Check that the new service holds the jobs the job map says were loaded.
+"""
+import hashlib
+import json
+import logging
+import os
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from . import codec
+from .actuator import Actuator
+from .manifest import LOADED
+from .store import open_store
+
+# Outcomes of verifying one job.
+VERIFIED = "ok"
+MISSING = "missing"
+DIVERGENT = "divergent"
+UNVERIFIED = "failed"
+# Seconds to wait for one job from the new service.
+VERIFY_TIMEOUT = 60
+# Significant digits to which measurement values must agree; the new
+#  service may store them at a different precision.
+VALUE_DIGITS = 12
+
+
+class Verifier(Actuator):
+    """Class to fetch loaded jobs back from the new service and compare
+    them with the transformed jobs they were loaded from.
+    """
+    stage = "verify"
+
+    def __init__(self, context=None):
+        super().__init__(context=context)
+        self.input_store = open_store(context, "transformed")
+        self.to_url = context.to_url
+        logger = logging.getLogger(__name__)
+        logger.setLevel(context.loglevel)
+        self.logger = logger
+        self.jobmap = None
+
+    def verify(self):
+        """Fetch every job in the job map (or those of the context's job
+        numbers) from the new service, several at once, and compare the
+        digest of each, normalized with normalize_job, with that of its
+        transformed job.  Writes a report to verify.json in the working
+        directory and returns a dict of outcome to sorted old job numbers.
+        """
+        self.jobmap = self.context.jobmap
+        jobs = sorted(self.jobmap.items())
+        if self.job_numbers:
+            jobs = [(j, n) for j, n in jobs if j in self.job_numbers]
+        results = dict((outcome, []) for outcome in
+                       (VERIFIED, MISSING, DIVERGENT, UNVERIFIED))
+        if not jobs:
+            self.logger.error("No loaded jobs in %s to verify." %
+                              self.jobmap.mapfile)
+            return results
+        self.metrics.stage_started(self.stage)
+        so_far = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.context.workers,
+                                    thread_name_prefix=self.stage
+                                    ) as executor:
+                futures = [executor.submit(self.verify_job, jobnum,
+                                           new_jobnum)
+                           for jobnum, new_jobnum in jobs]
+                for future in as_completed(futures):
+                    jobnum, outcome, message = future.result()
+                    results[outcome].append(jobnum)
+                    self.count_job(outcome)
+                    so_far = so_far + 1
+                    if outcome == VERIFIED:
+                        self.logger.debug("Job %d verified." % jobnum)
+                    else:
+                        self.logger.warning("Job %d: %s" % (jobnum, message))
+                    if so_far % 100 == 0:
+                        self.logger.info("%s: %d/%d verified" %
+                                         (self.to_url, so_far, len(jobs)))
+        finally:
+            self.metrics.stage_finished(self.stage)
+        for jobnums in results.values():
+            jobnums.sort()
+        self.logger.info("%d/%d jobs verified; %d missing, " %
+                         (len(results[VERIFIED]), len(jobs),
+                          len(results[MISSING])) +
+                         "%d divergent, %d could not be checked." %
+                         (len(results[DIVERGENT]), len(results[UNVERIFIED])))
+        self._write_report(results)
+        return results
+
+    def verify_job(self, jobnum, new_jobnum):
+        """Compare one transformed job with the new service's copy of it.
+        Returns a tuple of the job number, the outcome, and a message.
+        """
+        try:
+            with self.metrics.timer("json_decode_seconds", stage=self.stage):
+                local = self.input_store.read(jobnum)
+        except (KeyError, OSError, ValueError) as exc:
+            return (jobnum, UNVERIFIED, "could not read '%s': %s" %
+                    (self.input_store.location(jobnum), str(exc)))
+        url = "%s/job/%d" % (self.to_url, new_jobnum)
+        try:
+            resp = self.context.authorized_request("GET", url,
+                                                   timeout=VERIFY_TIMEOUT)
+        except requests.exceptions.RequestException as exc:
+            return (jobnum, UNVERIFIED, "could not fetch '%s': %s" %
+                    (url, str(exc)))
+        if resp.status_code == 404:
+            return (jobnum, MISSING, "'%s' not found" % url)
+        if resp.status_code != requests.codes.ok:
+            return (jobnum, UNVERIFIED, "'%s': HTTP %d" %
+                    (url, resp.status_code))
+        try:
+            with self.metrics.timer("json_decode_seconds", stage=self.stage):
+                remote = codec.response_json(resp)
+        except json.decoder.JSONDecodeError as exc:
+            return (jobnum, UNVERIFIED, "bad JSON from '%s': %s" %
+                    (url, str(exc)))
+        if job_digest(local) != job_digest(remote):
+            return (jobnum, DIVERGENT, "'%s' differs from '%s'" %
+                    (url, self.input_store.location(jobnum)))
+        return (jobnum, VERIFIED, None)
+
+    def requeue(self, jobnums):
+        """Forget that the given jobs were loaded, so that the next load
+        sends them again.
+        """
+        if not jobnums:
+            return
+        self.context.jobmap.remove(jobnums)
+        for jobnum in jobnums:
+            self.manifest.forget(jobnum, LOADED)
+            self.manifest.mark_failed(jobnum, LOADED, "failed verification")
+        self.manifest.flush()
+        self.logger.info("%d jobs queued to be loaded again." % len(jobnums))
+
+    def _write_report(self, results):
+        fname = os.path.join(self.directory, "verify.json")
+        try:
+            with open(fname + ".tmp", "w") as f:
+                json.dump(results, f, indent=4, sort_keys=True)
+            os.replace(fname + ".tmp", fname)
+        except OSError as exc:
+            self.logger.warning("Could not write '%s': %s" %
+                                (fname, str(exc)))
+
+
+def normalize_job(job):
+    """Reduce a job, either as transformed or as the new service returns
+    it, to the content both must share: its measurements (metric and
+    value, in a fixed order), its environment, and the names of its
+    packages.  Blobs are left out, since the service may hold them apart
+    from the job and skip_known_blobs leaves them out of uploads.
+    """
+    meta = job.get("meta") or {}
+    env = meta.get("env", job.get("env")) or {}
+    packages = meta.get("packages", job.get("packages")) or []
+    if isinstance(packages, dict):
+        names = list(packages)
+    else:
+        names = [p.get("name") if isinstance(p, dict) else p
+                 for p in packages]
+    measurements = []
+    for meas in job.get("measurements") or []:
+        value = meas.get("value")
+        if (isinstance(value, (int, float)) and
+                not isinstance(value, bool)):
+            value = "%.*g" % (VALUE_DIGITS, value)
+        measurements.append([meas.get("metric"), value])
+    measurements.sort(key=repr)
+    return {"env": env,
+            "measurements": measurements,
+            "packages": sorted(names, key=repr)}
+
+
+def job_digest(job):
+    """Return a digest of the normalized form of a job.
+    """
+    data = codec.dumps(normalize_job(job), compact=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
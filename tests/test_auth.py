@@ -0,0 +1,145 @@
+"""Tests for getting, caching, and renewing the token for the new service.
+"""
+import base64
+import json
+import logging
+import os
+import time
+from squash_migrator.auth import TOKEN_CACHE, TokenSource
+from squash_migrator.context import Context
+
+NEW_URL = "http://new.example"
+
+
+def make_token(name, lifetime=3600):
+    now = time.time()
+    claims = json.dumps({"iat": now, "exp": now + lifetime, "name": name})
+    payload = base64.urlsafe_b64encode(claims.encode("utf-8"))
+    return "h." + payload.decode("ascii").rstrip("=") + ".s"
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, obj=None):
+        self.status_code = status_code
+        self.headers = {}
+        self._obj = obj
+
+    def json(self):
+        return self._obj
+
+    def close(self):
+        pass
+
+
+class FakeService(object):
+    """Stands in for the new service's HTTP session.  It hands out a new
+    token on each authentication, and answers requests for /job with 200
+    if they carry a token issued at or after index accept_from, and with
+    401 otherwise.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.issued = []
+        self.accept_from = None
+
+    def request(self, method, url, headers=None, **kwargs):
+        path = url[len(NEW_URL):]
+        self.requests.append((method, path))
+        if path.startswith("/user/"):
+            return FakeResponse(200)
+        if path == "/auth":
+            token = make_token("t%d" % len(self.issued))
+            self.issued.append(token)
+            return FakeResponse(200, {"access_token": token})
+        token = (headers or {}).get("Authorization", "")[len("JWT "):]
+        if (self.accept_from is not None and
+                token in self.issued[self.accept_from:]):
+            return FakeResponse(200)
+        return FakeResponse(401)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def count(self, path):
+        return len([r for r in self.requests if r[1] == path])
+
+
+def write_cache(tmp_path, token, user="u"):
+    with open(os.path.join(str(tmp_path), TOKEN_CACHE), "w") as f:
+        json.dump({"url": NEW_URL, "user": user, "token": token}, f)
+
+
+def make_source(tmp_path, service):
+    return TokenSource(service, NEW_URL, user="u", password="p",
+                       directory=str(tmp_path))
+
+
+def test_no_request_until_a_token_is_needed(tmp_path):
+    service = FakeService()
+    source = make_source(tmp_path, service)
+    assert service.requests == []
+    token = source.get_token()
+    assert token == service.issued[0]
+    assert source.get_token() == token
+    assert service.count("/auth") == 1
+
+
+def test_cached_token_is_reused(tmp_path):
+    service = FakeService()
+    cached = make_token("cached")
+    write_cache(tmp_path, cached)
+    assert make_source(tmp_path, service).get_token() == cached
+    assert service.requests == []
+
+
+def test_cached_token_is_not_used_when_expired_or_for_another_user(tmp_path):
+    service = FakeService()
+    write_cache(tmp_path, make_token("old", lifetime=-10))
+    assert make_source(tmp_path, service).get_token() == service.issued[0]
+    write_cache(tmp_path, make_token("other"), user="someone else")
+    assert make_source(tmp_path, service).get_token() == service.issued[1]
+
+
+def test_new_token_is_cached_for_the_owner_only(tmp_path):
+    service = FakeService()
+    token = make_source(tmp_path, service).get_token()
+    cache_file = os.path.join(str(tmp_path), TOKEN_CACHE)
+    assert os.stat(cache_file).st_mode & 0o777 == 0o600
+    with open(cache_file, "r") as f:
+        cached = json.load(f)
+    assert cached == {"url": NEW_URL, "user": "u", "token": token}
+    assert "p" not in cached.values()
+
+
+def make_context(tmp_path, service):
+    context = Context(user="u", password="p", loglevel=logging.WARNING,
+                      directory=str(tmp_path), to_url=NEW_URL)
+    context.http.session = service
+    return context
+
+
+def test_rejected_token_is_renewed_and_the_request_sent_once_more(tmp_path):
+    service = FakeService()
+    context = make_context(tmp_path, service)
+    first = context._auth.get_token()
+    # The service stops taking the first token, but takes the next.
+    service.accept_from = 1
+    resp = context.authorized_request("POST", NEW_URL + "/job", json={})
+    assert resp.status_code == 200
+    assert service.count("/job") == 2
+    assert service.count("/auth") == 2
+    assert context._auth.get_token() != first
+
+
+def test_second_rejection_is_returned_not_retried(tmp_path):
+    service = FakeService()
+    context = make_context(tmp_path, service)
+    resp = context.authorized_request("POST", NEW_URL + "/job", json={})
+    assert resp.status_code == 401
+    assert service.count("/job") == 2
+    assert service.count("/auth") == 2
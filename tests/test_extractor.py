@@ -0,0 +1,160 @@
+"""Tests for page sizing and resumable bulk extraction.
+"""
+import json
+import logging
+from urllib.parse import urlparse, parse_qs
+import pytest
+import requests
+from squash_migrator.context import Context
+from squash_migrator.extractor import BULK_CHECKPOINT, PAGE_ATTEMPTS, \
+    Extractor, PageSizer
+from squash_migrator.manifest import EXTRACTED, Manifest
+
+OLD_URL = "http://old.example"
+
+
+class FakeResponse(object):
+
+    def __init__(self, obj):
+        self.content = json.dumps(obj).encode("utf-8")
+        self.headers = {"Content-Length": str(len(self.content))}
+        self.status_code = 200
+        self.url = None
+        self.text = self.content.decode("utf-8")
+
+
+class FakeListing(object):
+    """Stands in for the shared HTTP client, serving count jobs, one at a
+    time or in a paged listing, and failing requests for the (page, page
+    size) pairs in fail.  A newest-first listing leaves "next" out of its
+    last page.
+    """
+
+    def __init__(self, count, fail=(), newest_first=False):
+        self.count = count
+        self.fail = set(fail)
+        self.newest_first = newest_first
+        self.requested = []
+
+    def get(self, url, **kwargs):
+        parsed = urlparse(url)
+        if parsed.path.strip("/") != "jobs":
+            self.requested.append(url)
+            return FakeResponse(self._job(int(parsed.path.split("/")[2])))
+        query = parse_qs(parsed.query)
+        page = int(query.get("page", ["1"])[0])
+        size = int(query.get("page_size", ["10"])[0])
+        self.requested.append((page, size))
+        if (page, size) in self.fail:
+            raise requests.exceptions.ConnectionError("page %d" % page)
+        first = (page - 1) * size
+        jobnums = range(first + 1, min(first + size, self.count) + 1)
+        if self.newest_first:
+            jobnums = [self.count + 1 - n for n in jobnums]
+        nexturl = None
+        if first + size < self.count:
+            nexturl = "%s/jobs/?page=%d&page_size=%d" % (OLD_URL, page + 1,
+                                                         size)
+        j_resp = {"count": self.count, "next": nexturl,
+                  "results": [self._job(n) for n in jobnums]}
+        if self.newest_first and nexturl is None:
+            del j_resp["next"]
+        return FakeResponse(j_resp)
+
+    def _job(self, jobnum):
+        return {"links": {"self": "%s/jobs/%d/" % (OLD_URL, jobnum)},
+                "measurements": [], "blobs": []}
+
+
+def extract(tmp_path, session, **kwargs):
+    context = Context(loglevel=logging.WARNING, directory=str(tmp_path),
+                      from_url=OLD_URL, min_page_size=10, max_page_size=10,
+                      **kwargs)
+    extractor = Extractor(context=context)
+    extractor.session = session
+    extractor.extract()
+    return context.manifest
+
+
+def test_page_sizes_double_up_to_max():
+    sizer = PageSizer(10, 100)
+    assert sizer.sizes == [10, 20, 40, 80]
+
+
+def test_page_sizer_grows_and_shrinks():
+    sizer = PageSizer(10, 100)
+    sizer.record(10, 0.1, 1000)
+    sizer.record(20, 0.1, 1000)
+    assert sizer.size == 40
+    sizer.record(40, 60, 1000)
+    assert sizer.size == 20
+    sizer.shrink()
+    sizer.shrink()
+    assert sizer.size == 10
+
+
+@pytest.mark.parametrize("offset, expected", [(0, 40), (40, 40), (60, 20),
+                                              (70, 10)])
+def test_page_sizer_aligns_pages(offset, expected):
+    sizer = PageSizer(10, 100)
+    sizer.level = 2
+    assert sizer.size_at(offset) == expected
+    # Every page ends where a page of any smaller size can start.
+    for smaller in sizer.sizes[:sizer.level]:
+        assert (offset + expected) % smaller == 0
+
+
+def test_page_sizer_limit():
+    sizer = PageSizer(10, 100)
+    sizer.level = 3
+    sizer.limit(25, 80)
+    assert sizer.sizes == [10, 20]
+    assert sizer.size == 20
+
+
+def test_resume_fetches_only_missing_pages(tmp_path):
+    # The last page fails every attempt, so the first run stops short.
+    failing = FakeListing(55, fail=[(6, 10)])
+    manifest = extract(tmp_path, failing)
+    assert manifest.jobnums(EXTRACTED) == list(range(1, 51))
+    assert manifest.get_checkpoint(BULK_CHECKPOINT)["done"] == [[0, 50]]
+    assert manifest.get_high_water_mark() is None
+    manifest.close()
+    working = FakeListing(55)
+    manifest = extract(tmp_path, working)
+    # The first page, for the count, and then only the missing one.
+    assert working.requested == [(1, 10), (6, 10)]
+    assert manifest.jobnums(EXTRACTED) == list(range(1, 56))
+    assert manifest.get_checkpoint(BULK_CHECKPOINT) is None
+    assert manifest.get_high_water_mark() == 55
+
+
+def test_resume_after_skipping_a_middle_page(tmp_path):
+    failing = FakeListing(55, fail=[(3, 10)])
+    manifest = extract(tmp_path, failing)
+    assert failing.requested.count((3, 10)) == PAGE_ATTEMPTS
+    assert manifest.get_checkpoint(BULK_CHECKPOINT)["done"] == [[0, 20],
+                                                                [30, 55]]
+    manifest.close()
+    working = FakeListing(55)
+    manifest = extract(tmp_path, working)
+    assert working.requested == [(1, 10), (3, 10)]
+    assert manifest.jobnums(EXTRACTED) == list(range(1, 56))
+    assert manifest.get_high_water_mark() == 55
+
+
+def test_individual_jobs_leave_no_high_water_mark(tmp_path):
+    manifest = extract(tmp_path, FakeListing(55), job_numbers={40})
+    assert manifest.jobnums(EXTRACTED) == [40]
+    assert manifest.get_high_water_mark() is None
+
+
+def test_incremental_newest_first_listing_without_next(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    manifest.set_high_water_mark(0)
+    manifest.close()
+    listing = FakeListing(15, newest_first=True)
+    manifest = extract(tmp_path, listing, incremental=True)
+    assert listing.requested == [(1, 10), (2, 10)]
+    assert manifest.jobnums(EXTRACTED) == list(range(1, 16))
+    assert manifest.get_high_water_mark() == 15
@@ -0,0 +1,62 @@
+"""Tests for the journaled map of old to new job numbers.
+"""
+import json
+import os
+from squash_migrator import jobmap
+from squash_migrator.jobmap import JobMap
+
+
+def test_pairs_survive_reopening(tmp_path):
+    directory = str(tmp_path)
+    jobs = JobMap(directory)
+    jobs.add(1, 101)
+    jobs.add(2, 102)
+    # Not closed, as after a crash: the pairs are in the journal only.
+    assert not os.path.exists(jobs.mapfile)
+    reopened = JobMap(directory)
+    assert dict(reopened.items()) == {1: 101, 2: 102}
+
+
+def test_torn_journal_line_is_skipped(tmp_path):
+    directory = str(tmp_path)
+    jobs = JobMap(directory)
+    jobs.add(1, 101)
+    jobs.add(2, 102)
+    with open(jobs.journal, "a") as f:
+        f.write("3")
+    reopened = JobMap(directory)
+    assert dict(reopened.items()) == {1: 101, 2: 102}
+    # Later additions are not lost behind the bad line.
+    reopened.add(4, 104)
+    assert dict(JobMap(directory).items()) == {1: 101, 2: 102, 4: 104}
+
+
+def test_journal_is_compacted(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobmap, "COMPACT_INTERVAL", 3)
+    directory = str(tmp_path)
+    jobs = JobMap(directory)
+    for jobnum in range(1, 5):
+        jobs.add(jobnum, 100 + jobnum)
+    # The first three were folded into the map file.
+    with open(jobs.mapfile, "r") as f:
+        assert json.load(f) == {"1": 101, "2": 102, "3": 103}
+    with open(jobs.journal, "r") as f:
+        assert f.read() == "4 104\n"
+    jobs.close()
+    assert not os.path.exists(jobs.journal)
+    assert dict(JobMap(directory).items()) == {1: 101, 2: 102, 3: 103,
+                                               4: 104}
+
+
+def test_removals_are_journaled(tmp_path):
+    directory = str(tmp_path)
+    jobs = JobMap(directory)
+    jobs.add(1, 101)
+    jobs.add(2, 102)
+    jobs.close()
+    jobs.remove([1, 3])
+    assert 1 not in jobs
+    assert dict(JobMap(directory).items()) == {2: 102}
+    # A job loaded again after its removal is mapped again.
+    jobs.add(1, 201)
+    assert dict(JobMap(directory).items()) == {1: 201, 2: 102}
@@ -0,0 +1,28 @@
+"""Tests for decoding JSON or Python literal metadata.
+"""
+import pytest
+from squash_migrator import literal
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"a": [1, 2.5, null]}', {"a": [1, 2.5, None]}),
+    ("{'a': [1, 2.5, None]}", {"a": [1, 2.5, None]}),
+    ("{u'filter_name': u'r', 'x': (1, 2)}", {"filter_name": "r",
+                                              "x": (1, 2)}),
+    ("  {'quoted': \"it's\"}\n", {"quoted": "it's"}),
+])
+def test_decode(text, expected):
+    assert literal.decode(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "__import__('os').system('true')",
+    "open('/etc/passwd').read()",
+    "{'a': x}",
+    "[i for i in range(3)]",
+    "{'a': 1} if True else {}",
+    "not json",
+])
+def test_decode_rejects_expressions(text):
+    with pytest.raises(ValueError):
+        literal.decode(text)
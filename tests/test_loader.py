@@ -0,0 +1,94 @@
+"""Tests for concurrent loading and upload status polling.
+"""
+import logging
+import threading
+from squash_migrator import loader as loader_module
+from squash_migrator.context import Context
+from squash_migrator.loader import Loader
+from squash_migrator.manifest import LOADED
+
+NEW_URL = "http://new.example"
+
+
+class FakeResponse(object):
+
+    def __init__(self, obj):
+        self.status_code = 200
+        self.headers = {}
+        self._obj = obj
+
+    def json(self):
+        return self._obj
+
+    def close(self):
+        pass
+
+
+class FakeStatus(object):
+    """Stands in for the HTTP session, answering status checks with the
+    status in statuses for the job at the end of the link, or with no
+    status at all if that is None.
+    """
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    def request(self, method, url, **kwargs):
+        jobnum = int(url.rsplit("/", 1)[1])
+        status = self.statuses[jobnum]
+        return FakeResponse({} if status is None else {"status": status})
+
+
+def make_loader(tmp_path, monkeypatch, statuses, max_uploads):
+    monkeypatch.setattr(loader_module, "MIN_POLL_DELAY", 0.01)
+    monkeypatch.setattr(loader_module, "MAX_POLL_DELAY", 0.02)
+    monkeypatch.setattr(loader_module, "MAX_POLL_TIME", 0.5)
+    context = Context(token="t", loglevel=logging.CRITICAL,
+                      directory=str(tmp_path), to_url=NEW_URL,
+                      max_uploads=max_uploads, workers=4)
+    context.http.session = FakeStatus(statuses)
+    loader = Loader(context=context)
+    loader.outstanding = []
+    lock = threading.Lock()
+
+    def post_job(jobnum):
+        # Uploads are outstanding from here until they resolve.
+        with lock:
+            loader.outstanding.append(len(loader._poller.pending) + 1)
+        with loader._lock:
+            loader._new_jobnums[jobnum] = (jobnum, 100 + jobnum)
+        return "%s/status/%d" % (NEW_URL, jobnum)
+
+    loader._post_job = post_job
+    return loader
+
+
+def test_failed_and_unfinished_uploads_free_their_slots(tmp_path,
+                                                        monkeypatch):
+    # Job 2 fails, and job 3 never finishes.
+    statuses = {1: "SUCCESS", 2: "FAILURE", 3: "PENDING", 4: "SUCCESS"}
+    loader = make_loader(tmp_path, monkeypatch, statuses, max_uploads=2)
+    assert loader.start()
+    for jobnum in sorted(statuses):
+        loader.submit(jobnum)
+    loader.finish()
+    # Every slot was given back.
+    for _ in range(2):
+        assert loader._outstanding.acquire(blocking=False)
+    assert max(loader.outstanding) <= 2
+    manifest = loader.manifest
+    assert manifest.jobnums(LOADED) == [1, 4]
+    assert manifest.failures() == {2: (LOADED, "upload failed"),
+                                   3: (LOADED, "upload failed")}
+    assert dict(loader.jobmap.items()) == {1: 101, 4: 104}
+
+
+def test_status_check_errors_do_not_stop_the_poller(tmp_path, monkeypatch):
+    statuses = {1: None, 2: "SUCCESS"}
+    loader = make_loader(tmp_path, monkeypatch, statuses, max_uploads=1)
+    assert loader.start()
+    loader.submit(1)
+    loader.submit(2)
+    loader.finish()
+    assert loader.manifest.jobnums(LOADED) == [2]
+    assert list(loader.manifest.failures()) == [1]
@@ -0,0 +1,31 @@
+"""Tests for reading command-line options from the environment.
+"""
+import sys
+import pytest
+from squash_migrator.defaults import SQUASH_MIGRATOR_NAMESPACE
+from squash_migrator.main import get_options
+
+
+def options(monkeypatch, *args, **environ):
+    monkeypatch.setattr(sys, "argv", ["squash-migrator"] + list(args))
+    for name, value in environ.items():
+        monkeypatch.setenv(SQUASH_MIGRATOR_NAMESPACE + name, value)
+    return get_options()
+
+
+@pytest.mark.parametrize("value", ["1", "true", "TRUE", "yes", "Yes "])
+def test_flags_are_turned_on_in_the_environment(monkeypatch, value):
+    assert options(monkeypatch, PIPELINE=value).pipeline
+
+
+@pytest.mark.parametrize("value", ["", "0", "false", "no", "off"])
+def test_flags_are_left_off_in_the_environment(monkeypatch, value):
+    params = options(monkeypatch, PIPELINE=value, VERIFY=value)
+    assert not params.pipeline
+    assert not params.verify
+
+
+def test_verify_has_no_short_option(monkeypatch):
+    assert options(monkeypatch, "--verify").verify
+    with pytest.raises(SystemExit):
+        options(monkeypatch, "-V")
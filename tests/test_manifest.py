@@ -0,0 +1,107 @@
+"""Tests for the per-job stage manifest.
+"""
+import logging
+import sqlite3
+import pytest
+from squash_migrator.context import Context
+from squash_migrator.manifest import EXTRACTED, LOADED, TRANSFORMED, \
+    Manifest
+from squash_migrator.store import open_store
+
+
+def test_mark_keeps_what_was_known(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    manifest.mark(1, EXTRACTED, size=100)
+    manifest.mark_failed(1, TRANSFORMED, "bad")
+    assert manifest.failures() == {1: (TRANSFORMED, "bad")}
+    # Found already present: the size written before is kept.
+    manifest.mark(1, EXTRACTED)
+    manifest.mark(1, TRANSFORMED, size=50)
+    manifest.mark(1, LOADED, new_jobnum=7)
+    manifest.close()
+    manifest = Manifest(str(tmp_path))
+    assert manifest.failures() == {}
+    for state in (EXTRACTED, TRANSFORMED, LOADED):
+        assert manifest.jobnums(state) == [1]
+    row = manifest._conn.execute(
+        "SELECT extracted_size, transformed_size, new_jobnum FROM jobs"
+    ).fetchone()
+    assert row == (100, 50, 7)
+    manifest.forget(1, LOADED)
+    assert manifest.jobnums(LOADED) == []
+
+
+def test_checkpoints_are_saved_with_the_marks(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    manifest.mark(1, EXTRACTED, size=10)
+    manifest.save_checkpoint("bulk", {"done": [[0, 1]]})
+    # Neither is written until the buffer is flushed.
+    other = Manifest(str(tmp_path))
+    assert other.get_checkpoint("bulk") is None
+    assert other.jobnums(EXTRACTED) == []
+    manifest.flush()
+    assert other.get_checkpoint("bulk") == {"done": [[0, 1]]}
+    assert other.jobnums(EXTRACTED) == [1]
+    manifest.clear_checkpoint("bulk")
+    assert manifest.get_checkpoint("bulk") is None
+
+
+@pytest.mark.parametrize("store", ["directory", "sqlite"])
+def test_rebuild_from_the_stores_keeps_digests(tmp_path, store):
+    context = Context(loglevel=logging.WARNING, directory=str(tmp_path),
+                      store=store)
+    jobs = open_store(context, "jobs")
+    transformed = open_store(context, "transformed")
+    for jobnum in (1, 2, 3):
+        jobs.write(jobnum, {"_job_number": jobnum})
+    for jobnum in (1, 2):
+        transformed.write(jobnum, {"_job_number": jobnum})
+    context.jobmap.add(1, 101)
+    manifest = context.manifest
+    assert manifest.jobnums(EXTRACTED) == [1, 2, 3]
+    assert manifest.jobnums(TRANSFORMED) == [1, 2]
+    assert manifest.jobnums(LOADED) == [1]
+    manifest.set_fingerprint(1, "in1", "fp1", [["AF1", None, None]])
+    manifest.save_checkpoint("bulk", {"done": []})
+    # Recorded, but not in the store.
+    manifest.mark(3, TRANSFORMED, size=10)
+    manifest.rebuild(jobs, transformed, context.jobmap)
+    assert manifest.jobnums(TRANSFORMED) == [1, 2]
+    assert manifest.fingerprints() == {1: ("in1", "fp1",
+                                           [["AF1", None, None]]),
+                                       2: (None, None, None)}
+    assert manifest.get_checkpoint("bulk") is None
+    row = manifest._conn.execute(
+        "SELECT new_jobnum FROM jobs WHERE jobnum = 1").fetchone()
+    assert row == (101,)
+
+
+def test_old_manifest_gains_new_columns(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "manifest.sqlite"))
+    conn.execute("CREATE TABLE jobs (jobnum INTEGER PRIMARY KEY, " +
+                 "extracted REAL, extracted_size INTEGER, " +
+                 "transformed REAL, transformed_size INTEGER, " +
+                 "loaded REAL, new_jobnum INTEGER, " +
+                 "failed TEXT, error TEXT, updated REAL)")
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("INSERT INTO jobs (jobnum, extracted, transformed) " +
+                 "VALUES (5, 1, 1)")
+    conn.execute("INSERT INTO meta VALUES ('built', '1')")
+    conn.commit()
+    conn.close()
+    manifest = Manifest(str(tmp_path))
+    assert manifest.built
+    assert manifest.fingerprints() == {5: (None, None, None)}
+    manifest.set_fingerprint(5, "in5", "fp5", [])
+    assert manifest.fingerprints() == {5: ("in5", "fp5", [])}
+
+
+def test_high_water_mark_never_goes_down(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    assert manifest.get_high_water_mark() is None
+    manifest.set_high_water_mark(50)
+    manifest.set_high_water_mark(40)
+    assert manifest.get_high_water_mark() == 50
+    manifest.set_high_water_mark(60)
+    manifest.close()
+    assert Manifest(str(tmp_path)).get_high_water_mark() == 60
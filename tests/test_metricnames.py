@@ -0,0 +1,75 @@
+"""Tests for resolving old metrics, specs, and filters to new names.
+"""
+import json
+import pytest
+from squash_migrator.metricnames import WILDCARD, MetricNameIndex
+
+NAMES = {("AF1", "design", "r"): "AF1_design",
+         ("AF1", "minimum", "r"): "AF1_minimum",
+         ("AF1", "minimum", "g"): "AF1_minimum",
+         ("PA1", "design", "r"): "PA1_design"}
+
+
+def from_file(tmp_path, entries):
+    fname = str(tmp_path / "names.json")
+    with open(fname, "w") as f:
+        json.dump(entries, f)
+    return MetricNameIndex.from_file(fname, names=NAMES)
+
+
+def test_exact_match():
+    index = MetricNameIndex(NAMES)
+    assert index.resolve("AF1", "design", "r") == "AF1_design"
+
+
+def test_derived_fallbacks():
+    index = MetricNameIndex(NAMES)
+    # Every known filter of AF1 minimum maps to one name.
+    assert index.resolve("AF1", "minimum", "i") == "AF1_minimum"
+    # PA1 has one name whatever the spec.
+    assert index.resolve("PA1", "stretch", None) == "PA1_design"
+    # AF1's specs disagree, and nothing is known of AM1.
+    assert index.resolve("AF1", "stretch", "r") == "AF1"
+    assert index.resolve("AM1", None, None) == "AM1"
+
+
+def test_wildcard_fallbacks():
+    names = dict(NAMES)
+    names[("AF1", WILDCARD, WILDCARD)] = "AF1_any"
+    names[("AF1", "design", WILDCARD)] = "AF1_design_any"
+    index = MetricNameIndex(names)
+    assert index.resolve("AF1", "design", "i") == "AF1_design_any"
+    assert index.resolve("AF1", "stretch", "r") == "AF1_any"
+    assert index.resolve("AF1", "design", "r") == "AF1_design"
+
+
+def test_file_wildcard_overrides_built_in_names(tmp_path):
+    index = from_file(tmp_path, [{"metric": "AF1", "spec": "*",
+                                  "filter": "*", "name": "AF1_new"}])
+    assert index.resolve("AF1", "design", "r") == "AF1_new"
+    assert index.resolve("AF1", "minimum", "g") == "AF1_new"
+    assert index.resolve("PA1", "design", "r") == "PA1_design"
+
+
+def test_file_spec_wildcard_overrides_that_spec_only(tmp_path):
+    index = from_file(tmp_path, [{"metric": "AF1", "spec": "design",
+                                  "filter": "*", "name": "AF1_d"}])
+    assert index.resolve("AF1", "design", "r") == "AF1_d"
+    assert index.resolve("AF1", "minimum", "r") == "AF1_minimum"
+
+
+def test_exact_file_entry_beats_file_wildcard(tmp_path):
+    index = from_file(tmp_path, [
+        {"metric": "AF1", "spec": "*", "name": "AF1_new"},
+        {"metric": "AF1", "spec": "design", "filter": "r",
+         "name": "AF1_exact"}])
+    assert index.resolve("AF1", "design", "r") == "AF1_exact"
+    assert index.resolve("AF1", "minimum", "r") == "AF1_new"
+
+
+@pytest.mark.parametrize("entries", [{"metric": "AF1"},
+                                     [{"metric": "AF1"}],
+                                     ["AF1"]])
+def test_bad_file_is_rejected(tmp_path, entries):
+    with pytest.raises(ValueError):
+        from_file(tmp_path, entries)
@@ -0,0 +1,98 @@
+"""Tests that both job stores behave alike.
+"""
+import io
+import logging
+import os
+import zlib
+import pytest
+from squash_migrator import codec
+from squash_migrator.context import Context
+from squash_migrator.store import STORE_TYPES, DirectoryStore, \
+    SQLiteStore, _InflatingReader, open_store
+
+JOB = {"_job_number": 3, "measurements": [{"metric": "AF1",
+                                          "value": 1.5}] * 50,
+       "meta": {"env": {"name": "été"}}, "blobs": []}
+
+
+@pytest.fixture(params=STORE_TYPES)
+def store(request, tmp_path):
+    context = Context(loglevel=logging.WARNING, directory=str(tmp_path),
+                      store=request.param, compact=True)
+    return open_store(context, "jobs")
+
+
+def test_round_trip(store):
+    store.write(3, JOB)
+    assert store.exists(3)
+    assert not store.exists(4)
+    assert store.read(3) == JOB
+    with store.reader(3) as fp:
+        assert codec.loads(fp.read()) == JOB
+    assert store.size(3) == len(codec.dumps(JOB, compact=True)
+                                .encode("utf-8"))
+    assert list(store.items()) == [(3, JOB)]
+
+
+def test_missing_jobs_raise_key_error(store):
+    for method in (store.read, store.reader, store.size):
+        with pytest.raises(KeyError):
+            method(5)
+
+
+def test_jobnums_are_sorted(store):
+    for jobnum in (10, 2, 33, 1):
+        store.write(jobnum, dict(JOB, _job_number=jobnum))
+    assert store.jobnums() == [1, 2, 10, 33]
+
+
+def test_writer_stores_only_complete_jobs(store):
+    text = codec.dumps(JOB, compact=True)
+    with store.writer(3) as out:
+        for start in range(0, len(text), 100):
+            out.write(text[start:start + 100])
+    assert store.read(3) == JOB
+    assert store.size(3) == len(text.encode("utf-8"))
+    with pytest.raises(ValueError):
+        with store.writer(4) as out:
+            out.write(text[:100])
+            raise ValueError("interrupted")
+    assert not store.exists(4)
+
+
+def test_stores_agree(tmp_path):
+    directory = DirectoryStore(str(tmp_path / "jobs"))
+    packed = SQLiteStore(str(tmp_path / "jobs.sqlite"))
+    for jobnum in (5, 1, 12):
+        for store in (directory, packed):
+            store.write(jobnum, dict(JOB, _job_number=jobnum))
+    # Files that are not whole jobs are not listed.
+    for name in ("job-7.json.tmp", "job-x.json", "notes.txt"):
+        with open(str(tmp_path / "jobs" / name), "w") as f:
+            f.write("{}")
+    assert directory.jobnums() == packed.jobnums() == [1, 5, 12]
+    assert list(directory.items()) == list(packed.items())
+
+
+@pytest.mark.parametrize("size", [1, 7, 4096])
+def test_inflating_reader_partial_reads(size):
+    data = os.urandom(2000) + b"x" * 50000
+    reader = _InflatingReader(zlib.compress(data))
+    out = io.BytesIO()
+    while True:
+        chunk = reader.read(size)
+        if not chunk:
+            break
+        assert len(chunk) <= size
+        out.write(chunk)
+    assert out.getvalue() == data
+    assert reader.read(size) == b""
+
+
+def test_sqlite_size_of_records_without_one(tmp_path):
+    store = SQLiteStore(str(tmp_path / "jobs.sqlite"))
+    store.write(3, JOB)
+    # As written before uncompressed sizes were recorded.
+    store._connect().execute("UPDATE jobs SET size = NULL")
+    assert store.size(3) == len(codec.dumps(JOB, compact=True)
+                                .encode("utf-8"))
@@ -0,0 +1,73 @@
+"""Tests for incremental JSON reading and writing.
+"""
+import io
+import json
+import pytest
+from squash_migrator import codec
+from squash_migrator import stream
+
+JOB = {"_job_number": 7,
+       "meta": {"env": {"name": "été", "n": [1, 2.5, None]},
+                "packages": []},
+       "measurements": [{"metric": "AF1", "value": 1.0e-12,
+                         "blob_refs": ["a", "b"]},
+                        {"metric": "PA1", "value": -3, "unit": None}],
+       "blobs": []}
+
+
+def write(obj, compact, segments=1):
+    with stream.ObjectWriter(compact=compact) as writer:
+        for key, value in obj.items():
+            if not isinstance(value, list):
+                writer.set(key, value)
+                continue
+            # Split each array across segments, some of them empty.
+            for index in range(segments):
+                array = writer.array(key)
+                for element in value[index::segments]:
+                    array.append(element)
+        out = io.StringIO()
+        writer.write(out)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("segments", [1, 3])
+def test_object_writer_matches_codec(compact, segments):
+    assert write(JOB, compact, segments) == codec.dumps(JOB, compact=compact)
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_object_writer_empty(compact):
+    assert write({}, compact) == codec.dumps({}, compact=compact)
+
+
+def test_object_writer_spools_large_arrays(monkeypatch):
+    monkeypatch.setattr(stream, "SPOOL_SIZE", 64)
+    job = dict(JOB, measurements=[{"metric": "m%d" % i, "value": i}
+                                  for i in range(500)])
+    assert write(job, False) == codec.dumps(job)
+
+
+def test_object_writer_rejects_nan():
+    with stream.ObjectWriter(compact=True, allow_nan=False) as writer:
+        with pytest.raises(ValueError):
+            writer.array("measurements").append({"value": float("nan")})
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 65536])
+def test_iter_object_matches_loads(monkeypatch, chunk_size):
+    monkeypatch.setattr(stream, "CHUNK_SIZE", chunk_size)
+    data = codec.dumps(JOB).encode("utf-8")
+    found = {}
+    for key, value in stream.iter_object(io.BytesIO(data),
+                                         stream.JOB_ARRAYS):
+        if key in stream.JOB_ARRAYS:
+            value = list(value)
+        found[key] = value
+    assert found == json.loads(data)
+
+
+def test_iter_object_rejects_bad_input():
+    with pytest.raises(ValueError):
+        list(stream.iter_object(io.BytesIO(b'{"a": 1,}')))
@@ -0,0 +1,126 @@
+"""Tests that streamed and in-memory transformation agree, and that
+transformed jobs are fingerprinted by the metrics they use.
+"""
+import io
+import json
+import logging
+import time
+import pytest
+import requests
+from squash_migrator import codec
+from squash_migrator.context import Context
+from squash_migrator.jobmap import JobMap
+from squash_migrator.manifest import EXTRACTED, LOADED
+from squash_migrator.transformer import METRIC_MAP_REFRESH_TIMEOUT, \
+    METRIC_MAP_TTL, SKIPPED, TRANSFORMED, Transformer
+
+METADATA = repr({"spec_name": "design", "filter_name": "r",
+                 "extras": {"x": 1}, "parameters": {"p": [1, 2]},
+                 "blobs": {"a": "b"}})
+OLD_JOB = {"links": {"self": "http://old.example/jobs/12/"},
+           "ci_id": "12", "ci_name": "c", "ci_dataset": "d",
+           "ci_label": "l", "date": "2017-01-01", "ci_url": "u",
+           "status": 0,
+           "measurements": [{"metric": "AF1", "value": 1.5,
+                             "metadata": METADATA},
+                            # The same blob again, stored only once.
+                            {"metric": "AF1", "value": 2.5,
+                             "metadata": METADATA},
+                            {"metric": "PA1", "value": 2.0,
+                             "metadata": None}],
+           "blobs": [{"name": "old", "identifier": "x", "data": {}}],
+           "packages": [{"name": "afw", "build_version": "1",
+                         "git_commit": "abc"}]}
+
+
+def make_transformer(tmp_path, compact, metric_names=None):
+    context = Context(loglevel=logging.WARNING, directory=str(tmp_path),
+                      compact=compact, metric_names=metric_names)
+    transformer = Transformer(context=context)
+    transformer.metric_map = {"AF1": "mag", "PA1": "mmag"}
+    return transformer
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("blobs", [OLD_JOB["blobs"],
+                                   repr(OLD_JOB["blobs"])])
+def test_stream_matches_transform_job(tmp_path, compact, blobs):
+    data = codec.dumps(dict(OLD_JOB, blobs=blobs)).encode("utf-8")
+    transformer = make_transformer(tmp_path, compact)
+    expected = codec.dumps(transformer.transform_job(codec.loads(data)),
+                           compact=compact)
+    # A fresh transformer, so that nothing is served from its caches.
+    transformer = make_transformer(tmp_path, compact)
+    out = io.StringIO()
+    transformer.transform_job_stream(io.BytesIO(data), out)
+    assert out.getvalue() == expected
+
+
+def test_fingerprint_covers_only_the_metrics_used(tmp_path):
+    transformer = make_transformer(tmp_path, False)
+    transformer.write_job(dict(OLD_JOB), transformer.input_store)
+    jobnum, status, _, _, digests = transformer.transform_jobnum(12)
+    assert status == TRANSFORMED
+    input_digest, fingerprint, metric_keys = digests
+    assert metric_keys == [["AF1", "design", "r"], ["PA1", None, None]]
+    result = transformer.transform_jobnum(12, fingerprint, metric_keys)
+    assert result[1] == SKIPPED
+    # A metric the job does not use leaves its fingerprint alone.
+    transformer.metric_map["AM1"] = "marcsec"
+    assert transformer.fingerprint(input_digest, metric_keys) == fingerprint
+    transformer.metric_map["PA1"] = "mag"
+    assert transformer.fingerprint(input_digest, metric_keys) != fingerprint
+    result = transformer.transform_jobnum(12, fingerprint, metric_keys)
+    assert result[1] == TRANSFORMED
+
+
+def test_transforming_a_loaded_job_again_requeues_it(tmp_path, monkeypatch):
+    # The unit map is set by make_transformer, not fetched.
+    monkeypatch.setattr(Transformer, "_make_metric_map", lambda self: None)
+    names = str(tmp_path / "names.json")
+    with open(names, "w") as f:
+        json.dump([], f)
+    transformer = make_transformer(tmp_path, False, metric_names=names)
+    transformer.write_job(dict(OLD_JOB), transformer.input_store)
+    manifest = transformer.manifest
+    manifest.mark(12, EXTRACTED, size=1)
+    transformer.transform()
+    # As the loader records a loaded job.
+    transformer.context.jobmap.add(12, 7)
+    manifest.mark(12, LOADED, new_jobnum=7)
+    manifest.close()
+    with open(names, "w") as f:
+        json.dump([{"metric": "PA1", "name": "validate_drp.PA1_new"}], f)
+    transformer = make_transformer(tmp_path, False, metric_names=names)
+    transformer.transform()
+    assert 12 not in transformer.manifest.has(LOADED)
+    assert 12 not in JobMap(str(tmp_path))
+
+
+class DownService(object):
+    """Stands in for the HTTP session of an unreachable old service.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append(kwargs)
+        raise requests.exceptions.ConnectionError("down")
+
+
+def test_unreachable_service_falls_back_to_stale_metric_map(tmp_path):
+    transformer = make_transformer(tmp_path, False)
+    transformer.context.from_url = "http://old.example"
+    transformer._write_metric_map_cache({"AF1": "mag"}, None)
+    cache = transformer._read_metric_map_cache()
+    cache["fetched"] = time.time() - 2 * METRIC_MAP_TTL
+    with open(transformer._get_metric_map_cache_file(), "w") as f:
+        json.dump(cache, f)
+    service = DownService()
+    transformer.context.http.session = service
+    transformer._make_metric_map()
+    assert transformer.metric_map == {"AF1": "mag"}
+    # Given up on at the first failure, without a retry.
+    assert len(service.requests) == 1
+    assert service.requests[0]["timeout"] == METRIC_MAP_REFRESH_TIMEOUT
@@ -0,0 +1,186 @@
+"""Tests for retries, concurrency limits, and circuit breaking in the
+shared HTTP client.
+"""
+import threading
+import time
+import pytest
+import requests
+from squash_migrator import transport
+from squash_migrator.transport import BREAKER_COOLDOWN, BREAKER_THRESHOLD, \
+    MAX_RETRIES, AdaptiveLimiter, CircuitBreaker, HTTPClient
+
+URL = "http://new.example/job"
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession(object):
+    """Stands in for requests.Session, answering each request with the
+    next of the given responses, or raising it if it is an exception.
+    The last one is repeated once the others are used up.
+    """
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        answer = self.answers[0]
+        if len(self.answers) > 1:
+            self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(transport.time, "sleep", slept.append)
+    # Otherwise an open circuit would spin until its cooldown passed.
+    monkeypatch.setattr(transport, "BREAKER_COOLDOWN", 0)
+    return slept
+
+
+def make_client(*answers):
+    client = HTTPClient()
+    client.session = FakeSession(*answers)
+    return client
+
+
+@pytest.mark.parametrize("status", [500, 502, 503, 504, 429])
+def test_retries_retryable_statuses(sleeps, status):
+    client = make_client(FakeResponse(status), FakeResponse(200))
+    assert client.get(URL).status_code == 200
+    assert len(client.session.requests) == 2
+    assert len(sleeps) == 1
+
+
+def test_retry_after_sets_the_delay(sleeps):
+    client = make_client(FakeResponse(429, {"Retry-After": "3"}),
+                         FakeResponse(200))
+    assert client.get(URL).status_code == 200
+    assert sleeps == [3.0]
+
+
+@pytest.mark.parametrize("status", [400, 401, 404, 409])
+def test_does_not_retry_client_errors(sleeps, status):
+    client = make_client(FakeResponse(status), FakeResponse(200))
+    assert client.get(URL).status_code == status
+    assert len(client.session.requests) == 1
+    assert sleeps == []
+
+
+def test_gives_up_after_max_retries(sleeps):
+    client = make_client(FakeResponse(503))
+    assert client.get(URL).status_code == 503
+    assert len(client.session.requests) == MAX_RETRIES + 1
+    assert len(sleeps) == MAX_RETRIES
+
+
+def test_retries_can_be_turned_off(sleeps):
+    client = make_client(FakeResponse(503), FakeResponse(200))
+    assert client.get(URL, retries=0).status_code == 503
+    assert len(client.session.requests) == 1
+    assert sleeps == []
+
+
+def test_raises_the_last_exception(sleeps):
+    client = make_client(requests.exceptions.ConnectionError("down"))
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.get(URL)
+    assert len(client.session.requests) == MAX_RETRIES + 1
+
+
+def test_post_is_retried_only_if_unprocessed(sleeps):
+    # A 500 may mean the job was created, so it is not sent again.
+    client = make_client(FakeResponse(500), FakeResponse(200))
+    assert client.post(URL, data=b"{}").status_code == 500
+    client = make_client(FakeResponse(503), FakeResponse(200))
+    assert client.post(URL, data=b"{}").status_code == 200
+    client = make_client(requests.exceptions.ReadTimeout("slow"),
+                         FakeResponse(200))
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.post(URL, data=b"{}")
+
+
+def test_breaker_opens_after_repeated_failures():
+    breaker = CircuitBreaker()
+    for _ in range(BREAKER_THRESHOLD - 1):
+        breaker.record(False)
+    assert breaker.opened is None
+    breaker.record(False)
+    assert breaker.opened is not None
+
+
+def test_breaker_half_opens_for_one_probe():
+    breaker = CircuitBreaker()
+    for _ in range(BREAKER_THRESHOLD):
+        breaker.record(False)
+    # As if the cooldown had passed.
+    breaker.opened = time.monotonic() - BREAKER_COOLDOWN
+    breaker.wait()
+    assert breaker.probing
+    # A second request waits for the probe's outcome.
+    waiter = threading.Thread(target=breaker.wait)
+    waiter.start()
+    waiter.join(0.3)
+    assert waiter.is_alive()
+    breaker.record(True)
+    waiter.join(2)
+    assert not waiter.is_alive()
+    assert breaker.opened is None and breaker.failures == 0
+
+
+def test_failed_probe_reopens_the_breaker():
+    breaker = CircuitBreaker()
+    for _ in range(BREAKER_THRESHOLD):
+        breaker.record(False)
+    breaker.opened = time.monotonic() - BREAKER_COOLDOWN
+    breaker.wait()
+    breaker.record(False)
+    assert not breaker.probing
+    assert breaker.opened > time.monotonic() - BREAKER_COOLDOWN
+
+
+def cycle(limiter, latency, ok):
+    limiter.acquire()
+    limiter.release(latency, ok)
+
+
+def test_limiter_shrinks_on_failure_and_recovers():
+    limiter = AdaptiveLimiter(4, 8)
+    cycle(limiter, 0.1, True)
+    assert limiter.limit == pytest.approx(4.25)
+    cycle(limiter, None, False)
+    assert limiter.limit == pytest.approx(2.125)
+    # Failures in quick succession halve the limit only once.
+    cycle(limiter, None, False)
+    assert limiter.limit == pytest.approx(2.125)
+    for _ in range(100):
+        cycle(limiter, 0.1, True)
+    assert limiter.limit == 8
+
+
+def test_limiter_shrinks_on_slow_responses():
+    limiter = AdaptiveLimiter(4, 8)
+    cycle(limiter, 0.1, True)
+    cycle(limiter, 10, True)
+    assert limiter.limit < 4
+
+
+def test_limiter_never_goes_below_one():
+    limiter = AdaptiveLimiter(1, 1)
+    limiter._last_decrease = -transport.DECREASE_INTERVAL
+    cycle(limiter, None, False)
+    assert limiter.limit == 1
@@ -0,0 +1,99 @@
+"""Tests for checking loaded jobs against the new service.
+"""
+import logging
+from squash_migrator import codec
+from squash_migrator.context import Context
+from squash_migrator.jobmap import JobMap
+from squash_migrator.manifest import LOADED
+from squash_migrator.store import open_store
+from squash_migrator.verifier import DIVERGENT, MISSING, VERIFIED, \
+    Verifier, job_digest
+
+NEW_URL = "http://new.example"
+TRANSFORMED = {"_job_number": 12,
+               "meta": {"env": {"ci_id": "12", "env_name": "jenkins"},
+                        "packages": {"afw": {"git_sha": "abc"},
+                                     "pipe_base": {"git_sha": "def"}}},
+               "measurements": [{"metric": "AF1", "value": 0.1 + 0.2,
+                                 "unit": "mag", "identifier": None,
+                                 "blob_refs": ["b1"]},
+                                {"metric": "PA1", "value": 2,
+                                 "unit": "mmag", "identifier": None,
+                                 "blob_refs": None}],
+               "blobs": [{"identifier": "b1", "name": "AF1",
+                          "data": {"x": 1}}]}
+# The same job as the new service returns it.
+LOADED_JOB = {"id": 7, "date_created": "2018-01-01T00:00:00Z",
+              "s3_uri": "s3://bucket/7.json",
+              "env": {"ci_id": "12", "env_name": "jenkins"},
+              "packages": [{"name": "pipe_base", "git_sha": "def", "id": 2},
+                           {"name": "afw", "git_sha": "abc", "id": 1}],
+              "measurements": [{"id": 20, "metric": "PA1", "value": 2.0,
+                                "unit": "mmag"},
+                               {"id": 19, "metric": "AF1", "value": 0.3,
+                                "unit": "mag"}]}
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, obj=None):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = codec.dumps(obj).encode("utf-8")
+
+    def close(self):
+        pass
+
+
+class FakeService(object):
+    """Stands in for the HTTP session, serving the jobs in jobs by new
+    job number and answering 404 for any other.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def request(self, method, url, **kwargs):
+        new_jobnum = int(url.rsplit("/", 1)[1])
+        if new_jobnum not in self.jobs:
+            return FakeResponse(404)
+        return FakeResponse(200, self.jobs[new_jobnum])
+
+
+def test_digest_ignores_what_the_service_adds():
+    assert job_digest(TRANSFORMED) == job_digest(LOADED_JOB)
+
+
+def test_digest_sees_a_changed_measurement():
+    changed = dict(LOADED_JOB, measurements=[
+        dict(LOADED_JOB["measurements"][0], metric="PA1_new"),
+        LOADED_JOB["measurements"][1]])
+    assert job_digest(TRANSFORMED) != job_digest(changed)
+
+
+def make_verifier(tmp_path, jobs):
+    context = Context(token="t", loglevel=logging.CRITICAL,
+                      directory=str(tmp_path), to_url=NEW_URL)
+    context.http.session = FakeService(jobs)
+    return Verifier(context=context)
+
+
+def test_verify_and_requeue(tmp_path):
+    verifier = make_verifier(tmp_path, {7: LOADED_JOB,
+                                        8: dict(LOADED_JOB,
+                                                measurements=[])})
+    store = open_store(verifier.context, "transformed")
+    for jobnum, new_jobnum in ((12, 7), (13, 8), (14, 9)):
+        store.write(jobnum, dict(TRANSFORMED, _job_number=jobnum))
+        verifier.context.jobmap.add(jobnum, new_jobnum)
+        verifier.manifest.mark(jobnum, LOADED, new_jobnum=new_jobnum)
+    results = verifier.verify()
+    assert results[VERIFIED] == [12]
+    assert results[DIVERGENT] == [13]
+    assert results[MISSING] == [14]
+    verifier.requeue(results[DIVERGENT] + results[MISSING])
+    manifest = verifier.manifest
+    assert manifest.jobnums(LOADED) == [12]
+    assert manifest.failures() == {13: (LOADED, "failed verification"),
+                                   14: (LOADED, "failed verification")}
+    assert dict(JobMap(str(tmp_path)).items()) == {12: 7}